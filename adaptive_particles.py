@@ -0,0 +1,289 @@
+"""
+#Adaptive Particles:
+A particle set whose size changes every resample, using KLD-sampling (Fox, 2003, and Table 8.4 in Probabilistic
+Robotics).
+
+When the pose belief is tight (driving down a straight), a few hundred particles describe it just as well as
+5000, and the rest is wasted CPU. When it spreads out (a corner, or a bad measurement) we want more. KLD-sampling
+picks the number of particles so that, with probability 1 - δ, the error between the particle approximation
+and the true belief is below ε (measured by the KL divergence). It does this by counting how many bins of a pose
+space grid the particles fall in: k occupied bins needs
+
+    n = (k - 1) / 2ε * (1 - 2/(9(k - 1)) + sqrt(2/(9(k - 1))) z)³
+
+particles, where z is the upper 1 - δ quantile of the standard normal distribution.
+
+In the original algorithm particles are drawn one at a time until there are enough of them for the bins they
+have filled (and at least min_particles). Here a batch of max_particles candidates is drawn at once, the number
+of occupied bins after each prefix of the batch is worked out with a cumulative sum, and we take the first prefix
+that is big enough, or max_particles if none are. Then that many particles are resampled as normal.
+
+Every array is allocated for max_particles up front (like max_landmarks, see README), and number_of_particles
+of them are in use. poses, importance_factors, landmarks etc. are views of the first number_of_particles rows,
+so changing the count is just rebinding the views, never a reallocation. The viewer reads number_of_particles
+and the views every frame, so it follows the count on its own.
+"""
+
+from dataclasses import dataclass, fields
+from statistics import NormalDist
+from typing import Optional
+
+import numpy as np
+
+from particles import (
+    Particles,
+    ResampleBuffers,
+    MeasurementBuffers,
+    NUMBER_OF_LANDMARKS,
+    DEFAULT_RESAMPLING_METHOD,
+    RESAMPLING_METHODS,
+    _search_sorted,
+)
+from data_association import DEFAULT_CELL_SIZE
+from motion_models import MotionModel
+
+DEFAULT_KLD_ERROR = 0.05  # ε
+DEFAULT_KLD_CONFIDENCE = 0.99  # 1 - δ
+
+# Width of each pose space bin in x, y and θ. Smaller bins mean more particles for the same spread.
+DEFAULT_BIN_SIZE = (0.2, 0.2, np.deg2rad(10.))
+
+# These methods can draw a different number of particles than there are weights.
+ADAPTIVE_RESAMPLING_METHODS = ("systematic", "stratified", "multinomial")
+
+
+def kld_particle_count(occupied_bins, error: float = DEFAULT_KLD_ERROR, confidence: float = DEFAULT_KLD_CONFIDENCE):
+    """How many particles KLD-sampling needs for a given number of occupied bins. Works on arrays too.
+
+    One bin (or none) only needs one particle, the caller's min_particles takes over from there."""
+    z = NormalDist().inv_cdf(confidence)
+    degrees = np.maximum(np.asarray(occupied_bins, dtype=np.float64) - 1, 1)
+    a = 2 / (9 * degrees)
+    count = degrees / (2 * error) * (1 - a + np.sqrt(a) * z) ** 3
+
+    return np.where(np.asarray(occupied_bins) > 1, np.ceil(count), 1)
+
+
+@dataclass
+class KLDBuffers:
+    """Scratch space for AdaptiveParticles.kld_count, sized for max_particles candidates.
+
+    positions: uniform draws, used to pick candidates in a random (unsorted) order.
+    candidates: the candidate poses.
+    bins: the pose space bin of each candidate, as integers.
+    keys: each candidate's bin packed into one integer, so bins can be compared with np.unique.
+    first: True for the first candidate in each bin.
+    occupied: number of occupied bins after each prefix of the candidates.
+
+    positions and candidates use the pose dtype, as np.take can only write candidates into an array of the same
+    dtype as the poses."""
+    positions: np.ndarray
+    candidates: np.ndarray
+    bins: np.ndarray
+    keys: np.ndarray
+    first: np.ndarray
+    occupied: np.ndarray
+
+    @classmethod
+    def allocate(cls, number_of_candidates: int, dtype=np.float64) -> "KLDBuffers":
+        return cls(
+            np.empty(number_of_candidates, dtype=dtype),
+            np.empty((number_of_candidates, 3), dtype=dtype),
+            np.empty((number_of_candidates, 3), dtype=np.int64),
+            np.empty(number_of_candidates, dtype=np.int64),
+            np.empty(number_of_candidates, dtype=bool),
+            np.empty(number_of_candidates, dtype=np.int64),
+        )
+
+
+class AdaptiveParticles(Particles):
+    """A Particles object whose number_of_particles is picked by KLD-sampling every time it resamples.
+
+    Args:
+        min_particles, max_particles: the range number_of_particles stays in. Everything is allocated for
+            max_particles.
+        initial_pose: starting pose of every particle.
+        initial_particles: Optional. How many particles to start with. Defaults to max_particles, as we
+            normally know least at the start.
+        kld_error: Optional. ε, the largest KL divergence we'll accept. Smaller means more particles.
+        kld_confidence: Optional. 1 - δ, how sure we want to be that we're within kld_error.
+        bin_size: Optional. (x, y, θ) size of the pose space bins.
+        The rest are the same as Particles.
+
+    Attributes:
+    number_of_particles: how many particles are in use right now.
+    particle_capacity: max_particles."""
+    def __init__(
+        self,
+        min_particles: int,
+        max_particles: int,
+        initial_pose: np.ndarray,
+        initial_error: Optional[np.ndarray] = None,
+        max_landmarks: int = NUMBER_OF_LANDMARKS,
+        seed: Optional[int] = None,
+        association_cell_size: float = DEFAULT_CELL_SIZE,
+        landmark_cap: Optional[int] = None,
+        motion_model: Optional[MotionModel] = None,
+        shared_memory_name: Optional[str] = None,
+        dtype: Optional[np.dtype] = None,
+        packed_covariance: bool = False,
+        initial_particles: Optional[int] = None,
+        kld_error: float = DEFAULT_KLD_ERROR,
+        kld_confidence: float = DEFAULT_KLD_CONFIDENCE,
+        bin_size=DEFAULT_BIN_SIZE
+    ):
+        if not 1 <= min_particles <= max_particles:
+            raise ValueError(f"need 1 <= min_particles <= max_particles, got {min_particles} and {max_particles}.")
+
+        super().__init__(
+            max_particles,
+            initial_pose,
+            initial_error,
+            max_landmarks,
+            seed,
+            association_cell_size,
+            landmark_cap,
+            motion_model,
+            shared_memory_name=shared_memory_name,
+            dtype=dtype,
+            packed_covariance=packed_covariance,
+        )
+
+        self.min_particles = min_particles
+        self.max_particles = max_particles
+        self.kld_error = kld_error
+        self.kld_confidence = kld_confidence
+        self.bin_size = np.asarray(bin_size, dtype=np.float64)
+
+        # The full size arrays and buffers. The attributes Particles uses are views of their first rows.
+        self._pose_storage = (self.poses, self._spare_poses)
+        self._importance_storage = self.importance_factors
+        self._full_resample_buffers = self._resample_buffers
+        self._full_measurement_buffers = self._measurement_buffers
+        self._full_motion_buffers = self._motion_buffers
+        self._kld_buffers = KLDBuffers.allocate(max_particles, self.pose_dtype)
+
+        if initial_particles is None:
+            initial_particles = max_particles
+        self.number_of_particles = int(np.clip(initial_particles, min_particles, max_particles))
+        self.importance_factors.fill(1 / self.number_of_particles)
+        self._bind_particle_rows()
+        self.mark_changed()
+
+    def _bind_particle_rows(self) -> None:
+        """Points poses, importance_factors, the map views and the scratch buffers at the first
+        number_of_particles rows of the full size arrays."""
+        count = self.number_of_particles
+        self.poses = self._pose_storage[self._live_poses][:count]
+        self._spare_poses = self._pose_storage[self._live_poses ^ 1][:count]
+        self.importance_factors = self._importance_storage[:count]
+        self._rebind_views()
+
+        full = self._full_resample_buffers
+        self._resample_buffers = ResampleBuffers(
+            full.positions[:count], full.cumulative[:count], full.particle_range[:count], full.indices[:count]
+        )
+        self._measurement_buffers = MeasurementBuffers(*(
+            getattr(self._full_measurement_buffers, field.name)[:count]
+            for field in fields(MeasurementBuffers)
+        ))
+        self._motion_buffers = self._full_motion_buffers.shaped(count)
+
+    def _swap_spare_arrays(self) -> None:
+        super()._swap_spare_arrays()
+        self._bind_particle_rows()
+
+    def kld_count(self) -> int:
+        """How many particles KLD-sampling wants for the current (normalised) weights, between
+        min_particles and max_particles.
+
+        Draws max_particles candidates from the weights, in random order, then finds the first prefix
+        (of at least min_particles) with at least kld_particle_count(occupied bins) particles."""
+        buffers = self._kld_buffers
+        cumulative = self._full_resample_buffers.cumulative[:self.number_of_particles]
+        np.cumsum(self.importance_factors, out=cumulative)
+        cumulative[-1] = 1.
+
+        self.rng.random(out=buffers.positions, dtype=buffers.positions.dtype)
+        candidates = self._full_resample_buffers.indices
+        _search_sorted(cumulative, buffers.positions, candidates)
+        np.take(self.poses, candidates, axis=0, out=buffers.candidates, mode="clip")
+
+        # Headings are wrapped first, so θ and θ + 2π land in the same bin.
+        np.mod(buffers.candidates[:, 2], 2 * np.pi, out=buffers.candidates[:, 2])
+        buffers.candidates /= self.bin_size
+        np.floor(buffers.candidates, out=buffers.candidates)
+        buffers.bins[:] = buffers.candidates
+
+        # Pack (x, y, θ) bins into one integer. 21 bits each is ±1 million bins in x and y, plenty for a track.
+        bins = buffers.bins
+        bins[:, :2] += 1 << 20
+        np.left_shift(bins[:, 0], 42, out=buffers.keys)
+        buffers.keys |= bins[:, 1] << 21
+        buffers.keys |= bins[:, 2]
+
+        _, first_indices = np.unique(buffers.keys, return_index=True)
+        buffers.first.fill(False)
+        buffers.first[first_indices] = True
+        np.cumsum(buffers.first, out=buffers.occupied)
+
+        # Like the original loop, we always draw at least min_particles before checking.
+        first = self.min_particles - 1
+        required = kld_particle_count(buffers.occupied[first:], self.kld_error, self.kld_confidence)
+        enough = np.flatnonzero(self._full_resample_buffers.particle_range[first:] + 1 >= required)
+
+        return first + int(enough[0]) + 1 if len(enough) else self.max_particles
+
+    def resample(
+        self,
+        method: str = DEFAULT_RESAMPLING_METHOD,
+        ess_threshold: Optional[float] = None
+    ) -> bool:
+        """Picks a new number_of_particles with kld_count, then draws that many particles from the current ones.
+
+        Args:
+            method: one of ADAPTIVE_RESAMPLING_METHODS ("systematic", "stratified", "multinomial"). Residual
+                resampling can't change the number of particles.
+            ess_threshold: the same as Particles.resample. If we don't resample, the count stays the same.
+
+        Returns:
+            True if the particles were resampled."""
+        if method not in ADAPTIVE_RESAMPLING_METHODS:
+            raise ValueError(
+                f"AdaptiveParticles can't use {method!r} resampling, pick one of {ADAPTIVE_RESAMPLING_METHODS}."
+            )
+        if ess_threshold is not None:
+            if self.effective_sample_size() >= ess_threshold * self.number_of_particles:
+                return False
+
+        self.normalise_importance_factors()
+        count = self.kld_count()
+
+        # The pointers (and the particles drawn) are sized for the new count, the wheel for the old one.
+        full = self._full_resample_buffers
+        buffers = ResampleBuffers(
+            full.positions[:count],
+            full.cumulative[:self.number_of_particles],
+            full.particle_range[:count],
+            full.indices[:count],
+        )
+        indices = RESAMPLING_METHODS[method](self.importance_factors, self.rng, buffers)
+        self.gather(indices)
+        self.importance_factors.fill(1 / self.number_of_particles)
+
+        return True
+
+    def gather(self, indices: np.ndarray) -> None:
+        """Replaces the particles with particles[indices]. number_of_particles becomes len(indices), which
+        has to be between min_particles and max_particles."""
+        count = len(indices)
+        if not self.min_particles <= count <= self.max_particles:
+            raise ValueError(
+                f"can't gather {count} particles, the count has to stay between "
+                f"{self.min_particles} and {self.max_particles}."
+            )
+
+        # The spare poses need room for the new count before Particles.gather writes into them.
+        self._spare_poses = self._pose_storage[self._live_poses ^ 1][:count]
+        self.number_of_particles = count
+        super().gather(indices)
@@ -0,0 +1,127 @@
+"""
+#Import Time Benchmark:
+Checks that `import particles` stays cheap, so a headless node (like the one on the car) starts quickly.
+
+It imports particles in a fresh interpreter a few times with python -X importtime and fails (exit code 1) if:
+- any module in FORBIDDEN_MODULES got imported (matplotlib and Qt are only for plotting and viewing), or
+- the median import time is more than TOLERANCE times the saved baseline.
+
+Run it from the repo root:
+    python benchmarks/import_time.py                    # check against the baseline
+    python benchmarks/import_time.py --update-baseline  # save this machine's numbers as the new baseline
+
+Numba takes a few hundred ms to import, so numba and numpy only runs are timed separately
+(CLOUDS_DISABLE_NUMBA skips the numba import completely).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_ROOT, "benchmarks", "baselines", "import_time.json")
+
+MODULE = "particles"
+FORBIDDEN_MODULES = ("matplotlib", "PyQt5")
+RUNS = 5
+TOLERANCE = 1.5
+SLOWEST_SHOWN = 5
+
+# Rule 3: Use dictionaries for more complex lookups.
+CONFIGURATIONS = {
+    "numpy": {"CLOUDS_DISABLE_NUMBA": "1"},
+    "numba": {},
+}
+
+CHECK_SCRIPT = (
+    f"import sys, {MODULE}; "
+    f"print(','.join(name for name in {FORBIDDEN_MODULES!r} if name in sys.modules))"
+)
+
+
+def import_once(environment: dict) -> tuple:
+    """Imports MODULE in a new interpreter. Returns (total ms, {module: cumulative ms}, forbidden modules seen)."""
+    env = dict(os.environ)
+    env.pop("CLOUDS_DISABLE_NUMBA", None)
+    env.update(environment)
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHECK_SCRIPT],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True
+    )
+
+    # -X importtime lines look like "import time:  self [us] | cumulative | imported package".
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_time, total_time, name = (part.strip() for part in line.replace("import time:", "|", 1).split("|"))
+        cumulative[name.strip()] = int(total_time) / 1000
+
+    forbidden = [name for name in result.stdout.strip().split(",") if name]
+    return cumulative[MODULE], cumulative, forbidden
+
+
+def measure(environment: dict) -> dict:
+    totals = []
+    slowest = {}
+    forbidden = set()
+    for _ in range(RUNS):
+        total, cumulative, seen = import_once(environment)
+        totals.append(total)
+        forbidden.update(seen)
+        for name, milliseconds in cumulative.items():
+            if name != MODULE and "." not in name:
+                slowest[name] = min(slowest.get(name, milliseconds), milliseconds)
+
+    return {
+        "median_ms": statistics.median(totals),
+        "min_ms": min(totals),
+        "slowest_imports_ms": dict(sorted(slowest.items(), key=lambda item: -item[1])[:SLOWEST_SHOWN]),
+        "forbidden_modules": sorted(forbidden),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--update-baseline", action="store_true", help="save these results as the baseline")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    failed = False
+    for name, environment in CONFIGURATIONS.items():
+        result = measure(environment)
+        results[name] = result
+
+        print(f"{name}: median {result['median_ms']:.1f}ms, min {result['min_ms']:.1f}ms")
+        for module, milliseconds in result["slowest_imports_ms"].items():
+            print(f"    {module:<24}{milliseconds:8.1f}ms")
+
+        if result["forbidden_modules"]:
+            print(f"    FAIL: importing {MODULE} imported {', '.join(result['forbidden_modules'])}")
+            failed = True
+
+        if name in baseline and not args.update_baseline:
+            limit = baseline[name]["median_ms"] * TOLERANCE
+            if result["median_ms"] > limit:
+                print(f"    FAIL: {result['median_ms']:.1f}ms is over the {limit:.1f}ms limit (baseline x {TOLERANCE})")
+                failed = True
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+        print(f"saved baseline to {BASELINE_PATH}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+#Sharding Benchmark:
+Measures how one filter cycle speeds up with ShardedParticles as workers are added.
+
+A cycle is one predict, MEASUREMENTS measurement updates and a resample, with LANDMARKS landmarks in the map.
+Each worker count is compared to a plain Particles on the same seed, and the speed up and parallel
+efficiency (speed up / workers) are printed. On a machine with W free cores, expect the efficiency to stay
+near 1 up to W workers for 20k+ particles, and fall off for small particle counts where the per command
+overhead (roughly 50-100µs per worker) dominates.
+
+Run it from the repo root:
+    python benchmarks/sharding.py
+    python benchmarks/sharding.py --particles 20000 100000 --workers 1 2 4 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from particles import Particles, get_landmark_offsets, get_landmark_covs  # noqa: E402
+from sharded_particles import ShardedParticles  # noqa: E402
+from motion_models import VelocityMotionModel  # noqa: E402
+
+LANDMARKS = 50
+MEASUREMENTS = 10
+WARMUP = 2
+REPEATS = 10
+SEED = 0
+
+ALPHAS = [0.01, 0.0001, 0.0001, 0.001, 0.05, 0.1]
+SENSOR_NOISE = np.array(((0.1, 0.), (0., 0.01)))
+DETECTIONS = np.column_stack((np.linspace(2, 10, LANDMARKS), np.linspace(-1, 1, LANDMARKS)))
+
+
+def add_map(particles: Particles) -> None:
+    if isinstance(particles, ShardedParticles):
+        particles.add_observations(DETECTIONS, SENSOR_NOISE)
+        return
+
+    positions = get_landmark_offsets(particles, DETECTIONS) + particles.poses[:, None, :2]
+    particles.add_landmarks(positions, get_landmark_covs(DETECTIONS, SENSOR_NOISE, particles.poses[:, 2]))
+
+
+def cycle(particles: Particles) -> None:
+    particles.predict((1., 0.2), 0.1)
+    for landmark_index in range(MEASUREMENTS):
+        particles.measurement_update(landmark_index, DETECTIONS[landmark_index], SENSOR_NOISE)
+    particles.resample()
+
+
+def time_cycle(particles: Particles) -> float:
+    """Median time of one cycle, in ms."""
+    add_map(particles)
+    for _ in range(WARMUP):
+        cycle(particles)
+
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        cycle(particles)
+        times.append(time.perf_counter() - start)
+
+    return float(np.median(times)) * 1000
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--particles", nargs="+", type=int, default=[20000, 50000, 100000])
+    parser.add_argument("--workers", nargs="+", type=int, default=None, help="defaults to 1, 2, 4... up to the core count")
+    arguments = parser.parse_args()
+
+    workers = arguments.workers
+    if workers is None:
+        cores = os.cpu_count() or 1
+        workers = [2 ** power for power in range(cores.bit_length()) if 2 ** power <= cores]
+
+    model = VelocityMotionModel(ALPHAS)
+    print(f"{'particles':>10} {'workers':>8} {'cycle ms':>10} {'speed up':>9} {'efficiency':>11}")
+    for number_of_particles in arguments.particles:
+        single = time_cycle(
+            Particles(number_of_particles, np.zeros(3), seed=SEED, max_landmarks=LANDMARKS, motion_model=model)
+        )
+        print(f"{number_of_particles:>10} {'-':>8} {single:>10.2f} {1:>9.2f} {'-':>11}")
+
+        for number_of_workers in workers:
+            with ShardedParticles(
+                number_of_particles, np.zeros(3), seed=SEED, max_landmarks=LANDMARKS,
+                motion_model=model, number_of_workers=number_of_workers
+            ) as particles:
+                sharded = time_cycle(particles)
+
+            speed_up = single / sharded
+            print(
+                f"{number_of_particles:>10} {number_of_workers:>8} {sharded:>10.2f} "
+                f"{speed_up:>9.2f} {speed_up / number_of_workers:>11.2f}"
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,478 @@
+"""
+#Benchmark Suite:
+Times the filter and viewer hot paths over a sweep of particle and landmark counts, and fails loudly if
+anything got slower (or hungrier) than the saved baseline.
+
+Every benchmark is run for each particle count in PARTICLE_COUNTS and, if it depends on the map size, each
+landmark count in LANDMARK_COUNTS. The sharded_* cases are run for each worker count in WORKER_COUNTS too
+(the W= part of their name). For each case we report:
+- p50, p90 and p99 latency of one call, over at least MIN_REPEATS calls (after WARMUP calls).
+- peak_kib: the most memory (traced by tracemalloc, numpy arrays included) in use at once during one call,
+  above what was in use before it. A call that only writes into preallocated buffers scores ~0.
+- retained_blocks: how many allocations made by one call were still alive afterwards.
+- setup_kib: memory allocated by the setup (mostly the Particles object itself).
+
+Everything uses fixed seeds, so two runs on the same machine do the same work.
+
+Run it from the repo root:
+    python benchmarks/suite.py                      # full sweep, checked against the baseline
+    python benchmarks/suite.py --quick              # small sweep, for a quick look
+    python benchmarks/suite.py --only predict iteration
+    python benchmarks/suite.py --update-baseline    # save this machine's results as the baseline
+    python benchmarks/suite.py --output results.json
+
+The sharded cases only show a speed up when there are at least W free cores. With fewer, they measure the
+per command overhead of talking to the workers. peak_kib only covers the coordinating process.
+
+A case fails if its p50 is more than TIME_TOLERANCE times the baseline (plus TIME_SLACK_MS, so tiny
+timings don't flap), or its peak_kib is more than MEMORY_TOLERANCE times the baseline (plus
+MEMORY_SLACK_KIB). Cases with no baseline are just reported. Exit code 1 means something regressed.
+
+The viewer benchmarks use Qt's offscreen platform, so they run without a display. They're skipped if PyQt5
+isn't installed.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from math import pi
+from typing import Callable, Optional
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from particles import (  # noqa: E402
+    Particles,
+    motion_update,
+    ackermann_motion_update,
+    get_landmark_offset,
+    get_landmark_cov,
+)
+from sharded_particles import ShardedParticles  # noqa: E402
+from motion_models import VelocityMotionModel  # noqa: E402
+import numba_kernels  # noqa: E402
+
+BASELINE_PATH = os.path.join(REPO_ROOT, "benchmarks", "baselines", "suite.json")
+
+PARTICLE_COUNTS = (100, 1000, 5000, 20000, 50000)
+LANDMARK_COUNTS = (10, 100, 1000)
+QUICK_PARTICLE_COUNTS = (100, 1000)
+QUICK_LANDMARK_COUNTS = (10, 100)
+WORKER_COUNTS = (1, 2, 4)
+
+# Skip cases whose map (live and spare copies) would need more than this.
+MAX_MAP_BYTES = 1024 ** 3
+MAP_BYTES_PER_LANDMARK = 2 * (2 + 1 + 4) * 4  # live and spare float32 position, Tau and covariance.
+
+SEED = 1234
+WARMUP = 2
+MIN_REPEATS = 10
+MAX_REPEATS = 500
+TARGET_SECONDS = 0.25  # Keep repeating (up to MAX_REPEATS) until this much time has been spent on a case.
+
+TIME_TOLERANCE = 1.5
+TIME_SLACK_MS = 0.05
+MEMORY_TOLERANCE = 1.25
+MEMORY_SLACK_KIB = 64
+
+INITIAL_POSE = np.array((0., 0., 0.))
+INITIAL_ERROR = np.array((1., 1., 0.05))
+ALPHAS = [0.1, 0.1, 0.000001, 0.000001, 0.0000001, 0.0000001]
+CONTROL = np.array((5., 0.1))
+TIMESTEP = 1 / 30
+POLAR_DETECTION = np.array((15., pi / 4))
+SENSOR_COVARIANCE = np.array(((0.3, 0.2), (0.2, 0.5)))
+
+
+@dataclass
+class Benchmark:
+    """One thing to time.
+
+    setup(number_of_particles, number_of_landmarks) does the untimed work and returns the function to time.
+    uses_landmarks: if False, the landmark sweep is skipped (only the first landmark count is run).
+    max_particles: Optional. Larger particle counts are skipped, for things that are slow by design.
+    uses_workers: if True, setup also takes number_of_workers and every count in WORKER_COUNTS is run.
+
+    If the returned function has a close attribute, it is called once the case is done (e.g. to stop workers)."""
+    setup: Callable[..., Callable[[], None]]
+    uses_landmarks: bool = False
+    max_particles: Optional[int] = None
+    needs_qt: bool = False
+    uses_workers: bool = False
+
+
+def make_particles(
+    number_of_particles: int,
+    number_of_landmarks: int,
+    fill: bool = True,
+    number_of_workers: Optional[int] = None
+) -> Particles:
+    """A seeded particle set with room for number_of_landmarks. If fill, the map is filled up too.
+
+    If number_of_workers is given, it's a ShardedParticles with that many workers. Close it when you're done."""
+    arguments = dict(
+        max_landmarks=number_of_landmarks,
+        seed=SEED,
+        landmark_cap=number_of_landmarks,
+        motion_model=VelocityMotionModel(ALPHAS),
+    )
+    if number_of_workers is None:
+        particles = Particles(number_of_particles, INITIAL_POSE, INITIAL_ERROR, **arguments)
+    else:
+        particles = ShardedParticles(
+            number_of_particles, INITIAL_POSE, INITIAL_ERROR, number_of_workers=number_of_workers, **arguments
+        )
+
+    if fill:
+        offsets = np.random.default_rng(SEED).uniform(-50, 50, (number_of_landmarks, 2))
+        positions = particles.poses[None, :, :2] + offsets[:, None, :]
+        particles.add_landmarks(
+            positions.transpose(1, 0, 2),
+            np.broadcast_to(SENSOR_COVARIANCE, (number_of_landmarks, 2, 2)),
+        )
+
+    return particles
+
+
+def setup_construction(number_of_particles, number_of_landmarks):
+    return lambda: make_particles(number_of_particles, number_of_landmarks, fill=False)
+
+
+def setup_add_landmark(number_of_particles, number_of_landmarks):
+    """Adds a landmark and its covariance to a full map, so every call evicts one and the size stays put."""
+    particles = make_particles(number_of_particles, number_of_landmarks)
+    offset = get_landmark_offset(particles, POLAR_DETECTION)
+    covariance = get_landmark_cov(POLAR_DETECTION, SENSOR_COVARIANCE)
+
+    def add_landmark():
+        particles.add_landmark(particles.poses[:, :2] + offset)
+        particles.add_covariance(covariance)
+
+    return add_landmark
+
+
+def setup_motion_update(number_of_particles, number_of_landmarks):
+    particles = make_particles(number_of_particles, number_of_landmarks, fill=False)
+    return lambda: motion_update(particles, CONTROL, TIMESTEP, ALPHAS)
+
+
+def setup_ackermann_motion_update(number_of_particles, number_of_landmarks):
+    particles = make_particles(number_of_particles, number_of_landmarks, fill=False)
+    return lambda: ackermann_motion_update(particles, CONTROL, TIMESTEP, ALPHAS)
+
+
+def setup_predict(number_of_particles, number_of_landmarks):
+    particles = make_particles(number_of_particles, number_of_landmarks, fill=False)
+    return lambda: particles.predict(CONTROL, TIMESTEP)
+
+
+def setup_get_landmark_offset(number_of_particles, number_of_landmarks):
+    particles = make_particles(number_of_particles, number_of_landmarks, fill=False)
+    return lambda: get_landmark_offset(particles, POLAR_DETECTION)
+
+
+def setup_get_landmark_offset_out(number_of_particles, number_of_landmarks):
+    particles = make_particles(number_of_particles, number_of_landmarks, fill=False)
+    out = np.empty((number_of_particles, 2))
+    return lambda: get_landmark_offset(particles, POLAR_DETECTION, out)
+
+
+def setup_get_landmark_cov(number_of_particles, number_of_landmarks):
+    return lambda: get_landmark_cov(POLAR_DETECTION, SENSOR_COVARIANCE)
+
+
+def setup_measurement_update(number_of_particles, number_of_landmarks):
+    particles = make_particles(number_of_particles, number_of_landmarks)
+    landmark = number_of_landmarks // 2
+    return lambda: particles.measurement_update(landmark, POLAR_DETECTION, SENSOR_COVARIANCE)
+
+
+def setup_resample(number_of_particles, number_of_landmarks):
+    """Gathers the whole map every call, so this is the landmark-heavy part of a filter step."""
+    particles = make_particles(number_of_particles, number_of_landmarks)
+    return lambda: particles.resample()
+
+
+def setup_sharded_predict(number_of_particles, number_of_landmarks, number_of_workers):
+    """The same as predict, with the particles split across number_of_workers processes."""
+    particles = make_particles(
+        number_of_particles, number_of_landmarks, fill=False, number_of_workers=number_of_workers
+    )
+
+    def predict():
+        particles.predict(CONTROL, TIMESTEP)
+
+    predict.close = particles.close
+    return predict
+
+
+def setup_sharded_resample(number_of_particles, number_of_landmarks, number_of_workers):
+    """The same as resample, with every worker gathering its own shard of the map."""
+    particles = make_particles(number_of_particles, number_of_landmarks, number_of_workers=number_of_workers)
+
+    def resample():
+        particles.resample()
+
+    resample.close = particles.close
+    return resample
+
+
+def setup_iteration(number_of_particles, number_of_landmarks):
+    particles = make_particles(number_of_particles, number_of_landmarks, fill=False)
+
+    def iterate():
+        for particle in particles:
+            particle.pose
+
+    return iterate
+
+
+_application = None
+
+
+def _qt_application():
+    """Makes the QApplication the viewer benchmarks need. It's kept in a global so it isn't garbage collected."""
+    global _application
+    from PyQt5.QtWidgets import QApplication
+    if _application is None:
+        _application = QApplication.instance() or QApplication([])
+    return _application
+
+
+def setup_particle_cloud_update(number_of_particles, number_of_landmarks):
+    """The old one-graphics-item-per-particle cloud."""
+    _qt_application()
+    from particle_cloud import ParticleCloud
+    from vehicle_cloud import create_direction_particle, update_direction_particle
+
+    particles = make_particles(number_of_particles, number_of_landmarks, fill=False)
+    cloud = ParticleCloud(particles, create_direction_particle, update_direction_particle, None, None)
+
+    def update():
+        particles.mark_changed()
+        cloud.update_particles()
+
+    return update
+
+
+def setup_pose_cloud_render(number_of_particles, number_of_landmarks):
+    """Updates the batched pose cloud and paints the whole scene into an offscreen image."""
+    _qt_application()
+    from PyQt5.QtGui import QImage, QPainter
+    from PyQt5.QtWidgets import QGraphicsScene
+    from vehicle_cloud import PoseCloudItem
+
+    particles = make_particles(number_of_particles, number_of_landmarks, fill=False)
+    cloud = PoseCloudItem(particles)
+    scene = QGraphicsScene()
+    scene.addItem(cloud)
+    image = QImage(800, 600, QImage.Format_ARGB32_Premultiplied)
+
+    def render():
+        particles.mark_changed()
+        cloud.update_particles()
+        painter = QPainter(image)
+        scene.render(painter)
+        painter.end()
+
+    # The scene and image have to outlive the closure.
+    render.keep_alive = (scene, image)
+    return render
+
+
+# Rule 3: Use dictionaries for more complex lookups.
+BENCHMARKS = {
+    "construction": Benchmark(setup_construction, uses_landmarks=True),
+    "add_landmark": Benchmark(setup_add_landmark, uses_landmarks=True),
+    "motion_update": Benchmark(setup_motion_update),
+    "ackermann_motion_update": Benchmark(setup_ackermann_motion_update),
+    "predict": Benchmark(setup_predict),
+    "get_landmark_offset": Benchmark(setup_get_landmark_offset),
+    "get_landmark_offset_out": Benchmark(setup_get_landmark_offset_out),
+    "get_landmark_cov": Benchmark(setup_get_landmark_cov),
+    "measurement_update": Benchmark(setup_measurement_update, uses_landmarks=True),
+    "resample": Benchmark(setup_resample, uses_landmarks=True),
+    "sharded_predict": Benchmark(setup_sharded_predict, uses_workers=True),
+    "sharded_resample": Benchmark(setup_sharded_resample, uses_landmarks=True, uses_workers=True),
+    "iteration": Benchmark(setup_iteration),
+    "particle_cloud_update": Benchmark(setup_particle_cloud_update, max_particles=5000, needs_qt=True),
+    "pose_cloud_render": Benchmark(setup_pose_cloud_render, needs_qt=True),
+}
+
+
+def case_name(
+    benchmark: str, number_of_particles: int, number_of_landmarks: int, number_of_workers: Optional[int] = None
+) -> str:
+    if number_of_workers is None:
+        return f"{benchmark}/N={number_of_particles}/L={number_of_landmarks}"
+    return f"{benchmark}/W={number_of_workers}/N={number_of_particles}/L={number_of_landmarks}"
+
+
+def measure(function: Callable[[], None]) -> dict:
+    """Times function, then runs it once more under tracemalloc for its memory use."""
+    for _ in range(WARMUP):
+        function()
+
+    times = []
+    started = time.perf_counter()
+    while len(times) < MAX_REPEATS and (
+        len(times) < MIN_REPEATS or time.perf_counter() - started < TARGET_SECONDS
+    ):
+        call_start = time.perf_counter_ns()
+        function()
+        times.append(time.perf_counter_ns() - call_start)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    in_use, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    del result
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "lineno") if stat.count_diff > 0)
+    times_ms = np.array(times) / 1e6
+
+    return {
+        "p50_ms": float(np.percentile(times_ms, 50)),
+        "p90_ms": float(np.percentile(times_ms, 90)),
+        "p99_ms": float(np.percentile(times_ms, 99)),
+        "repeats": len(times),
+        "peak_kib": (peak - in_use) / 1024,
+        "retained_blocks": retained,
+    }
+
+
+def run_case(
+    benchmark: Benchmark, number_of_particles: int, number_of_landmarks: int, number_of_workers: Optional[int] = None
+) -> dict:
+    setup_arguments = (number_of_particles, number_of_landmarks)
+    if number_of_workers is not None:
+        setup_arguments += (number_of_workers,)
+
+    tracemalloc.start()
+    function = benchmark.setup(*setup_arguments)
+    setup_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    try:
+        result = measure(function)
+    finally:
+        close = getattr(function, "close", None)
+        if close is not None:
+            close()
+    result["setup_kib"] = setup_bytes / 1024
+    return result
+
+
+def regressions(name: str, result: dict, baseline: dict) -> list:
+    """Returns a message for every way result is worse than baseline."""
+    messages = []
+    time_limit = baseline["p50_ms"] * TIME_TOLERANCE + TIME_SLACK_MS
+    if result["p50_ms"] > time_limit:
+        messages.append(f"{name}: p50 {result['p50_ms']:.3f}ms is over the {time_limit:.3f}ms limit")
+
+    memory_limit = baseline["peak_kib"] * MEMORY_TOLERANCE + MEMORY_SLACK_KIB
+    if result["peak_kib"] > memory_limit:
+        messages.append(f"{name}: peak {result['peak_kib']:.0f}KiB is over the {memory_limit:.0f}KiB limit")
+
+    return messages
+
+
+def cases(names: list, particle_counts: tuple, landmark_counts: tuple):
+    """Yields (name, benchmark, N, L, W) for every case in the sweep that fits in memory. W is None unless
+    the benchmark uses_workers."""
+    qt_available = True
+    try:
+        import PyQt5  # noqa: F401
+    except ImportError:
+        qt_available = False
+
+    for benchmark_name in names:
+        benchmark = BENCHMARKS[benchmark_name]
+        if benchmark.needs_qt and not qt_available:
+            print(f"skipping {benchmark_name}: PyQt5 isn't installed")
+            continue
+
+        for number_of_particles in particle_counts:
+            if benchmark.max_particles is not None and number_of_particles > benchmark.max_particles:
+                continue
+            for number_of_landmarks in landmark_counts if benchmark.uses_landmarks else landmark_counts[:1]:
+                if number_of_particles * number_of_landmarks * MAP_BYTES_PER_LANDMARK > MAX_MAP_BYTES:
+                    continue
+                for number_of_workers in WORKER_COUNTS if benchmark.uses_workers else (None,):
+                    yield benchmark_name, benchmark, number_of_particles, number_of_landmarks, number_of_workers
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="run a small sweep")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS), metavar="BENCHMARK")
+    parser.add_argument("--update-baseline", action="store_true", help="save these results as the baseline")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    particle_counts = QUICK_PARTICLE_COUNTS if args.quick else PARTICLE_COUNTS
+    landmark_counts = QUICK_LANDMARK_COUNTS if args.quick else LANDMARK_COUNTS
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as baseline_file:
+            baseline = json.load(baseline_file)["cases"]
+
+    results = {}
+    failures = []
+    print(f"{'case':<48}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'peak KiB':>11}{'blocks':>8}")
+    for benchmark_name, benchmark, number_of_particles, number_of_landmarks, number_of_workers in cases(
+        args.only, particle_counts, landmark_counts
+    ):
+        name = case_name(benchmark_name, number_of_particles, number_of_landmarks, number_of_workers)
+        result = run_case(benchmark, number_of_particles, number_of_landmarks, number_of_workers)
+        results[name] = result
+
+        print(
+            f"{name:<48}{result['p50_ms']:>10.3f}{result['p90_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+            f"{result['peak_kib']:>11.0f}{result['retained_blocks']:>8}"
+        )
+        if name in baseline and not args.update_baseline:
+            failures += regressions(name, result, baseline[name])
+
+    machine = {
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": sys.platform,
+        "cpu_count": os.cpu_count(),
+        "numba": numba_kernels.USE_NUMBA,
+    }
+    report = {"machine": machine, "cases": results}
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=4)
+
+    if args.update_baseline:
+        # Keep the baselines of cases we didn't run this time.
+        with open(BASELINE_PATH, "w") as baseline_file:
+            json.dump({"machine": machine, "cases": {**baseline, **results}}, baseline_file, indent=4)
+        print(f"saved baseline to {BASELINE_PATH}")
+
+    if failures:
+        print(f"\nREGRESSIONS ({len(failures)}):")
+        for message in failures:
+            print(f"    {message}")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
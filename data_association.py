@@ -0,0 +1,123 @@
+"""
+#Data Association:
+Every time a cone is detected, we need to figure out which landmark it belongs to (or if it's a new one).
+
+Checking every detection against every landmark of every particle is O(N·M·L), which gets very slow once
+a lap has added a few hundred cones. Instead, we keep a coarse grid over the landmark positions, and only
+test landmarks that sit in the grid cells around each detection.
+
+The grid holds the mean position of each landmark across all particles. Each particle's estimate of a landmark
+is normally very close to the mean, so as long as the cells are bigger than the distance we'd ever match a
+cone over, the 3x3 block of cells around a detection contains every landmark that could pass the gate.
+"""
+
+import numpy as np
+
+# Chi-squared value for 2 degrees of freedom at 95% confidence. This is used to gate associations
+# and to size uncertainty ellipses.
+DEFAULT_CONFIDENCE_THRESHOLD = 0.95
+DEFAULT_CHI_SQUARED_VALUE = 5.991  # Two sigma.
+
+DEFAULT_CELL_SIZE = 5.0  # meters. Should be bigger than the furthest you would ever match a cone.
+
+
+def chi_squared_value(confidence: float = DEFAULT_CONFIDENCE_THRESHOLD) -> float:
+    """The chi-squared value for 2 degrees of freedom at a given confidence, e.g. 0.95 -> 5.991.
+
+    With 2 degrees of freedom the chi-squared distribution is just an exponential, so there's a closed form
+    and we don't need a lookup table (or scipy)."""
+    return -2 * np.log1p(-confidence)
+
+
+class LandmarkGrid:
+    """A uniform grid spatial index over landmark mean positions.
+
+    cells maps an integer (x, y) cell to the list of landmark indices inside it. We keep track of which
+    cell each landmark is in, so moving a landmark is just a remove and an append.
+
+    Attributes:
+    cell_size: the width of each square cell in meters.
+    cells: dictionary from (cell_x, cell_y) to a list of landmark indices."""
+    def __init__(self, cell_size: float = DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self._landmark_cells = []
+
+    def __len__(self):
+        return len(self._landmark_cells)
+
+    def cell_of(self, position: np.ndarray) -> tuple:
+        return (
+            int(np.floor(position[0] / self.cell_size)),
+            int(np.floor(position[1] / self.cell_size)),
+        )
+
+    def insert(self, position: np.ndarray) -> int:
+        """Adds a new landmark to the index. Landmarks are numbered in the order they are inserted."""
+        landmark_index = len(self._landmark_cells)
+        cell = self.cell_of(position)
+        self.cells.setdefault(cell, []).append(landmark_index)
+        self._landmark_cells.append(cell)
+
+        return landmark_index
+
+    def insert_many(self, positions: np.ndarray) -> None:
+        for position in positions:
+            self.insert(position)
+
+    def move(self, landmark_index: int, position: np.ndarray) -> None:
+        """Updates where a landmark is. Does nothing if it hasn't changed cell."""
+        new_cell = self.cell_of(position)
+        old_cell = self._landmark_cells[landmark_index]
+        if new_cell == old_cell:
+            return
+
+        self.cells[old_cell].remove(landmark_index)
+        if not self.cells[old_cell]:
+            del self.cells[old_cell]
+
+        self.cells.setdefault(new_cell, []).append(landmark_index)
+        self._landmark_cells[landmark_index] = new_cell
+
+    def rebuild(self, positions: np.ndarray) -> None:
+        """Throws away the index and builds it again from an (L, 2) array of positions."""
+        self.cells = {}
+        self._landmark_cells = []
+        self.insert_many(positions)
+
+    def move_all(self, positions: np.ndarray) -> None:
+        """Moves every landmark to an (L, 2) array of positions.
+
+        After a resample most landmarks stay in the same cell, so this keeps the existing cell lists instead of
+        building new ones like rebuild does. Falls back to rebuild if the number of landmarks has changed."""
+        if len(positions) != len(self._landmark_cells):
+            self.rebuild(positions)
+            return
+
+        for landmark_index, position in enumerate(positions):
+            self.move(landmark_index, position)
+
+    def query(self, position: np.ndarray) -> list:
+        """Returns every landmark in the 3x3 block of cells around position."""
+        cell_x, cell_y = self.cell_of(position)
+        nearby = []
+        for x in range(cell_x - 1, cell_x + 2):
+            for y in range(cell_y - 1, cell_y + 2):
+                nearby.extend(self.cells.get((x, y), ()))
+
+        return nearby
+
+    def candidates(self, positions: np.ndarray) -> np.ndarray:
+        """Queries an (M, 2) array of positions at once.
+
+        Returns:
+            (M, K) array of landmark indices, where K is the largest number of candidates any position
+            had. Rows with fewer candidates are padded with -1."""
+        nearby = [self.query(position) for position in positions]
+        most_candidates = max((len(landmarks) for landmarks in nearby), default=0)
+
+        candidate_array = np.full((len(nearby), most_candidates), -1, dtype=np.intp)
+        for row, landmarks in enumerate(nearby):
+            candidate_array[row, :len(landmarks)] = landmarks
+
+        return candidate_array
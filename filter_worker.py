@@ -0,0 +1,211 @@
+"""
+#Filter Worker:
+Runs the particle filter on its own thread, so the viewer and the filter can't slow each other down.
+
+The worker calls a step function (predict, update, resample...) in a loop, and after every step it publishes a
+Snapshot: read-only copies of poses, landmarks and covariance. The GUI picks up the newest snapshot whenever it
+wants to draw, and any snapshots it was too slow to see are just skipped.
+
+The snapshots live in a SnapshotBuffer, which copies into preallocated slots instead of making new arrays every
+step. There are three slots rather than two: one the GUI is reading, one holding the newest snapshot, and one
+the worker is writing into. That way the worker always has somewhere to write and never waits for a redraw,
+and the GUI never sees a snapshot change under it.
+
+Most of the heavy numpy work releases the GIL, so a thread is enough to keep the two apart.
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import numpy as np
+
+from particles import Particles
+
+NUMBER_OF_SLOTS = 3
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """A read-only copy of the arrays in a Particles object at one point in time.
+
+    It has the same attribute names as Particles, so the viewer's batched clouds can draw it directly."""
+    version: int
+    poses: np.ndarray
+    importance_factors: np.ndarray
+    landmarks: np.ndarray
+    landmark_likelihood: np.ndarray
+    covariance: np.ndarray
+
+    @property
+    def number_of_particles(self) -> int:
+        return len(self.poses)
+
+    @property
+    def observed_landmarks(self) -> int:
+        return self.landmarks.shape[1]
+
+    @property
+    def observed_covariances(self) -> int:
+        return self.covariance.shape[1]
+
+
+class _SnapshotSlot:
+    """Preallocated storage for one snapshot. The landmark arrays grow when the map outgrows them."""
+    def __init__(self, number_of_particles: int):
+        self.poses = np.empty((number_of_particles, 3))
+        self.importance_factors = np.empty(number_of_particles)
+        self.landmarks = np.empty((number_of_particles, 0, 2))
+        self.landmark_likelihood = np.empty((number_of_particles, 0))
+        self.covariance = np.empty((number_of_particles, 0, 2, 2))
+
+    def _reserve(self, name: str, required: int, dtype) -> np.ndarray:
+        array = getattr(self, name)
+        if array.shape[1] < required or array.dtype != dtype:
+            capacity = max(required, 2 * array.shape[1])
+            array = np.empty(array.shape[:1] + (capacity,) + array.shape[2:], dtype)
+            setattr(self, name, array)
+        return array
+
+    def fill(self, particles: Particles) -> Snapshot:
+        """Copies particles into this slot and returns read-only views of the copy."""
+        landmarks, likelihood, covariance = (
+            particles.landmarks, particles.landmark_likelihood, particles.covariance
+        )
+        observed_landmarks = landmarks.shape[1]
+        observed_covariances = covariance.shape[1]
+
+        number_of_particles = len(particles.poses)
+        views = (
+            self.poses[:number_of_particles],
+            self.importance_factors[:number_of_particles],
+            self._reserve("landmarks", observed_landmarks, landmarks.dtype)[:number_of_particles, :observed_landmarks],
+            self._reserve("landmark_likelihood", observed_landmarks, likelihood.dtype)[
+                :number_of_particles, :observed_landmarks
+            ],
+            self._reserve("covariance", observed_covariances, covariance.dtype)[
+                :number_of_particles, :observed_covariances
+            ],
+        )
+        sources = (particles.poses, particles.importance_factors, landmarks, likelihood, covariance)
+        for view, source in zip(views, sources):
+            np.copyto(view, source)
+
+        # Read-only views, so nothing on the GUI side can change a snapshot by accident.
+        read_only = []
+        for view in views:
+            view = view.view()
+            view.flags.writeable = False
+            read_only.append(view)
+
+        return Snapshot(particles.version, *read_only)
+
+
+class SnapshotBuffer:
+    """Passes snapshots from the filter thread to the GUI thread without either of them waiting on the other.
+
+    The worker calls publish, the GUI calls latest. The lock is only held while slot numbers are swapped,
+    never while copying."""
+    def __init__(self, number_of_particles: int):
+        self._slots = [_SnapshotSlot(number_of_particles) for _ in range(NUMBER_OF_SLOTS)]
+        self._snapshots = [None] * NUMBER_OF_SLOTS
+        self._newest = None
+        self._reading = None
+        self._lock = threading.Lock()
+
+    def publish(self, particles: Particles) -> None:
+        """Copies the current state of particles into a free slot and makes it the newest snapshot."""
+        with self._lock:
+            slot = next(
+                index for index in range(NUMBER_OF_SLOTS) if index not in (self._newest, self._reading)
+            )
+
+        snapshot = self._slots[slot].fill(particles)
+
+        with self._lock:
+            self._snapshots[slot] = snapshot
+            self._newest = slot
+
+    def latest(self) -> Optional[Snapshot]:
+        """Returns the newest snapshot, or None if there hasn't been a new one since the last call.
+
+        The snapshot returned stays valid until the next call to latest."""
+        with self._lock:
+            if self._newest is None or self._newest == self._reading:
+                return None
+            self._reading = self._newest
+            return self._snapshots[self._reading]
+
+
+class SnapshotReader:
+    """Holds the snapshot the GUI is currently drawing. Pass this to the clouds instead of a Particles object.
+
+    Every attribute (poses, landmarks, covariance, version...) is read from the current snapshot. Call refresh
+    once per frame to move on to the newest one."""
+    def __init__(self, buffer: SnapshotBuffer, particles: Particles):
+        self.buffer = buffer
+
+        # Start from a copy of the current state, so there's always something to draw.
+        buffer.publish(particles)
+        self.snapshot = buffer.latest()
+
+    def refresh(self) -> bool:
+        """Moves to the newest snapshot. Returns False if there wasn't a new one, so there is nothing to redraw."""
+        snapshot = self.buffer.latest()
+        if snapshot is None:
+            return False
+
+        self.snapshot = snapshot
+        return True
+
+    def __getattr__(self, name):
+        return getattr(self.snapshot, name)
+
+
+class FilterWorker(threading.Thread):
+    """Runs step(particles) over and over on its own thread, publishing a snapshot after each step.
+
+    Args:
+        particles: the particle filter. Only the worker should touch it once start() has been called.
+        step: the function that runs one filter step, e.g. a predict and a measurement update.
+        step_interval: Optional. The time between the start of each step in seconds. If a step takes longer
+            than this, the next one starts straight away. If None, steps run back to back.
+
+    Attributes:
+    snapshots: the SnapshotBuffer the worker publishes to.
+    reader: a SnapshotReader the GUI can hand to its clouds."""
+    def __init__(
+        self,
+        particles: Particles,
+        step: Callable[[Particles], None],
+        step_interval: Optional[float] = None
+    ):
+        super().__init__(daemon=True)
+        self.particles = particles
+        self.step = step
+        self.step_interval = step_interval
+
+        # Sized for the most particles there can be, so an AdaptiveParticles can change size between snapshots.
+        self.snapshots = SnapshotBuffer(getattr(particles, "particle_capacity", particles.number_of_particles))
+        self.reader = SnapshotReader(self.snapshots, particles)
+        self.steps_run = 0
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            step_start = time.perf_counter()
+
+            self.step(self.particles)
+            self.snapshots.publish(self.particles)
+            self.steps_run += 1
+
+            if self.step_interval is not None:
+                remaining = self.step_interval - (time.perf_counter() - step_start)
+                if remaining > 0:
+                    self._stop_event.wait(remaining)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Asks the worker to finish its current step and stop, then waits for it."""
+        self._stop_event.set()
+        self.join(timeout)
@@ -0,0 +1,220 @@
+"""
+#Instrumentation:
+Opt-in timing of each stage of the filter and the viewer, so when a frame blows its budget you can see which
+stage did it without sprinkling prints everywhere.
+
+Make an Instrumentation and hand it to Particles.enable_instrumentation and/or
+ParticleView.enable_instrumentation. Every call to an instrumented method then adds a record (stage, start
+time, duration and, optionally, bytes allocated) to a fixed size ring buffer. Ask for stats(stage) or
+summary() at any time for rolling p50/p99 over the records still in the buffer.
+
+How it stays cheap:
+- Enabling wraps the chosen methods on that one object (as instance attributes), and disabling deletes the
+  wrappers again. When it's off, nothing is wrapped, so the cost is exactly zero.
+- When it's on, each record is one perf_counter pair and a write into a preallocated numpy array. The
+  buffer never grows, it just overwrites the oldest records.
+- tracemalloc is only used if you ask for trace_allocations, as it slows all of Python down while it's on.
+
+If you want to keep every record, pass an exporter: it is called with a copy of the buffer each time it fills
+up, before anything is overwritten (and when you call flush).
+
+Only calls that go through a wrapper are timed. Particles calls get_landmark_covs and stretched_noise_terms
+through its own methods (_landmark_covariances and _stretched_noise_terms), so they show up as the
+covariance_transform stage. To time some other free function, call the function instrumentation.wrap returns,
+not the module's original.
+"""
+
+import threading
+import time
+import tracemalloc
+import weakref
+from functools import wraps
+from typing import Callable, Optional
+
+import numpy as np
+
+DEFAULT_CAPACITY = 4096
+
+RECORD_DTYPE = np.dtype([
+    ("stage", np.int32),
+    ("start", np.float64),
+    ("duration", np.float64),  # seconds
+    ("allocated", np.int64),  # bytes, or 0 if trace_allocations is off
+])
+
+# Rule 3: Use dictionaries for more complex lookups.
+# Particles method -> stage name. add_landmark and add_covariance call the batched methods, so they're covered.
+# covariance_transform runs inside associate and measurement_update, so its time is counted in those too.
+PARTICLE_STAGES = {
+    "predict": "predict",
+    "predict_sequence": "predict",
+    "add_landmarks": "landmark_insert",
+    "add_covariances": "covariance_insert",
+    "_landmark_covariances": "covariance_transform",
+    "_stretched_noise_terms": "covariance_transform",
+    "associate": "associate",
+    "measurement_update": "measurement_update",
+    "resample": "resample",
+}
+
+
+class Instrumentation:
+    """A ring buffer of stage timings, and the wrappers that fill it.
+
+    Args:
+        capacity: Optional. How many records the ring buffer holds.
+        trace_allocations: Optional. Also record how many bytes each stage left allocated (via tracemalloc).
+        exporter: Optional. Called with (records, stage_names) every time the buffer fills up, where records is
+            a RECORD_DTYPE array (a copy, so you can keep it) and stage_names maps record["stage"] to a name.
+
+    Attributes:
+    stage_names: every stage seen so far, in the order they were first seen."""
+    def __init__(
+        self,
+        capacity: int = DEFAULT_CAPACITY,
+        trace_allocations: bool = False,
+        exporter: Optional[Callable[[np.ndarray, list], None]] = None
+    ):
+        self.capacity = capacity
+        self.trace_allocations = trace_allocations
+        self.exporter = exporter
+
+        self.stage_names = []
+        self._stage_codes = {}
+        self._records = np.zeros(capacity, RECORD_DTYPE)
+        self._stages = self._records["stage"]
+        self._starts = self._records["start"]
+        self._durations = self._records["duration"]
+        self._allocations = self._records["allocated"]
+        self._written = 0
+        self._exported = 0
+        self._lock = threading.Lock()
+
+        # Which methods we replaced on which objects, so disable can put them back. Weak keys, so instrumenting
+        # something doesn't keep it alive after everything else has let go of it.
+        self._wrapped = weakref.WeakKeyDictionary()
+
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage_code(self, stage: str) -> int:
+        code = self._stage_codes.get(stage)
+        if code is None:
+            with self._lock:
+                code = self._stage_codes.setdefault(stage, len(self.stage_names))
+                if code == len(self.stage_names):
+                    self.stage_names.append(stage)
+        return code
+
+    def record(self, code: int, start: float, duration: float, allocated: int = 0) -> None:
+        """Adds one record to the ring buffer. code comes from stage_code."""
+        with self._lock:
+            if self.exporter is not None and self._written - self._exported == self.capacity:
+                self._export()
+
+            slot = self._written % self.capacity
+            self._stages[slot] = code
+            self._starts[slot] = start
+            self._durations[slot] = duration
+            self._allocations[slot] = allocated
+            self._written += 1
+
+    def wrap(self, function: Callable, stage: str) -> Callable:
+        """Returns a version of function that records a stage every time it is called."""
+        code = self.stage_code(stage)
+        perf_counter = time.perf_counter
+
+        if self.trace_allocations:
+            get_traced_memory = tracemalloc.get_traced_memory
+
+            @wraps(function)
+            def timed(*args, **kwargs):
+                allocated_before = get_traced_memory()[0]
+                start = perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    duration = perf_counter() - start
+                    self.record(code, start, duration, get_traced_memory()[0] - allocated_before)
+        else:
+            @wraps(function)
+            def timed(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(code, start, perf_counter() - start)
+
+        return timed
+
+    def instrument(self, target, stages: dict) -> None:
+        """Wraps target's methods, where stages maps method name -> stage name. Undo it with uninstrument."""
+        wrapped = self._wrapped.setdefault(target, [])
+        for method_name, stage in stages.items():
+            if method_name in wrapped:
+                continue
+            setattr(target, method_name, self.wrap(getattr(target, method_name), stage))
+            wrapped.append(method_name)
+
+    def uninstrument(self, target) -> None:
+        """Removes every wrapper instrument put on target, so its methods are the plain class methods again."""
+        wrapped = self._wrapped.pop(target, [])
+        for method_name in wrapped:
+            delattr(target, method_name)
+
+    def records(self, stage: Optional[str] = None) -> np.ndarray:
+        """Returns a copy of the records still in the buffer, oldest first, optionally only for one stage."""
+        with self._lock:
+            count = min(self._written, self.capacity)
+            start = self._written % self.capacity if self._written > self.capacity else 0
+            records = np.roll(self._records[:count], -start)
+
+        if stage is not None:
+            code = self._stage_codes.get(stage)
+            records = records[records["stage"] == code]
+        return records
+
+    def stats(self, stage: str) -> dict:
+        """Rolling statistics for one stage, over the records still in the buffer. Times are in ms."""
+        records = self.records(stage)
+        if not len(records):
+            return {"count": 0}
+
+        durations = records["duration"] * 1000
+        p50, p99 = np.percentile(durations, (50, 99))
+        stats = {
+            "count": len(records),
+            "p50_ms": float(p50),
+            "p99_ms": float(p99),
+            "max_ms": float(durations.max()),
+            "mean_ms": float(durations.mean()),
+        }
+        if self.trace_allocations:
+            stats["mean_allocated_kib"] = float(records["allocated"].mean() / 1024)
+        return stats
+
+    def summary(self) -> dict:
+        """stats for every stage seen so far."""
+        return {stage: self.stats(stage) for stage in self.stage_names}
+
+    def _export(self) -> None:
+        """Sends everything written since the last export to the exporter. Call with the lock held."""
+        count = self._written - self._exported
+        if not count:
+            return
+
+        first = self._exported % self.capacity
+        order = (np.arange(count) + first) % self.capacity
+        self.exporter(self._records[order], list(self.stage_names))
+        self._exported = self._written
+
+    def flush(self) -> None:
+        """Exports any records the exporter hasn't seen yet."""
+        if self.exporter is None:
+            return
+        with self._lock:
+            self._export()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._written = self._exported = 0
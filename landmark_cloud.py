@@ -4,19 +4,18 @@ This file holds the logic for our ellipse drawer and mean position drawer
 MEAN PARTICLE DRAWER:
 This is a class that draws the mean position of a landmark. This simply tells us the point that the landmark is most likely to be. You can use
 
-ELLIPSE DRAWER: NOT IMPLEMENTED!
-his draws an "uncertanty ellipse". This is an area we can be 95% certian that a landmark would be in, given a gaussian probability distribution, and our prior guess about the robots current position being in the right place.
-
-This class is only concerned with drawing these ellipses, not calculating or storing them. Please go to particles.py for the storage implementation, and read robablisitic Robotics (Thrun et al.) for fastSLAM implementation details.
-
-
-Most of this is vibe coded right now: use with caution!
-
-TODO:
-Full analysis of Claudes first draft -- Need to remove Chi Squared calculation within this class so we dont do it thousands of times per update loop! Insstead do it in clouds object.
-Will come back to it when I have more time, wanted to check the mutability of objects and functions in particle_viewer.
-
-Chi-Squared calculator allowing for more distinct values for p.
+LANDMARK LAYER:
+One graphics item that draws every observed landmark, for every particle (or just the mean of each landmark), in a single paint call.
+It reads particles.landmarks when it is painted, so new landmarks show up on their own. Use this rather than one LandmarkMeanDot cloud per landmark.
+Like the pose cloud, it is culled and thinned out to what the screen can show, and when the particles' dots would all pile up
+(zoomed out, or lots of particles) it only draws the mean of each landmark. The ellipse layer does the same with the mixture ellipses.
+
+ELLIPSE LAYER:
+This draws an "uncertanty ellipse" for every landmark. This is an area we can be 95% certian that a landmark would be in, given a gaussian probability distribution, and our prior guess about the robots current position being in the right place.
+
+This class is only concerned with drawing these ellipses, not calculating or storing them. The axes and angles come from uncertainty_ellipses in particles.py,
+which does every covariance at once, and the chi-squared value comes from chi_squared_value in data_association.py, so you can pick any confidence level.
+Read Probablisitic Robotics (Thrun et al.) for fastSLAM implementation details.
 """
 
 from PyQt5.QtWidgets import QGraphicsItem, QGraphicsEllipseItem
@@ -24,17 +23,20 @@ from PyQt5.QtGui import QBrush, QPen, QColor
 from PyQt5.QtCore import Qt
 import numpy as np
 from dataclasses import dataclass
-from particles import Particle
+from particles import Particle, Particles
+from particle_cloud import ArrayCloudItem
+from particles import uncertainty_ellipses
+from data_association import DEFAULT_CONFIDENCE_THRESHOLD, DEFAULT_CHI_SQUARED_VALUE
 
 # Define constants.
-DEFAULT_CONFIDENCE_THRESHOLD = 0.95
-DEFAULT_CHI_SQUARED_VALUE = 5.991  # Two sigma.
 DEFAULT_LM_MEAN = np.array((0, 0))
 DEFAULT_LM_COVARIANCE = np.eye(2, 2) * 50
 DEFAULT_LM_AXES_SIZE = np.array((1, 1))
 DEFAULT_LM_ANGLE = 0
 
 DEFAULT_LM_DOT_SIZE = 5.0  # This wont change on zoom-in, so might need to increase!
+DEFAULT_ELLIPSE_SEGMENTS = 24  # Straight lines per ellipse.
+DEFAULT_ELLIPSE_LINE_WIDTH = 1.0  # pixels.
 
 
 # Handle default brushes externally (Think this will be a speed up? but might cause lifetime headaches.)
@@ -73,3 +75,169 @@ def update_landmark_mean_dot(particle: Particle, landmark_mean_dot: LandmarkMean
     index = landmark_mean_dot.index
     position = particle.landmarks[index, :]
     landmark_mean_dot.setPos(position[0], -position[1])
+
+
+class LandmarkLayerItem(ArrayCloudItem):
+    """Draws every observed landmark as a dot, straight from particles.landmarks[:, :observed_landmarks].
+
+    Args:
+        particles_data: the particles whose map we are drawing.
+        means_only: if True, draw one dot per landmark at its mean across the particles, instead of N dots.
+        color: QColor for the dots.
+        size: dot diameter in pixels.
+
+    The dots are drawn with a cosmetic pen, so Qt keeps them the same size on screen when you zoom.
+    Its summary is the means_only drawing."""
+    def __init__(
+        self,
+        particles_data: Particles,
+        means_only: bool = False,
+        color=None,
+        size: float = DEFAULT_LM_DOT_SIZE
+    ):
+        super().__init__(
+            particles_data, DefaultMeanColors.fill if color is None else color, size
+        )
+        self.means_only = means_only
+
+        self._pen = QPen(self.color)
+        self._pen.setWidthF(size)
+        self._pen.setCapStyle(Qt.PenCapStyle.RoundCap)
+        self._pen.setCosmetic(True)
+
+    def anchors(self, means_only=None):
+        if means_only is None:
+            means_only = self.means_only
+
+        landmarks = self.data.landmarks
+        if means_only:
+            landmarks = landmarks.mean(axis=0)
+
+        landmarks = landmarks.reshape(-1, 2)
+        return np.stack((landmarks[:, 0], -landmarks[:, 1]), axis=1)
+
+    def draw_markers(self, painter, anchors, visible):
+        polygon, points = self.polygon(len(visible))
+        points[:] = anchors[visible]
+
+        painter.setPen(self._pen)
+        painter.drawPoints(polygon)
+
+    def draw_summary(self, painter, exposed):
+        if self.means_only:
+            return False
+
+        anchors = self.anchors(means_only=True)
+        visible = self.visible_markers(anchors, exposed)
+        if len(visible):
+            self.draw_markers(painter, anchors, visible)
+        return True
+
+
+class EllipseLayerItem(ArrayCloudItem):
+    """Draws the uncertainty ellipse of every observed landmark, in one drawLines call.
+
+    Args:
+        particles_data: the particles whose map we are drawing.
+        means_only: if True (the default), draw one ellipse per landmark. It covers both the covariance each
+            particle has for the landmark and how spread out the particles' estimates are, which is the
+            covariance of the whole mixture: mean(Σ) + cov(μ). If False, draw every particle's own ellipse.
+        confidence: how much probability each ellipse should hold, e.g. 0.95.
+        color: QColor for the outlines.
+        segments: how many straight lines to draw each ellipse with.
+
+    Its summary is the means_only drawing."""
+    def __init__(
+        self,
+        particles_data: Particles,
+        means_only: bool = True,
+        confidence: float = DEFAULT_CONFIDENCE_THRESHOLD,
+        color=None,
+        segments: int = DEFAULT_ELLIPSE_SEGMENTS
+    ):
+        super().__init__(
+            particles_data,
+            DefaultMeanColors.outline if color is None else color,
+            DEFAULT_ELLIPSE_LINE_WIDTH,
+        )
+        self.means_only = means_only
+        self.confidence = confidence
+        self._axes = np.empty((0, 2))
+        self._angles = np.empty(0)
+
+        # One lap of the unit circle, shared by every ellipse.
+        circle_angles = np.linspace(0, 2 * np.pi, segments + 1)
+        self._circle = np.stack((np.cos(circle_angles), np.sin(circle_angles)), axis=1)
+
+        self._pen = QPen(self.color)
+        self._pen.setWidthF(self.size)
+        self._pen.setCosmetic(True)
+
+    def centres_and_covariances(self, means_only=None) -> tuple:
+        """Returns the (E, 2) centres and (E, 2, 2) covariances of the ellipses we are going to draw.
+
+        means_only overrides the attribute of the same name."""
+        if means_only is None:
+            means_only = self.means_only
+
+        covariance = self.data.covariance
+        landmarks = self.data.landmarks[:, :covariance.shape[1]]
+
+        if not means_only:
+            return landmarks.reshape(-1, 2), covariance.reshape(-1, 2, 2)
+
+        means = landmarks.mean(axis=0)
+        spread = landmarks - means
+        mixture = covariance.mean(axis=0)
+        mixture += np.einsum("nli,nlj->lij", spread, spread) / len(landmarks)
+
+        return means, mixture
+
+    def anchors(self):
+        centres, covariances = self.centres_and_covariances()
+        self._axes, self._angles = uncertainty_ellipses(covariances, self.confidence)
+
+        return np.stack((centres[:, 0], -centres[:, 1]), axis=1)
+
+    def reach(self):
+        return self._axes[:, 0].max(initial=0.)
+
+    def draw_markers(self, painter, anchors, visible):
+        self.draw_ellipses(painter, anchors[visible], self._axes[visible], self._angles[visible])
+
+    def draw_summary(self, painter, exposed):
+        if self.means_only:
+            return False
+
+        centres, covariances = self.centres_and_covariances(means_only=True)
+        axes, angles = uncertainty_ellipses(covariances, self.confidence)
+        anchors = np.stack((centres[:, 0], -centres[:, 1]), axis=1)
+
+        visible = self.visible_markers(anchors, exposed)
+        if len(visible):
+            self.draw_ellipses(painter, anchors[visible], axes[visible], angles[visible])
+        return True
+
+    def draw_ellipses(self, painter, anchors: np.ndarray, axes: np.ndarray, angles: np.ndarray) -> None:
+        """Draws an ellipse at each (K, 2) scene point, with (K, 2) major and minor axes and (K,) angles."""
+        centre_x, centre_y = anchors[:, 0, None], anchors[:, 1, None]
+
+        # Every point of every outline: centre + major cos(t) u + minor sin(t) v, with u and v the ellipse axes.
+        # Everything is in scene coordinates, so the angles go clockwise.
+        along_major = axes[:, 0, None] * self._circle[:, 0]
+        along_minor = axes[:, 1, None] * self._circle[:, 1]
+        cos_angle, sin_angle = np.cos(angles)[:, None], np.sin(angles)[:, None]
+        x = centre_x + along_major * cos_angle - along_minor * sin_angle
+        y = centre_y - along_major * sin_angle - along_minor * cos_angle
+
+        # drawLines takes pairs of points, so every segment is written as (start, end).
+        number_of_ellipses, number_of_segments = x.shape[0], x.shape[1] - 1
+        polygon, points = self.polygon(2 * number_of_ellipses * number_of_segments)
+        pairs = points.reshape(number_of_ellipses, number_of_segments, 2, 2)
+        pairs[:, :, 0, 0] = x[:, :-1]
+        pairs[:, :, 1, 0] = x[:, 1:]
+        pairs[:, :, 0, 1] = y[:, :-1]
+        pairs[:, :, 1, 1] = y[:, 1:]
+
+        painter.setPen(self._pen)
+        painter.drawLines(polygon)
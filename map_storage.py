@@ -0,0 +1,123 @@
+"""
+#Map Storage:
+How the landmark arrays behind Particles are laid out in memory.
+
+There are two layouts:
+- Full (the default): landmarks are (N, L, 2), Tau is (N, L) and covariance is (N, L, 2, 2).
+- Packed: every 2x2 covariance is symmetric, so only xx, xy and yy are stored, as a (3, L, N) block.
+  Landmarks are stored the same way, as a (2, L, N) block of x and y. Each component is its own (L, N)
+  plane (structure of arrays), with the particles last, so one landmark's values across every particle
+  (what the measurement update works on) are one contiguous run per component. Resampling only gathers
+  the observed rows of each plane, which are contiguous too.
+
+Either way, the public landmarks and covariance attributes on Particles are views with the usual
+(N, L, 2) and (N, L, 2, 2) shapes. For the packed layout they are strided views: covariance[..., 0, 1]
+and covariance[..., 1, 0] are the same memory, so the view always looks like a full symmetric matrix,
+and writing a symmetric matrix to it works as normal. Nothing is copied.
+
+With float32 and the packed layout, a map takes 24 bytes per landmark per particle instead of 28, and
+with dtype=float64 the full layout takes 56. See Particles(dtype=..., packed_covariance=...).
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+LANDMARK_SIZE = 2
+PACKED_COVARIANCE_SIZE = 3  # xx, xy, yy
+
+
+def storage_shapes(number_of_particles: int, capacity: int, packed: bool) -> tuple:
+    """Returns the shapes of the landmark, Tau and covariance storage arrays."""
+    if packed:
+        return (
+            (LANDMARK_SIZE, capacity, number_of_particles),
+            (number_of_particles, capacity),
+            (PACKED_COVARIANCE_SIZE, capacity, number_of_particles),
+        )
+
+    return (
+        (number_of_particles, capacity, LANDMARK_SIZE),
+        (number_of_particles, capacity),
+        (number_of_particles, capacity, 2, 2),
+    )
+
+
+def particle_axes(packed: bool) -> tuple:
+    """Returns the particle axis of the landmark, Tau and covariance storage arrays, for gathers."""
+    return (2, 0, 2) if packed else (0, 0, 0)
+
+
+def slot_axes(packed: bool) -> tuple:
+    """Returns the landmark slot axis of the landmark, Tau and covariance storage arrays. It's the same for
+    both layouts, only the particle axis moves."""
+    return (1, 1, 1)
+
+
+def particle_rows(storage: np.ndarray, axis: int, count: int) -> np.ndarray:
+    """Returns the first count particles of a storage array, along its particle axis (see particle_axes).
+
+    Storage can have room for more particles than are in use (see AdaptiveParticles). If it's all in use,
+    the array itself is returned, so gathers into it stay contiguous."""
+    if storage.shape[axis] == count:
+        return storage
+
+    return storage[(slice(None),) * axis + (slice(count),)]
+
+
+def gather_particles(
+    storage: np.ndarray, indices: np.ndarray, out: np.ndarray, particle_axis: int, slot_axis: int, observed: int
+) -> None:
+    """Copies particle indices[i] of storage into particle i of out, for the first observed landmark slots.
+
+    out must already be cut down to len(indices) particles (see particle_rows). Slots past observed hold nothing
+    we need, and the arrays usually have room for a lot more landmarks than we've seen, so where we can we skip
+    them (whatever ends up in them is junk, like after np.empty):
+    - If the slots come before the particles, the used slots of each plane are one contiguous block,
+      so each block is taken on its own.
+    - Otherwise each particle's used slots are a short run with a gap after it. np.take copies a strided
+      input before gathering it, which is slower than taking everything once most of the slots are in use,
+      so only a mostly empty array is gathered with fancy indexing."""
+    capacity = storage.shape[slot_axis]
+    if slot_axis < particle_axis:
+        for plane in np.ndindex(storage.shape[:slot_axis]):
+            np.take(
+                storage[plane][:observed], indices, axis=particle_axis - slot_axis,
+                out=out[plane][:observed], mode="clip"
+            )
+    elif 2 * observed > capacity:
+        np.take(storage, indices, axis=particle_axis, out=out, mode="clip")
+    else:
+        used = [slice(None)] * storage.ndim
+        used[slot_axis] = slice(observed)
+        gathered = list(used)
+        gathered[particle_axis] = indices
+        out[tuple(used)] = storage[tuple(gathered)]
+
+
+def landmark_view(storage: np.ndarray, count: int, packed: bool) -> np.ndarray:
+    """Returns an (N, count, 2) view of the first count landmarks in storage."""
+    if not packed:
+        return storage[:, :count]
+
+    planes = storage[:, :count]
+    return as_strided(
+        planes[0],
+        shape=(planes.shape[2], count, LANDMARK_SIZE),
+        strides=(planes.strides[2], planes.strides[1], planes.strides[0]),
+    )
+
+
+def covariance_view(storage: np.ndarray, count: int, packed: bool) -> np.ndarray:
+    """Returns an (N, count, 2, 2) view of the first count covariances in storage.
+
+    For the packed layout, entry [i, j] is plane i + j, so [0, 1] and [1, 0] both land on the xy plane."""
+    if not packed:
+        return storage[:, :count]
+
+    planes = storage[:, :count]
+    plane_stride = planes.strides[0]
+    return as_strided(
+        planes[0],
+        shape=(planes.shape[2], count, 2, 2),
+        strides=(planes.strides[2], planes.strides[1], plane_stride, plane_stride),
+    )
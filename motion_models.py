@@ -0,0 +1,438 @@
+"""
+#Motion Models:
+These are the functions we use to predict where each particle has moved to (STEP 2 in docs/slam_intro.md).
+
+Every model works on the whole (N, 3) pose array at once, and writes the new poses straight into it.
+The models only differ in how they turn a control input into a noisy (v, ω, γ) for each particle.
+After that they all share one integrator (integrate_arc), so there is only one piece of arc maths to get right.
+
+integrate_arc uses the exact circular arc, written in a form that doesn't blow up as ω → 0:
+
+    x += v Δt cos(θ + ωΔt/2) sinc(ωΔt/2)
+    y += v Δt sin(θ + ωΔt/2) sinc(ωΔt/2)
+    θ += ωΔt + γΔt
+
+where sinc(a) = sin(a)/a. This is the same as the (v/ω)(sin(θ + ωΔt) - sin(θ)) form in Probabilistic Robotics
+(Table 5.3), but when a particle drives in a straight line sinc(0) = 1 and we get x += vΔt cos(θ) for free.
+No more clamping ω to 1e-6!
+
+Every temporary lives in a MotionBuffers object, so once that has been allocated, predicting doesn't allocate anything.
+If numba is installed, arc_chords and move_along_chords are swapped for the compiled kernels in numba_kernels.py.
+
+#Sequences:
+Odometry and IMU data come in much faster than we run the filter. Instead of calling predict hundreds of times
+per frame, predict_sequence takes a (K, ...) array of controls and moves every particle through all K steps at once.
+Each step is a straight chord, at some offset from the heading the step starts at, followed by a turn.
+The heading at the start of each step is just the starting heading plus a cumulative sum of the turns before it,
+and the position is a cumulative sum of the chords, so the whole sequence is a handful of (K, N) operations.
+"""
+
+import numpy as np
+from dataclasses import dataclass
+from typing import Optional
+
+import numba_kernels
+
+# Below this half turn angle (ωΔt/2) we use the series expansion of sinc instead of dividing by a tiny number.
+SMALL_ANGLE = 1e-4
+
+
+@dataclass
+class MotionBuffers:
+    """Scratch space for the motion models.
+
+    Each step of every model is described by three (N,) arrays, filled in by MotionModel.chords:
+    chord: the straight line distance the particle moves.
+    offset: the angle between the heading at the start of the step and the chord.
+    turn: how much the heading changes over the whole step.
+
+    noise: (3, N) block of samples, drawn in one go. Each model uses the rows for its own noisy controls.
+    straight: (N,) mask of particles with a half turn angle below SMALL_ANGLE.
+
+    For sequences, every array has an extra leading axis for the K steps, so chord is (K, N) and noise is (3, K, N)."""
+    noise: np.ndarray
+    straight: np.ndarray
+    offset: np.ndarray
+    chord: np.ndarray
+    turn: np.ndarray
+    scratch: np.ndarray
+
+    @classmethod
+    def allocate(
+        cls, number_of_particles: int, number_of_steps: Optional[int] = None
+    ) -> "MotionBuffers":
+        shape = (number_of_particles,)
+        if number_of_steps is not None:
+            shape = (number_of_steps, number_of_particles)
+
+        return cls(
+            np.empty((3,) + shape),
+            np.empty(shape, dtype=bool),
+            *[np.empty(shape) for _ in range(4)],
+        )
+
+    @property
+    def is_sequence(self) -> bool:
+        return self.chord.ndim == 2
+
+    def shaped(self, number_of_particles: int, number_of_steps: Optional[int] = None) -> "MotionBuffers":
+        """Views of these buffers for number_of_particles particles (and number_of_steps steps). Nothing is copied.
+
+        Each view is taken from the start of the flat storage rather than sliced, because the random number
+        generator can only fill contiguous arrays. So the buffers need room for at least that many particles
+        and steps, e.g. the first K steps of a sequence buffer, or AdaptiveParticles using fewer particles
+        than it allocated."""
+        shape = (number_of_particles,)
+        if number_of_steps is not None:
+            shape = (number_of_steps, number_of_particles)
+        size = int(np.prod(shape))
+
+        def view(array: np.ndarray, leading: tuple = ()) -> np.ndarray:
+            return array.reshape(-1)[:size * int(np.prod(leading))].reshape(leading + shape)
+
+        return MotionBuffers(
+            view(self.noise, (3,)),
+            view(self.straight),
+            view(self.offset),
+            view(self.chord),
+            view(self.turn),
+            view(self.scratch),
+        )
+
+
+def _per_step(values, buffers: MotionBuffers):
+    """Reshapes per step values (like timesteps or controls) so they broadcast against the buffers.
+
+    Single steps are left alone, sequences of K values become (K, 1)."""
+    values = np.asarray(values, dtype=np.float64)
+    if buffers.is_sequence and values.ndim:
+        return values.reshape(-1, 1)
+    return values
+
+
+def wrap_angle(angle):
+    """Wraps angles to [-π, π]."""
+    return np.arctan2(np.sin(angle), np.cos(angle))
+
+
+def arc_chords(
+    v: np.ndarray,
+    w: np.ndarray,
+    gamma: Optional[np.ndarray],
+    timestep,
+    buffers: MotionBuffers
+) -> None:
+    """Fills buffers.chord, buffers.offset and buffers.turn for particles driving along circular arcs.
+
+    Args:
+        v, w: (N,) (or (K, N)) linear and angular velocity for each particle.
+        gamma: Optional extra rotation rate applied at the end (the γ term in Probabilistic Robotics).
+        timestep: how long to drive for, in seconds. (K, 1) for sequences.
+        buffers: scratch space to write into."""
+    offset, chord, turn, scratch = buffers.offset, buffers.chord, buffers.turn, buffers.scratch
+
+    # The chord points half way round the arc.
+    np.multiply(w, timestep / 2, out=offset)
+
+    # chord = sin(a)/a, or 1 - a²/6 when a is tiny. turn holds a safe divisor for now.
+    np.abs(offset, out=scratch)
+    np.less(scratch, SMALL_ANGLE, out=buffers.straight)
+    np.copyto(turn, offset)
+    np.copyto(turn, 1., where=buffers.straight)
+    np.sin(offset, out=chord)
+    chord /= turn
+
+    np.multiply(offset, offset, out=scratch)
+    scratch /= -6
+    scratch += 1
+    np.copyto(chord, scratch, where=buffers.straight)
+
+    # chord = v Δt sinc(ωΔt/2)
+    chord *= v
+    chord *= timestep
+
+    np.multiply(w, timestep, out=turn)
+    if gamma is not None:
+        np.multiply(gamma, timestep, out=scratch)
+        turn += scratch
+
+
+def move_along_chords(poses: np.ndarray, buffers: MotionBuffers) -> None:
+    """Moves every pose by one step described by buffers.chord, offset and turn, in place."""
+    x, y, theta = poses[:, 0], poses[:, 1], poses[:, 2]
+    offset, scratch = buffers.offset, buffers.scratch
+
+    offset += theta
+    np.cos(offset, out=scratch)
+    scratch *= buffers.chord
+    x += scratch
+    np.sin(offset, out=scratch)
+    scratch *= buffers.chord
+    y += scratch
+    theta += buffers.turn
+
+
+def move_along_chord_sequence(
+    poses: np.ndarray, buffers: MotionBuffers, trajectory: Optional[np.ndarray] = None
+) -> None:
+    """Moves every pose through K steps described by (K, N) chords, offsets and turns, in place.
+
+    If trajectory is given (a (K, N, 3) array), the pose after every step is written into it."""
+    x, y, theta = poses[:, 0], poses[:, 1], poses[:, 2]
+    offset, chord, turn, scratch = buffers.offset, buffers.chord, buffers.turn, buffers.scratch
+
+    # turn becomes the heading at the end of each step, offset the direction of each chord.
+    np.cumsum(turn, axis=0, out=turn)
+    offset += theta
+    offset[1:] += turn[:-1]
+    turn += theta
+
+    # scratch holds the x movement of each step, offset the y movement.
+    np.cos(offset, out=scratch)
+    scratch *= chord
+    np.sin(offset, out=offset)
+    offset *= chord
+
+    if trajectory is not None:
+        # Accumulate in place, then copy. Accumulating straight into the strided trajectory would allocate.
+        np.cumsum(scratch, axis=0, out=scratch)
+        scratch += x
+        np.cumsum(offset, axis=0, out=offset)
+        offset += y
+        trajectory[..., 0] = scratch
+        trajectory[..., 1] = offset
+        trajectory[..., 2] = turn
+        poses[:] = trajectory[-1]
+        return
+
+    # chord[0] isn't needed any more, so it holds the sums.
+    np.sum(scratch, axis=0, out=chord[0])
+    x += chord[0]
+    np.sum(offset, axis=0, out=chord[0])
+    y += chord[0]
+    theta[:] = turn[-1]
+
+
+def _arc_chords_numba(v, w, gamma, timestep, buffers: MotionBuffers) -> None:
+    """Same as arc_chords, using numba_kernels.arc_chords. The kernel works on (K, N) arrays, so single steps
+    get a leading axis of length one."""
+    chord, offset, turn = buffers.chord, buffers.offset, buffers.turn
+    if not buffers.is_sequence:
+        v, w, chord, offset, turn = v[None], w[None], chord[None], offset[None], turn[None]
+        if gamma is not None:
+            gamma = gamma[None]
+
+    timesteps = np.broadcast_to(np.ravel(timestep), chord.shape[:1])
+    use_gamma = gamma is not None
+    numba_kernels.arc_chords(
+        v, w, gamma if use_gamma else v, use_gamma, timesteps, SMALL_ANGLE, chord, offset, turn
+    )
+
+
+def _move_along_chords_numba(poses: np.ndarray, buffers: MotionBuffers) -> None:
+    """Same as move_along_chords, using numba_kernels.move_along_chords."""
+    numba_kernels.move_along_chords(poses, buffers.chord, buffers.offset, buffers.turn)
+
+
+# Picked once, here. Everything below calls these through the module globals, so they all get the kernels.
+if numba_kernels.USE_NUMBA:
+    arc_chords = _arc_chords_numba
+    move_along_chords = _move_along_chords_numba
+
+
+def integrate_arc(
+    poses: np.ndarray,
+    v: np.ndarray,
+    w: np.ndarray,
+    gamma: Optional[np.ndarray],
+    timestep: float,
+    buffers: MotionBuffers
+) -> None:
+    """Moves every pose along a circular arc, in place.
+
+    Args:
+        poses: (N, 3) array of [x, y, θ].
+        v, w: (N,) linear and angular velocity for each particle.
+        gamma: Optional (N,) extra rotation rate applied at the end (the γ term in Probabilistic Robotics).
+        timestep: how long to drive for, in seconds.
+        buffers: scratch space with room for N particles."""
+    arc_chords(v, w, gamma, timestep, buffers)
+    move_along_chords(poses, buffers)
+
+
+class MotionModel:
+    """The interface every motion model follows.
+
+    Subclasses normally only need to write sample_controls, which fills buffers.noise with a noisy (v, ω, γ)
+    for each particle. Models that don't drive along arcs (like odometry) can override chords instead."""
+    def sample_controls(
+        self, control: np.ndarray, rng: np.random.Generator, buffers: MotionBuffers
+    ) -> tuple:
+        raise NotImplementedError
+
+    def chords(
+        self, control: np.ndarray, timestep, rng: np.random.Generator, buffers: MotionBuffers
+    ) -> None:
+        """Fills buffers.chord, offset and turn with one noisy step (or K steps) for every particle."""
+        v, w, gamma = self.sample_controls(control, rng, buffers)
+        arc_chords(v, w, gamma, timestep, buffers)
+
+    def predict(
+        self,
+        poses: np.ndarray,
+        control: np.ndarray,
+        timestep: float,
+        rng: np.random.Generator,
+        buffers: MotionBuffers
+    ) -> None:
+        """Moves every pose in place according to control, with noise drawn from rng."""
+        self.chords(control, timestep, rng, buffers)
+        move_along_chords(poses, buffers)
+
+    def predict_sequence(
+        self,
+        poses: np.ndarray,
+        controls: np.ndarray,
+        timesteps,
+        rng: np.random.Generator,
+        buffers: MotionBuffers,
+        trajectory: Optional[np.ndarray] = None
+    ) -> None:
+        """Moves every pose through K controls at once.
+
+        Args:
+            controls: K controls stacked along the first axis, e.g. (K, 2) for the velocity model.
+            timesteps: (K,) time each control was applied for, or one float for all of them.
+            buffers: sequence buffers with exactly K steps (see MotionBuffers.shaped).
+            trajectory: Optional (K, N, 3) array. If given, the poses after every step are written into it."""
+        self.chords(controls, _per_step(timesteps, buffers), rng, buffers)
+        move_along_chord_sequence(poses, buffers, trajectory)
+
+
+def _sample_noisy_pair(
+    control: np.ndarray, alphas: np.ndarray, rng: np.random.Generator, buffers: MotionBuffers
+) -> tuple:
+    """Draws the three noisy rows used by the velocity and bicycle models (Table 5.3 in Probabilistic Robotics).
+
+    Row 0 is control[0] + noise, row 1 is control[1] + noise and row 2 is zero mean noise (γ).
+    control can also be (K, 2), in which case every row is (K, N)."""
+    control = np.asarray(control, dtype=np.float64)
+    first, second = _per_step(control[..., 0], buffers), _per_step(control[..., 1], buffers)
+
+    first_noise = np.sqrt(alphas[0]*first**2 + alphas[1]*second**2)
+    second_noise = np.sqrt(alphas[2]*first**2 + alphas[3]*second**2)
+    gamma_noise = np.sqrt(alphas[4]*first**2 + alphas[5]*second**2)
+
+    rng.standard_normal(out=buffers.noise)
+    noisy_first, noisy_second, gamma = buffers.noise
+    noisy_first *= first_noise
+    noisy_first += first
+    noisy_second *= second_noise
+    noisy_second += second
+    gamma *= gamma_noise
+
+    return noisy_first, noisy_second, gamma
+
+
+class VelocityMotionModel(MotionModel):
+    """The velocity motion model. The control is (v, ω).
+
+    Args:
+        alphas: the six noise parameters from Probabilistic Robotics (Table 5.3)."""
+    def __init__(self, alphas: np.ndarray):
+        self.alphas = np.asarray(alphas, dtype=np.float64)
+
+    def sample_controls(self, control, rng, buffers):
+        return _sample_noisy_pair(control, self.alphas, rng, buffers)
+
+
+class BicycleMotionModel(MotionModel):
+    """Kinematic bicycle (Ackermann) model. The control is (v, δ): speed and front wheel steering angle.
+
+    The pose is the middle of the rear axle. With a constant speed and steering angle, that point drives
+    round a circle with ω = v tan(δ) / wheelbase, so the arc integration is exact. Because the pose is on
+    the centre line, the track width doesn't change where it goes.
+
+    Args:
+        wheelbase: distance between the front and rear axles in meters.
+        alphas: six noise parameters, used like the velocity model but on (v, δ) instead of (v, ω)."""
+    def __init__(self, wheelbase: float, alphas: np.ndarray):
+        self.wheelbase = wheelbase
+        self.alphas = np.asarray(alphas, dtype=np.float64)
+
+    def sample_controls(self, control, rng, buffers):
+        v, steering, gamma = _sample_noisy_pair(control, self.alphas, rng, buffers)
+
+        # Turn each particle's steering angle into ω, in place.
+        np.tan(steering, out=steering)
+        steering *= v
+        steering /= self.wheelbase
+
+        return v, steering, gamma
+
+
+class OdometryMotionModel(MotionModel):
+    """The odometry motion model (Table 5.6 in Probabilistic Robotics).
+
+    The control is a (2, 3) array holding the previous and current odometry poses. The change between them is
+    split into a rotation, a straight line and a second rotation, and each part gets its own noise.
+    The timestep is ignored, odometry already tells us how far we went.
+
+    Args:
+        alphas: the four noise parameters from Table 5.6."""
+    def __init__(self, alphas: np.ndarray):
+        self.alphas = np.asarray(alphas, dtype=np.float64)
+
+    def sample_controls(self, control, rng, buffers):
+        """control is (2, 3) for one step, or (K + 1, 3) odometry poses for a sequence of K steps."""
+        control = np.asarray(control, dtype=np.float64)
+        previous, current = control[:-1], control[1:]
+        if not buffers.is_sequence:
+            previous, current = previous[0], current[0]
+        alphas = self.alphas
+
+        dx = _per_step(current[..., 0] - previous[..., 0], buffers)
+        dy = _per_step(current[..., 1] - previous[..., 1], buffers)
+        translation = np.hypot(dx, dy)
+        # arctan2(0, 0) is 0, so standing still doesn't need a special case.
+        # Both rotations are wrapped, otherwise a heading near ±π turns a small turn into nearly 2π
+        # and the noise (which grows with the rotation) blows up.
+        first_rotation = wrap_angle(np.arctan2(dy, dx) - _per_step(previous[..., 2], buffers))
+        second_rotation = wrap_angle(_per_step(current[..., 2] - previous[..., 2], buffers) - first_rotation)
+
+        first_rotation_noise = np.sqrt(alphas[0]*first_rotation**2 + alphas[1]*translation**2)
+        translation_noise = np.sqrt(
+            alphas[2]*translation**2 + alphas[3]*(first_rotation**2 + second_rotation**2)
+        )
+        second_rotation_noise = np.sqrt(alphas[0]*second_rotation**2 + alphas[1]*translation**2)
+
+        rng.standard_normal(out=buffers.noise)
+        noisy_first, noisy_translation, noisy_second = buffers.noise
+        noisy_first *= first_rotation_noise
+        noisy_first += first_rotation
+        noisy_translation *= translation_noise
+        noisy_translation += translation
+        noisy_second *= second_rotation_noise
+        noisy_second += second_rotation
+
+        return noisy_first, noisy_translation, noisy_second
+
+    def chords(self, control, timestep, rng, buffers):
+        # Rotate, drive straight, rotate again.
+        first_rotation, translation, second_rotation = self.sample_controls(control, rng, buffers)
+        np.copyto(buffers.chord, translation)
+        np.copyto(buffers.offset, first_rotation)
+        np.add(first_rotation, second_rotation, out=buffers.turn)
+
+
+# Rule 3: Use dictionaries for more complex lookups. Add your own models here.
+MOTION_MODELS = {
+    "velocity": VelocityMotionModel,
+    "bicycle": BicycleMotionModel,
+    "odometry": OdometryMotionModel,
+}
+
+
+def create_motion_model(name: str, *args, **kwargs) -> MotionModel:
+    """Creates a motion model by name, e.g. create_motion_model("bicycle", 1.53, alphas)."""
+    return MOTION_MODELS[name](*args, **kwargs)
@@ -0,0 +1,143 @@
+"""
+#Numba Kernels:
+Optional compiled versions of the per-particle hot loops. If numba is installed, these are used instead of the
+numpy code in particles.py and motion_models.py. If it isn't, everything still works, just on the numpy path.
+
+The numpy versions have to go through the whole (N,) array once per operation, and keep every intermediate
+in a buffer. These kernels do all the maths for one particle at a time, in registers, and spread the particles
+across every core with prange. That's where the speed up comes from once you get past ~10k particles.
+
+The choice is made once, when this module is imported. Set the CLOUDS_DISABLE_NUMBA environment variable
+to force the numpy path (handy for checking the two give the same answer).
+
+Every kernel only takes plain arrays and floats, so they can be called without any of the classes.
+The first call to each kernel compiles it, which takes a second or two. cache=True saves the result
+in __pycache__ so that only happens once per machine.
+"""
+
+import os
+from importlib.util import find_spec
+
+import numpy as np
+
+# find_spec checks numba is installed without importing it. Importing numba takes a few hundred ms,
+# so when it's disabled we skip the import completely.
+NUMBA_AVAILABLE = find_spec("numba") is not None
+USE_NUMBA = NUMBA_AVAILABLE and not os.environ.get("CLOUDS_DISABLE_NUMBA")
+
+if USE_NUMBA:
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def arc_chords(v, w, gamma, use_gamma, timesteps, small_angle, chord, offset, turn):
+        """Kernel version of motion_models.arc_chords. Every array is (K, N), timesteps is (K,).
+
+        gamma is ignored unless use_gamma is True (numba needs an array either way)."""
+        number_of_steps, number_of_particles = chord.shape
+        for i in prange(number_of_particles):
+            for k in range(number_of_steps):
+                timestep = timesteps[k]
+                half_angle = w[k, i] * timestep / 2
+
+                if abs(half_angle) < small_angle:
+                    sinc = 1. - half_angle * half_angle / 6
+                else:
+                    sinc = np.sin(half_angle) / half_angle
+
+                chord[k, i] = v[k, i] * timestep * sinc
+                offset[k, i] = half_angle
+                turn[k, i] = w[k, i] * timestep
+                if use_gamma:
+                    turn[k, i] += gamma[k, i] * timestep
+
+    @njit(parallel=True, cache=True)
+    def move_along_chords(poses, chord, offset, turn):
+        """Kernel version of motion_models.move_along_chords. poses is (N, 3), everything else is (N,)."""
+        for i in prange(poses.shape[0]):
+            direction = poses[i, 2] + offset[i]
+            poses[i, 0] += chord[i] * np.cos(direction)
+            poses[i, 1] += chord[i] * np.sin(direction)
+            poses[i, 2] += turn[i]
+
+    @njit(parallel=True, cache=True)
+    def ekf_update(
+        poses, r, bearing, half_sum, half_diff, off_diagonal, mean, sigma, importance_factors
+    ):
+        """Kernel version of the EKF correction in Particles.measurement_update.
+
+        half_sum, half_diff and off_diagonal describe the sensor noise stretched by the range, exactly like the
+        numpy version. mean (N, 2), sigma (N, 2, 2) and importance_factors (N,) are updated in place."""
+        for i in prange(poses.shape[0]):
+            phi = poses[i, 2] + bearing
+            dx = poses[i, 0] + r * np.cos(phi) - mean[i, 0]
+            dy = poses[i, 1] + r * np.sin(phi) - mean[i, 1]
+
+            # S = Σ + R_xy
+            rotated = np.cos(2 * phi) * half_diff - np.sin(2 * phi) * off_diagonal
+            sig00, sig01, sig11 = sigma[i, 0, 0], sigma[i, 0, 1], sigma[i, 1, 1]
+            s00 = sig00 + half_sum + rotated
+            s11 = sig11 + half_sum - rotated
+            s01 = sig01 + np.sin(2 * phi) * half_diff + np.cos(2 * phi) * off_diagonal
+            det = s00 * s11 - s01 * s01
+
+            # K = Σ S^-1
+            k00 = (sig00 * s11 - sig01 * s01) / det
+            k01 = (sig01 * s00 - sig00 * s01) / det
+            k10 = (sig01 * s11 - sig11 * s01) / det
+            k11 = (sig11 * s00 - sig01 * s01) / det
+
+            mahalanobis = (dx * dx * s11 + dy * dy * s00 - 2 * dx * dy * s01) / det
+            importance_factors[i] *= np.exp(-0.5 * mahalanobis) / (2 * np.pi * np.sqrt(det))
+
+            # μ = μ + K d, Σ = Σ - K Σ
+            mean[i, 0] += k00 * dx + k01 * dy
+            mean[i, 1] += k10 * dx + k11 * dy
+
+            new_sig01 = sig01 - (k00 * sig01 + k01 * sig11)
+            sigma[i, 0, 0] = sig00 - (k00 * sig00 + k01 * sig01)
+            sigma[i, 0, 1] = new_sig01
+            sigma[i, 1, 0] = new_sig01
+            sigma[i, 1, 1] = sig11 - (k10 * sig01 + k11 * sig11)
+
+    @njit(parallel=True, cache=True)
+    def search_sorted(values, queries, right, out):
+        """Kernel version of np.searchsorted that writes into out instead of making a new array.
+
+        values must be sorted, queries don't have to be. right picks side="right" over side="left"."""
+        for i in prange(queries.shape[0]):
+            query = queries[i]
+            low, high = 0, values.shape[0]
+            while low < high:
+                middle = (low + high) // 2
+                if values[middle] < query or (right and values[middle] == query):
+                    low = middle + 1
+                else:
+                    high = middle
+            out[i] = low
+
+    @njit(parallel=True, cache=True)
+    def landmark_covs(polar_detections, sensor_noise_covs, headings, out):
+        """Kernel version of particles.get_landmark_covs with headings.
+
+        sensor_noise_covs is (M, 2, 2), headings is (N,) and out is the (N, M, 2, 2) result."""
+        number_of_detections = polar_detections.shape[0]
+        for i in prange(headings.shape[0]):
+            for j in range(number_of_detections):
+                r = polar_detections[j, 0]
+                theta = polar_detections[j, 1] + headings[i]
+                cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+
+                # J = [[cos, -r sin], [sin, r cos]], C = J R J^T, written out.
+                j00, j01, j10, j11 = cos_theta, -r * sin_theta, sin_theta, r * cos_theta
+                r00, r01 = sensor_noise_covs[j, 0, 0], sensor_noise_covs[j, 0, 1]
+                r10, r11 = sensor_noise_covs[j, 1, 0], sensor_noise_covs[j, 1, 1]
+
+                a00 = j00 * r00 + j01 * r10
+                a01 = j00 * r01 + j01 * r11
+                a10 = j10 * r00 + j11 * r10
+                a11 = j10 * r01 + j11 * r11
+
+                out[i, j, 0, 0] = a00 * j00 + a01 * j01
+                out[i, j, 0, 1] = a00 * j10 + a01 * j11
+                out[i, j, 1, 0] = a10 * j00 + a11 * j01
+                out[i, j, 1, 1] = a10 * j10 + a11 * j11
@@ -0,0 +1,358 @@
+"""
+#Particle Batch:
+Runs F particle filters at once, e.g. a sweep over ALPHAS and SENSOR_COVARIANCE, or one filter per car.
+
+Driving F separate Particles objects from a Python loop means F times the Python overhead, and F small numpy
+calls that each leave most of the CPU idle. ParticleBatch is a single Particles object holding F × N
+particles, where filter f owns particles f*N to (f+1)*N. Everything that works one particle at a time
+(prediction, landmark insertion, measurement updates) then runs for every filter in one vectorised call.
+The only things that need to know about filters are the ones that mix particles together: normalising
+the weights, the effective sample size and resampling. Those are done per filter here, still without a loop.
+
+Per filter settings:
+- filter_alphas: (F, k) motion noise, one row of alphas per filter.
+- predict(control, per_filter=True) takes one control per filter, e.g. (F, 2) for the velocity model or
+  (F, 2, 3) for the odometry model.
+- measurement_update(sensor_noise_cov) takes one (2, 2) R, or (F, 2, 2) with one R per filter.
+- add_landmarks / add_covariances with per_filter=True take (F, N, M, ...) or (F, M, ...).
+Without per_filter, everything takes the same shapes as Particles. Shapes alone can't tell a per filter control
+from a normal one (a (2, 3) odometry control looks like two filters' worth), which is why it's a flag.
+
+filter_poses, filter_landmarks etc. are (F, N, ...) views of the arrays, and batch.filter(f) gives you a
+ParticleSubset for one filter, which the viewer can draw like any other Particles object.
+
+Every filter shares one landmark index space, so add landmarks to all the filters at the same time
+(e.g. one sweep replaying the same detections). associate() uses landmark means across every filter to pick
+its candidates, so it's best to do association per filter if the filters disagree a lot about the map.
+"""
+
+import copy
+from dataclasses import fields
+from typing import Optional
+
+import numpy as np
+
+from particles import (
+    Particles,
+    ParticleSubset,
+    ResampleBuffers,
+    MeasurementBuffers,
+    NUMBER_OF_LANDMARKS,
+    DEFAULT_RESAMPLING_METHOD,
+    _ekf_update,
+    _search_sorted,
+)
+from data_association import DEFAULT_CELL_SIZE
+from motion_models import MotionModel
+
+
+def _systematic_pointers(positions: np.ndarray, rng: np.random.Generator, buffers: ResampleBuffers) -> None:
+    """One random offset per filter, then N evenly spaced pointers (see particles.systematic_resample)."""
+    np.add(buffers.particle_range, rng.random((positions.shape[0], 1)), out=positions)
+
+
+def _stratified_pointers(positions: np.ndarray, rng: np.random.Generator, buffers: ResampleBuffers) -> None:
+    rng.random(out=positions)
+    positions += buffers.particle_range
+
+
+def _multinomial_pointers(positions: np.ndarray, rng: np.random.Generator, buffers: ResampleBuffers) -> None:
+    rng.random(out=positions)
+    positions *= positions.shape[1]
+    positions.sort(axis=1)
+
+
+# Rule 3: Use dictionaries for more complex lookups.
+# Each of these fills buffers.positions with (F, N) pointers in [0, N) for every filter.
+BATCH_RESAMPLING_METHODS = {
+    "systematic": _systematic_pointers,
+    "stratified": _stratified_pointers,
+    "multinomial": _multinomial_pointers,
+}
+
+
+def batch_resample_indices(
+    weights: np.ndarray, method: str, rng: np.random.Generator, buffers: ResampleBuffers
+) -> np.ndarray:
+    """Resampling indices for F filters at once. weights is (F, N) and each row must be normalised.
+
+    Returns (F * N,) indices into the flattened particles, where filter f only ever picks from its own rows.
+
+    Filter f's cumulative weights are shifted up by f, so every filter's wheel sits end to end in one sorted
+    array from 0 to F. Each filter's pointers get the same shift, so one searchsorted handles every filter.
+    The indices are written into buffers.indices, which is what gets returned."""
+    number_of_filters, number_of_particles = weights.shape
+    cumulative, positions = buffers.cumulative, buffers.positions
+
+    np.cumsum(weights, axis=1, out=cumulative)
+    cumulative[:, -1] = 1.  # Stops rounding errors from pushing a pointer into the next filter.
+    cumulative += buffers.filter_offsets
+
+    BATCH_RESAMPLING_METHODS[method](positions, rng, buffers)
+    positions /= number_of_particles
+    positions += buffers.filter_offsets
+
+    # side="right", so a pointer landing exactly on filter f's start can't pick the last particle of filter f-1.
+    _search_sorted(cumulative.ravel(), positions.ravel(), buffers.indices, side="right")
+    return buffers.indices
+
+
+class ParticleBatch(Particles):
+    """F particle filters of N particles each, stored and updated as one Particles object of F × N particles.
+
+    Args:
+        number_of_filters: F.
+        number_of_particles: N, the particles in each filter.
+        initial_pose: (3,) starting pose for every filter, or (F, 3), one per filter.
+        filter_alphas: Optional (F, k) array. Row f replaces motion_model.alphas for filter f.
+        The rest are the same as Particles.
+
+    Attributes (on top of Particles):
+    number_of_filters, particles_per_filter: F and N. number_of_particles is F × N."""
+    def __init__(
+        self,
+        number_of_filters: int,
+        number_of_particles: int,
+        initial_pose: np.ndarray,
+        initial_error: Optional[np.ndarray] = None,
+        max_landmarks: int = NUMBER_OF_LANDMARKS,
+        seed: Optional[int] = None,
+        association_cell_size: float = DEFAULT_CELL_SIZE,
+        landmark_cap: Optional[int] = None,
+        motion_model: Optional[MotionModel] = None,
+        filter_alphas: Optional[np.ndarray] = None,
+        dtype: Optional[np.dtype] = None,
+        packed_covariance: bool = False
+    ):
+        self.number_of_filters = number_of_filters
+        self.particles_per_filter = number_of_particles
+
+        initial_pose = np.asarray(initial_pose, dtype=np.float64)
+        if initial_pose.ndim == 2:
+            initial_pose = np.repeat(initial_pose, number_of_particles, axis=0)
+
+        if filter_alphas is not None:
+            if motion_model is None:
+                raise ValueError("filter_alphas needs a motion_model to apply them to.")
+            motion_model = copy.copy(motion_model)
+            motion_model.alphas = self.per_particle(np.asarray(filter_alphas, dtype=np.float64)).T.copy()
+
+        super().__init__(
+            number_of_filters * number_of_particles,
+            initial_pose,
+            initial_error,
+            max_landmarks,
+            seed,
+            association_cell_size,
+            landmark_cap,
+            motion_model,
+            dtype=dtype,
+            packed_covariance=packed_covariance,
+        )
+
+        shape = (number_of_filters, number_of_particles)
+        self._batch_resample_buffers = ResampleBuffers(
+            np.empty(shape),
+            np.empty(shape),
+            np.arange(number_of_particles, dtype=np.float64),
+            np.empty(number_of_filters * number_of_particles, dtype=np.intp),
+        )
+        self._batch_resample_buffers.filter_offsets = np.arange(number_of_filters, dtype=np.float64)[:, None]
+        self._batch_controls = None
+
+        # The first N entries of every measurement buffer, for running the EKF one filter at a time.
+        self._filter_measurement_buffers = MeasurementBuffers(*(
+            getattr(self._measurement_buffers, field.name)[:number_of_particles]
+            for field in fields(MeasurementBuffers)
+        ))
+
+    def per_particle(self, values: np.ndarray) -> np.ndarray:
+        """Repeats (F, ...) per filter values into (F × N, ...) per particle values."""
+        return np.repeat(values, self.particles_per_filter, axis=0)
+
+    def _split(self, array: np.ndarray) -> np.ndarray:
+        return array.reshape((self.number_of_filters, self.particles_per_filter) + array.shape[1:])
+
+    @property
+    def filter_poses(self) -> np.ndarray:
+        """(F, N, 3) view of poses."""
+        return self._split(self.poses)
+
+    @property
+    def filter_importance_factors(self) -> np.ndarray:
+        """(F, N) view of importance_factors."""
+        return self._split(self.importance_factors)
+
+    @property
+    def filter_landmarks(self) -> np.ndarray:
+        """(F, N, L, 2) view of landmarks."""
+        return self._split(self.landmarks)
+
+    @property
+    def filter_landmark_likelihood(self) -> np.ndarray:
+        """(F, N, L) view of landmark_likelihood."""
+        return self._split(self.landmark_likelihood)
+
+    @property
+    def filter_covariance(self) -> np.ndarray:
+        """(F, N, L, 2, 2) view of covariance."""
+        return self._split(self.covariance)
+
+    def filter(self, filter_index: int) -> ParticleSubset:
+        """Returns one filter's particles. Writing to its (sliced) arrays writes straight into the batch."""
+        start = filter_index * self.particles_per_filter
+        return ParticleSubset(self, slice(start, start + self.particles_per_filter))
+
+    def filters(self):
+        for filter_index in range(self.number_of_filters):
+            yield self.filter(filter_index)
+
+    def _from_filters(self, values: np.ndarray, item_dimensions: int) -> np.ndarray:
+        """Turns (F, N, ...) or (F, ...) per filter values, on top of item_dimensions, into (F × N, ...) per particle."""
+        values = np.asarray(values)
+        if values.ndim not in (item_dimensions + 1, item_dimensions + 2) or values.shape[0] != self.number_of_filters:
+            raise ValueError(
+                f"per filter values need to be (F, N, ...) or (F, ...) with F = {self.number_of_filters}, "
+                f"got {values.shape}."
+            )
+        if values.ndim == item_dimensions + 2:
+            return values.reshape((self.number_of_particles,) + values.shape[2:])
+        return self.per_particle(values)
+
+    def predict(
+        self,
+        control: np.ndarray,
+        timestep: float,
+        model: Optional[MotionModel] = None,
+        per_filter: bool = False
+    ) -> None:
+        """Same as Particles.predict. With per_filter=True, control has a leading F axis, one control per filter.
+
+        The per particle controls are built in a buffer kept between calls. The particle axis goes just before the
+        control's last axis, so (F, 2) velocity controls become (F × N, 2) and (F, 2, 3) odometry controls become
+        (2, F × N, 3), which is how each motion model takes per particle controls."""
+        control = np.asarray(control, dtype=np.float64)
+        if per_filter:
+            if control.ndim < 2 or control.shape[0] != self.number_of_filters:
+                raise ValueError(
+                    f"per filter controls need a leading axis of {self.number_of_filters}, got {control.shape}."
+                )
+            shape = control.shape[1:-1] + (self.number_of_particles, control.shape[-1])
+            if self._batch_controls is None or self._batch_controls.shape != shape:
+                self._batch_controls = np.empty(shape)
+
+            filter_controls = self._batch_controls.reshape(
+                control.shape[1:-1] + (self.number_of_filters, self.particles_per_filter, control.shape[-1])
+            )
+            filter_controls[:] = np.moveaxis(control, 0, -2)[..., None, :]
+            control = self._batch_controls
+
+        super().predict(control, timestep, model)
+
+    def add_landmarks(
+        self,
+        landmark_positions: np.ndarray,
+        covariance_matrices: Optional[np.ndarray] = None,
+        per_filter: bool = False
+    ) -> np.ndarray:
+        """Same as Particles.add_landmarks. With per_filter=True, landmark_positions is (F, N, M, 2), or (F, M, 2)
+        for one position per filter, and covariance_matrices (if given) is per filter too."""
+        if per_filter:
+            landmark_positions = self._from_filters(landmark_positions, 2)
+            if covariance_matrices is not None:
+                covariance_matrices = self._from_filters(covariance_matrices, 3)
+
+        return super().add_landmarks(landmark_positions, covariance_matrices)
+
+    def add_covariances(self, covariance_matrices: np.ndarray, per_filter: bool = False) -> None:
+        """Same as Particles.add_covariances. With per_filter=True, covariance_matrices is (F, N, M, 2, 2), or
+        (F, M, 2, 2) for one per filter."""
+        if per_filter:
+            covariance_matrices = self._from_filters(covariance_matrices, 3)
+
+        super().add_covariances(covariance_matrices)
+
+    def measurement_update(
+        self,
+        landmark_index: int,
+        polar_measurement: np.ndarray,
+        sensor_noise_cov: np.ndarray
+    ) -> None:
+        """Same as Particles.measurement_update, but sensor_noise_cov can also be (F, 2, 2), one R per filter.
+
+        With one R per filter the EKF runs once per filter (each one still vectorised over its N particles)."""
+        sensor_noise_cov = np.asarray(sensor_noise_cov)
+        if sensor_noise_cov.ndim == 2:
+            super().measurement_update(landmark_index, polar_measurement, sensor_noise_cov)
+            return
+
+        r, bearing = polar_measurement[0], polar_measurement[1]
+        mean, sigma, tau = self._landmark_column(landmark_index)
+
+        number_of_particles = self.particles_per_filter
+        for filter_index, filter_noise_cov in enumerate(sensor_noise_cov):
+            rows = slice(filter_index * number_of_particles, (filter_index + 1) * number_of_particles)
+            half_sum, half_diff, off_diagonal = self._stretched_noise_terms(r, filter_noise_cov)
+            _ekf_update(
+                self.poses[rows], r, bearing, half_sum, half_diff, off_diagonal,
+                mean[rows], sigma[rows], self.importance_factors[rows], self._filter_measurement_buffers
+            )
+
+        tau += 1
+        self._store_landmark_column(landmark_index, mean, sigma, tau)
+        self.landmark_grid.move(landmark_index, mean.mean(axis=0))
+        self.mark_changed()
+
+    def normalise_importance_factors(self) -> None:
+        """Scales each filter's importance factors so they sum to one. A filter whose weights have all
+        collapsed to zero gets uniform weights."""
+        weights = self.filter_importance_factors
+        totals = weights.sum(axis=1, keepdims=True)
+        collapsed = ~((totals > 0) & np.isfinite(totals))
+        np.divide(weights, totals, out=weights, where=~collapsed)
+        weights[collapsed[:, 0]] = 1 / self.particles_per_filter
+
+    def effective_sample_size(self) -> np.ndarray:
+        """Returns the (F,) effective sample size of each filter (see Particles.effective_sample_size)."""
+        weights = self.filter_importance_factors
+        totals = weights.sum(axis=1)
+        squared_totals = np.einsum("fn,fn->f", weights, weights)
+        return np.divide(totals * totals, squared_totals, out=np.zeros_like(totals), where=squared_totals > 0)
+
+    def resample(
+        self,
+        method: str = DEFAULT_RESAMPLING_METHOD,
+        ess_threshold: Optional[float] = None
+    ) -> np.ndarray:
+        """Resamples every filter from its own particles, in one gather.
+
+        Args:
+            method: one of the keys in BATCH_RESAMPLING_METHODS ("systematic", "stratified", "multinomial").
+            ess_threshold: If set, only filters whose effective sample size is below
+                ess_threshold * particles_per_filter are resampled. The rest keep their particles.
+
+        Returns:
+            (F,) bool array, True for every filter that was resampled."""
+        if method not in BATCH_RESAMPLING_METHODS:
+            raise ValueError(f"ParticleBatch can't use {method!r} resampling, pick one of {list(BATCH_RESAMPLING_METHODS)}.")
+
+        resampled = np.ones(self.number_of_filters, dtype=bool)
+        if ess_threshold is not None:
+            resampled = self.effective_sample_size() < ess_threshold * self.particles_per_filter
+            if not resampled.any():
+                return resampled
+
+        self.normalise_importance_factors()
+        indices = batch_resample_indices(
+            self.filter_importance_factors, method, self.rng, self._batch_resample_buffers
+        )
+
+        # Filters that don't need resampling just gather themselves.
+        kept = ~resampled
+        if kept.any():
+            self._split(indices)[kept] = self._split(np.arange(self.number_of_particles))[kept]
+
+        self.gather(indices)
+        self.filter_importance_factors[resampled] = 1 / self.particles_per_filter
+
+        return resampled
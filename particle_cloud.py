@@ -1,11 +1,24 @@
 
 from particles import Particle, Particles, get_landmark_cov  
 from PyQt5.QtWidgets import (QGraphicsItem,
-                             QGraphicsItemGroup
+                             QGraphicsItemGroup,
+                             QStyleOptionGraphicsItem
                              )
+from PyQt5.QtGui import QPolygonF
+from PyQt5.QtCore import QRectF
 import numpy as np
 from typing import Callable
 
+# Bytes in one QPointF (two doubles).
+POINT_SIZE = 16
+
+DEFAULT_DETAIL_BUDGET = 20000  # The most markers one batched cloud draws per frame. Past this, they are thinned out.
+DETAIL_CELL_SIZE = 2  # pixels. Batched clouds draw about one marker per cell this big, any more just pile up.
+SUMMARY_SIZE = 24  # pixels. Batched clouds smaller than this on screen are drawn as a summary, if they have one.
+# Clouds with more markers than this per pixel cell are summarised too, as most of them would be drawn on top of
+# each other. Zooming in spreads them out until they are drawn in full.
+DENSE_SUMMARY_DENSITY = 8
+
 
 class ParticleCloud:
     """A class that handles the displaying of a set of particles. MORE INFO HERE.
@@ -31,6 +44,7 @@ class ParticleCloud:
         self.update_fn = particle_updater
         
         self.items = []
+        self._drawn_version = None
 
         # initialise display properties
         self.opacity = opacity
@@ -41,12 +55,27 @@ class ParticleCloud:
 
         self.set_visibility(False) # hides our group while we update everything.
 
-        for _ in range(self.data.number_of_particles): 
+        # How many of the items are showing. The rest are hidden, ready for when the particle count goes up.
+        self._shown_items = 0
+        self.sync_items()
+
+        self.set_visibility(True)
+
+    def sync_items(self):
+        """Makes sure there is one visible item per particle, for particle sets whose size changes
+        (see AdaptiveParticles). Items are only ever created, never deleted: spare ones are just hidden."""
+        number_of_particles = self.data.number_of_particles
+
+        for _ in range(len(self.items), number_of_particles):
             item = self.create_fn() #creates an item for each particle!
             self.items.append(item)
             self.group.addToGroup(item)
 
-        self.set_visibility(True)
+        if number_of_particles == self._shown_items:
+            return
+        for index in range(min(number_of_particles, self._shown_items), max(number_of_particles, self._shown_items)):
+            self.items[index].setVisible(index < number_of_particles)
+        self._shown_items = number_of_particles
 
     def create_particles(self, number_of_particles, particle_factory):
         """ creates a set of particledisplayitems from the underlying particle data. requires a factory to set up particles in the first place. 
@@ -59,8 +88,20 @@ class ParticleCloud:
             self.items.append(particle)
 
     def update_particles(self):
-        """updates particles current position based off current particle data."""
-        for particle_data, particle_view in zip(self.data, self.items):
+        """updates particles current position based off current particle data.
+
+        Does nothing if the data hasn't changed since the last update (see Particles.version)."""
+        version = getattr(self.data, "version", None)
+        if version is not None and version == self._drawn_version:
+            return
+        self._drawn_version = version
+        self.sync_items()
+
+        # One Particle proxy, moved along the items, instead of a new object per particle per frame.
+        particle_data = Particle(self.data, 0)
+        for index in range(self._shown_items):
+            particle_view = self.items[index]
+            particle_data._index = index
             self.update_fn(particle_data, particle_view)
 
     def set_visibility(self, visible):
@@ -69,3 +110,187 @@ class ParticleCloud:
     def set_opacity(self, opacity):
         self.group.setOpacity(opacity)
 
+
+
+def polygon_view(polygon: QPolygonF) -> np.ndarray:
+    """Returns a (K, 2) numpy view of the points inside a QPolygonF.
+
+    Writing to the view writes straight into the polygon, so we can fill it with vectorised numpy
+    instead of appending QPointFs one at a time."""
+    pointer = polygon.data()
+    pointer.setsize(polygon.size() * POINT_SIZE)
+
+    return np.frombuffer(pointer, np.float64).reshape(-1, 2)
+
+
+class ArrayCloudItem(QGraphicsItem):
+    """A single graphics item that draws a whole array of particles in one paint call.
+
+    ParticleCloud makes one QGraphicsItem per particle and moves each of them from Python, which gets slow
+    with a few hundred particles. This item reads the numpy arrays in the Particles object when Qt asks it to
+    paint, so the cost per frame is one Python call per cloud, however many particles there are.
+
+    Subclasses write:
+    anchors: returns a (K, 2) array with the scene position of each marker (y is flipped).
+    draw_markers: draws the markers at the given indices with the painter.
+    reach: Optional. How far a marker can stretch past its anchor in scene units, e.g. an ellipse's major axis.
+    draw_summary: Optional. Draws the cloud as a summary (e.g. one marker per landmark) when it's tiny or
+        crowded on screen (see summarise). Return True if you did.
+
+    Each paint only draws markers inside the part of the scene being redrawn (the rest are culled). If there
+    are more of those than DETAIL_CELL_SIZE pixel cells in that part of the screen, only one marker per cell is
+    drawn, so how much gets drawn follows the zoom. detail_budget caps it on top of that, by drawing every k-th
+    one. update_particles does nothing if Particles.version hasn't changed since the last frame.
+
+    It has the same interface as ParticleCloud (group, update_particles, set_visibility and set_opacity),
+    so ParticleView can handle both the same way.
+
+    Attributes:
+    data: The particle data class that we are drawing.
+    color: The QColor to draw with.
+    size: How big each particle is, in pixels. This stays the same when you zoom.
+    detail_budget: The most markers drawn in one paint."""
+    def __init__(
+        self,
+        particles_data: Particles,
+        color,
+        size: float,
+        detail_budget: int = DEFAULT_DETAIL_BUDGET
+    ):
+        super().__init__()
+        self.data = particles_data
+        self.color = color
+        self.size = size
+        self.detail_budget = detail_budget
+
+        # Scene units per pixel, from the last paint. Used to leave room round the edge for the markers.
+        self.pixel_size = 1.
+        self._bounds = QRectF()
+        self._spread = 0.
+        self._number_of_markers = 0
+        self._polygon = QPolygonF()
+        self._drawn_version = None
+
+        # Qt only fills in option.exposedRect (what we cull against) with this flag set.
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption, True)
+
+    @property
+    def group(self) -> QGraphicsItem:
+        """The item to add to the scene. For a ParticleCloud this is a group, here it's just this item."""
+        return self
+
+    def anchors(self) -> np.ndarray:
+        raise NotImplementedError
+
+    def draw_markers(self, painter, anchors: np.ndarray, visible: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def reach(self) -> float:
+        return 0.
+
+    def draw_summary(self, painter, exposed: QRectF) -> bool:
+        return False
+
+    def polygon(self, number_of_points: int) -> tuple:
+        """Returns a QPolygonF with room for number_of_points, and a numpy view of it.
+
+        QPolygonF can't be resized from Python, so the polygon is only rebuilt when the number of points changes."""
+        if self._polygon.size() != number_of_points:
+            self._polygon = QPolygonF(number_of_points)
+
+        return self._polygon, polygon_view(self._polygon)
+
+    def margin(self) -> float:
+        return self.size * self.pixel_size + self.reach()
+
+    def update_particles(self) -> None:
+        """Tells Qt the arrays have changed. Nothing is drawn here, that happens in paint."""
+        version = getattr(self.data, "version", None)
+        if version is not None and version == self._drawn_version:
+            return
+        self._drawn_version = version
+
+        anchors = self.anchors()
+        bounds = QRectF()
+        self._spread = 0.
+        self._number_of_markers = len(anchors)
+        if len(anchors):
+            margin = self.margin()
+            (left, top), (right, bottom) = anchors.min(axis=0), anchors.max(axis=0)
+            self._spread = max(right - left, bottom - top)
+            bounds = QRectF(
+                left - margin, top - margin, right - left + 2 * margin, bottom - top + 2 * margin
+            )
+
+        if bounds != self._bounds:
+            self.prepareGeometryChange()
+            self._bounds = bounds
+        self.update()
+
+    def visible_markers(self, anchors: np.ndarray, exposed: QRectF) -> np.ndarray:
+        """Indices of the markers that could touch the exposed rect, thinned out to about one per pixel cell
+        and to at most detail_budget."""
+        margin = self.margin()
+        x, y = anchors[:, 0], anchors[:, 1]
+        left, top = exposed.left() - margin, exposed.top() - margin
+        inside = (x >= left) & (x <= exposed.right() + margin)
+        inside &= (y >= top) & (y <= exposed.bottom() + margin)
+        visible = np.flatnonzero(inside)
+
+        # Keep one marker in each occupied cell. Every cell gets one, so sparse parts of the cloud don't lose any.
+        # Writing every marker into its cell leaves one of them there, which is cheaper than sorting by cell.
+        cell = DETAIL_CELL_SIZE * self.pixel_size
+        columns = int((exposed.width() + 2 * margin) // cell) + 1
+        rows = int((exposed.height() + 2 * margin) // cell) + 1
+        if len(visible) > columns * rows:
+            cells = ((x[visible] - left) // cell).astype(np.intp)
+            cells *= rows
+            cells += ((y[visible] - top) // cell).astype(np.intp)
+            occupant = np.full(columns * rows, -1, np.intp)
+            occupant[cells] = visible
+            visible = occupant[occupant >= 0]
+
+        if len(visible) > self.detail_budget:
+            stride = -(-len(visible) // self.detail_budget)
+            visible = visible[::stride]
+
+        return visible
+
+    def summarise(self) -> bool:
+        """True if the cloud should be drawn as a summary: it's under SUMMARY_SIZE pixels across, or has more
+        than DENSE_SUMMARY_DENSITY markers per pixel cell of the square it spans on screen."""
+        on_screen = self._spread / self.pixel_size
+        if on_screen < SUMMARY_SIZE:
+            return True
+
+        cells = (on_screen / DETAIL_CELL_SIZE) ** 2
+        return self._number_of_markers > DENSE_SUMMARY_DENSITY * cells
+
+    def boundingRect(self) -> QRectF:
+        return self._bounds
+
+    def paint(self, painter, option, widget=None) -> None:
+        self.pixel_size = 1 / QStyleOptionGraphicsItem.levelOfDetailFromTransform(
+            painter.worldTransform()
+        )
+
+        # Qt doesn't always trim exposedRect to the window, so cull against the device as well.
+        device = painter.device()
+        on_device = painter.worldTransform().inverted()[0].mapRect(
+            QRectF(0, 0, device.width(), device.height())
+        )
+        exposed = option.exposedRect.intersected(on_device)
+
+        if self.summarise() and self.draw_summary(painter, exposed):
+            return
+
+        anchors = self.anchors()
+        visible = self.visible_markers(anchors, exposed)
+        if len(visible):
+            self.draw_markers(painter, anchors, visible)
+
+    def set_visibility(self, visible):
+        self.setVisible(visible)
+
+    def set_opacity(self, opacity):
+        self.setOpacity(opacity)
@@ -0,0 +1,89 @@
+"""
+#Particle Plots:
+Quick matplotlib plots of a particle set, for notebooks and debugging.
+
+These used to live in particles.py, which meant anything that imported the filter paid for importing
+matplotlib too (about half a second, and a lot of memory), even on the car where nothing gets plotted.
+particles.py never imports this module, so only import it when you actually want a plot.
+
+For live viewing use particle_viewer.py instead, it's much faster.
+"""
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from particles import Particles, motion_update, uncertainty_ellipses, DEFAULT_CONFIDENCE_THRESHOLD
+
+ARROW_LENGTH = 0.05
+ELLIPSE_SEGMENTS = 48
+
+
+def plot_particle_poses(particles: Particles, ax=None, color="tab:blue"):
+    """Draws every particle pose as a small arrow. Returns the axes."""
+    if ax is None:
+        _, ax = plt.subplots()
+
+    x, y, theta = particles.poses.T
+    ax.quiver(
+        x, y, np.cos(theta), np.sin(theta),
+        color=color, angles="xy", scale_units="xy", scale=1 / ARROW_LENGTH, width=0.003
+    )
+    ax.set_aspect("equal")
+
+    return ax
+
+
+def plot_landmarks(
+    particles: Particles,
+    ax=None,
+    confidence: float = DEFAULT_CONFIDENCE_THRESHOLD,
+    color="tab:orange"
+):
+    """Draws every particle's landmark estimates as dots, plus the uncertainty ellipse of each landmark's
+    mean across the particles. Returns the axes."""
+    if ax is None:
+        _, ax = plt.subplots()
+
+    landmarks = particles.landmarks.reshape(-1, 2)
+    ax.scatter(landmarks[:, 0], landmarks[:, 1], s=2, color=color, alpha=0.3)
+
+    observed = particles.observed_covariances
+    if observed:
+        means = particles.landmarks[:, :observed].mean(axis=0)
+        covariance = particles.covariance.mean(axis=0)
+        axes, angles = uncertainty_ellipses(covariance, confidence)
+
+        t = np.linspace(0, 2 * np.pi, ELLIPSE_SEGMENTS)
+        circle = np.stack((np.cos(t), np.sin(t)))
+        for mean, (major, minor), angle in zip(means, axes, angles):
+            rotation = np.array(((np.cos(angle), -np.sin(angle)), (np.sin(angle), np.cos(angle))))
+            outline = rotation @ (circle * np.array(((major,), (minor,)))) + mean[:, None]
+            ax.plot(outline[0], outline[1], color=color, linewidth=1)
+
+    ax.set_aspect("equal")
+
+    return ax
+
+
+def animate_motion(particles: Particles, control, timestep: float, alphas, frames: int = 100):
+    """Moves particles with motion_update every frame and plots them. Blocks until the window is closed."""
+    import matplotlib.animation as animation
+
+    fig, ax = plt.subplots()
+
+    def animate(frame):
+        ax.clear()
+        # Update particles for this timestep
+        particles.poses[:] = motion_update(particles, np.asarray(control), timestep, alphas)
+        plot_particle_poses(particles, ax)
+        ax.set_title(f'Timestep {frame}')
+
+    ani = animation.FuncAnimation(fig, animate, frames=frames, interval=100, repeat=True)
+    plt.show()
+
+    return ani
+
+
+if __name__ == "__main__":
+    particles = Particles(5000, np.array([0 ,0. ,0.]),np.array([0.01, 0.01, 0.001]))
+    animate_motion(particles, (1, 0.2), 0.1, [0.01, 0.0001, 0.0001, 0.001, 0.05, 0.1])
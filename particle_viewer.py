@@ -8,14 +8,19 @@ from particle_cloud import ParticleCloud
 from vehicle_cloud import (
         create_direction_particle,
         update_direction_particle, 
+        PoseCloudItem,
                         )
 
 from landmark_cloud import (
         create_landmark_mean_dot,
-        update_landmark_mean_dot
+        update_landmark_mean_dot,
+        LandmarkLayerItem,
+        EllipseLayerItem,
         )
 import numpy as np
 from functools import partial
+from typing import Optional
+from instrumentation import Instrumentation
 
 
 
@@ -24,15 +29,9 @@ PARTICLE_ERROR = np.array((1.5, 1.5, 0.2))
 
 def create_direction_particle_cloud(
         data: Particles
-        ) -> ParticleCloud:
-    particle_cloud = ParticleCloud(
-            data,
-            create_direction_particle,
-            update_direction_particle, 
-            None,
-            None
-            )
-
+        ) -> PoseCloudItem:
+    """Creates a cloud that draws every particle pose as an arrow. The whole cloud is one graphics item."""
+    particle_cloud = PoseCloudItem(data)
     particle_cloud.update_particles()
 
     return particle_cloud
@@ -61,6 +60,28 @@ def create_landmark_particle_cloud(
     return particle_cloud
 
 
+def create_landmark_layer(
+        data: Particles,
+        means_only: bool = False
+        ) -> LandmarkLayerItem:
+    """Creates one layer that draws every landmark the particles have seen, including ones added later."""
+    landmark_layer = LandmarkLayerItem(data, means_only)
+    landmark_layer.update_particles()
+
+    return landmark_layer
+
+
+def create_ellipse_layer(
+        data: Particles,
+        means_only: bool = True
+        ) -> EllipseLayerItem:
+    """Creates one layer that draws the uncertainty ellipse of every landmark the particles have seen."""
+    ellipse_layer = EllipseLayerItem(data, means_only)
+    ellipse_layer.update_particles()
+
+    return ellipse_layer
+
+
 class ParticleView(QGraphicsView):
     """This draws and then displays our particles on the screen."""
     
@@ -76,6 +97,7 @@ class ParticleView(QGraphicsView):
         self.setDragMode(QGraphicsView.ScrollHandDrag)
         
         self.clouds = []
+        self.instrumentation = None
    
     def wheelEvent(self, event):
         """Enable zoom with mouse wheel."""
@@ -93,9 +115,52 @@ class ParticleView(QGraphicsView):
         self.scene.addItem(cloud.group)
         self.clouds.append(cloud)
 
+        if self.instrumentation is not None:
+            self._instrument_cloud(len(self.clouds) - 1, cloud)
+
+    def enable_instrumentation(self, instrumentation: Optional[Instrumentation] = None) -> Instrumentation:
+        """Starts recording how long each redraw takes, for the whole view and for each cloud.
+
+        Each cloud gets a "<class>[<index>].update" stage, and batched clouds a "<class>[<index>].paint" stage
+        too. "view.update_clouds" and "view.paint" cover everything. See instrumentation.py."""
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+
+        self.disable_instrumentation()
+        self.instrumentation = instrumentation
+        instrumentation.instrument(
+            self, {"update_clouds": "view.update_clouds", "paintEvent": "view.paint"}
+        )
+        for index, cloud in enumerate(self.clouds):
+            self._instrument_cloud(index, cloud)
+
+        return instrumentation
+
+    def disable_instrumentation(self) -> None:
+        if self.instrumentation is None:
+            return
+
+        self.instrumentation.uninstrument(self)
+        for cloud in self.clouds:
+            self.instrumentation.uninstrument(cloud)
+        self.instrumentation = None
+
+    def _instrument_cloud(self, index: int, cloud) -> None:
+        name = f"{type(cloud).__name__}[{index}]"
+        stages = {"update_particles": f"{name}.update"}
+        if cloud.group is cloud:
+            # Batched clouds do their real work when Qt paints them.
+            stages["paint"] = f"{name}.paint"
+        self.instrumentation.instrument(cloud, stages)
+
     def update_clouds(self):
+        """Tells every visible cloud to pick up the latest data.
+
+        This is cheap to call every frame: clouds skip the update if Particles.version hasn't changed, and the
+        batched clouds only draw what is on screen, thinned out or summarised when you zoom out."""
         for cloud in self.clouds:
-            cloud.update_particles()
+            if cloud.group.isVisible():
+                cloud.update_particles()
         
         # Initial update
 
@@ -19,7 +19,9 @@ Just press Q to quit.
 """
 
 from PyQt5.QtCore import QTimer
-from particles import Particles, get_landmark_offset, get_landmark_cov, ackermann_motion_update
+from particles import Particles, get_landmark_offset, get_landmark_cov
+from motion_models import VelocityMotionModel
+from filter_worker import FilterWorker
 import sys
 import time
 import numpy as np
@@ -29,7 +31,8 @@ from PyQt5.QtWidgets import QApplication, QShortcut
 from particle_viewer import (
         create_direction_particle_cloud,
         ParticleView,
-        create_landmark_particle_cloud)
+        create_landmark_layer,
+        create_ellipse_layer)
 
 MODE = "dynamic"
 NUMBER_OF_PARTICLES = 200
@@ -46,16 +49,22 @@ POLAR_LANDMARK_DETECTION = np.array((55., pi/2))
 
 MOTION_UPDATE_TIMESTEP = 1/30 # 30fps update for now, but system should be able to handle 60.
 LANDMARK_DETECTION_TIMESTEP = 1000
+REDRAW_INTERVAL = 1000 // 30  # ms. The viewer redraws at its own rate, whatever the filter is doing.
+
+# The filter adds a landmark every this many motion updates.
+STEPS_PER_LANDMARK = round(LANDMARK_DETECTION_TIMESTEP / 1000 / MOTION_UPDATE_TIMESTEP)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     timer = QTimer()
-    landmark_timer = QTimer()
-
-    particles = Particles(NUMBER_OF_PARTICLES, INITIAL_PARTICLE_POSITION, PARTICLE_ERROR, MAX_LANDMARKS)
 
-    #A "cloud" is a way of viewing our particles object in a GUI. create_direction_particle_cloud is used for dispalying objects with poses (IE our particles.)
-    position_cloud = create_direction_particle_cloud(particles)
+    particles = Particles(
+        NUMBER_OF_PARTICLES,
+        INITIAL_PARTICLE_POSITION,
+        PARTICLE_ERROR,
+        MAX_LANDMARKS,
+        motion_model=VelocityMotionModel(ALPHAS)
+        )
 
     # Now we are simulating a landmark detection using some data
     polar_landmark_detection = POLAR_LANDMARK_DETECTION #Im just using a constant value here.
@@ -76,69 +85,71 @@ if __name__ == "__main__":
     particles.add_landmark(cartesian_landmark_positions)
     particles.add_covariance(SENSOR_COVARIANCE) #We shouldnt be using SENSOR_COVARIANCE like this! fix!
 
-    # And then finally, we can create a landmark particle cloud that lets us see the position of every landmark in space.
-    # This will eventually visualise the concentration ellipse of every landmark as well, but this isnt implemented yet.
-    landmark_cloud_1 = create_landmark_particle_cloud(particles, 0)
-    
-    # The final step is to create our View.
-    view = ParticleView(particles)
-    view.add_cloud(position_cloud)
- 
- # The amount of state means that this should be a class or a lambda in actual code.   
-    def update_simulation():
-        #time ackermann update.
-        time_start = time.time()
-        new_particle_locations = ackermann_motion_update(particles, TEST_VELOCITY, MOTION_UPDATE_TIMESTEP, ALPHAS)
-        update_time = time.time() - time_start
-        
-        # time redraw
-        time_start = time.time()
-        particles.poses = new_particle_locations
-        view.update_clouds()
-        redraw_time = time.time() - time_start
-        print(f"time taken to redraw: {int(redraw_time*1000)}ms")
-        print(f"time taken to update position: {int(update_time*1000)}ms")
-        print()
-    
-    # This just tests adding landmarks to see if everything gets messy!
-    n = 0
-
-    #TODO: This is bad code! need to rewrite to avoid globals and make whats happening more clear.
-    def add_landmark_cloud():
-        global n
+    def add_landmark(particles):
+        """Simulates detecting the same cone again, and adds it as a new landmark."""
         polar_landmark_detection = np.array((55., pi/2))
-    
-    # Convert the landmark detection from a single polar detection to 50 seperate landmark hypotheses in cartesian space. 
-        cartesian_landmark_offset = get_landmark_offset(
-        particles, 
-        polar_landmark_detection
-        )
 
-        # This can be combined with prev. line in prod. code if you feel like it.
-        cartesian_landmark_positions = cartesian_landmark_offset + particles.poses[:, :2]
-       
+        # Convert the landmark detection from a single polar detection to 50 seperate landmark hypotheses in cartesian space. 
+        cartesian_landmark_positions = get_landmark_offset(
+            particles, 
+            polar_landmark_detection
+            ) + particles.poses[:, :2]
+
         # And now we just calculate the covariance at that specific distance.
         lm_covariances = get_landmark_cov(polar_landmark_detection, SENSOR_COVARIANCE)
 
         # Once we have calculated the correct positions and covariance values, we can add them to our Particles class.
         particles.add_landmark(cartesian_landmark_positions)
-        particles.add_covariance(lm_covariances) #We shouldnt be using SENSOR_COVARIANCE like this! fix!
+        particles.add_covariance(lm_covariances)
+
+    def filter_step(particles):
+        """One step of the filter. This runs on the worker thread, never the Qt thread."""
+        particles.predict(TEST_VELOCITY, MOTION_UPDATE_TIMESTEP)
+
+        # This just tests adding landmarks to see if everything gets messy!
+        if worker.steps_run % STEPS_PER_LANDMARK == STEPS_PER_LANDMARK - 1:
+            add_landmark(particles)
+            print(f"number of landmarks: {particles.observed_landmarks}")
+
+    """The filter runs on its own thread from here on. Don't touch particles from the Qt thread any more:
+    the worker publishes read-only snapshots, and worker.reader always holds the newest one we've drawn."""
+    worker = FilterWorker(particles, filter_step, MOTION_UPDATE_TIMESTEP)
+    snapshot = worker.reader
+
+    #A "cloud" is a way of viewing our particles object in a GUI. create_direction_particle_cloud is used for dispalying objects with poses (IE our particles.)
+    position_cloud = create_direction_particle_cloud(snapshot)
 
-        # And then finally, we can create a landmark particle cloud that lets us see the position of every landmark in space.
-        # This will eventually visualise the concentration ellipse of every landmark as well, but this isnt implemented yet.
-        landmark_cloud_1 = create_landmark_particle_cloud(particles, n)
-        n += 1
-        view.add_cloud(landmark_cloud_1)
+    # And then finally, we can create a landmark layer that lets us see the position of every landmark in space.
+    # There's only ever one of these: landmarks we add later show up in it automatically.
+    landmark_layer = create_landmark_layer(snapshot)
 
-        print(f"number of particles: {n}")
+    # The ellipse layer draws a 95% uncertainty ellipse round every landmark.
+    ellipse_layer = create_ellipse_layer(snapshot)
+    
+    # The final step is to create our View.
+    view = ParticleView(snapshot)
+    view.add_cloud(landmark_layer)
+    view.add_cloud(ellipse_layer)
+    view.add_cloud(position_cloud)
+
+    def redraw():
+        # If the filter hasn't published anything new, there's nothing to do. If it has published
+        # several snapshots since the last frame, we only ever see the newest one.
+        if not snapshot.refresh():
+            return
+
+        time_start = time.time()
+        view.update_clouds()
+        redraw_time = time.time() - time_start
+        print(f"time taken to redraw: {int(redraw_time*1000)}ms, filter steps so far: {worker.steps_run}")
      
-    timer.timeout.connect(update_simulation)
-    landmark_timer.timeout.connect(add_landmark_cloud)
+    timer.timeout.connect(redraw)
     
     if MODE == "dynamic":
         #runs a simple animation if you set dynamic mode.
-        timer.start(MOTION_UPDATE_TIMESTEP)
-        landmark_timer.start(LANDMARK_DETECTION_TIMESTEP)
+        worker.start()
+        timer.start(REDRAW_INTERVAL)
+        app.aboutToQuit.connect(worker.stop)
 
     # We have to attach clouds to our view individually.
        
@@ -6,16 +6,90 @@ This is the main particles class. Its used to model the pose and landmarks detec
 import numpy as np
 from numpy import sin, cos
 import time
+from dataclasses import dataclass
 from typing import Union, Optional
-import matplotlib.pyplot as plt
-import time
-
+import numba_kernels
+from data_association import (
+    LandmarkGrid,
+    DEFAULT_CELL_SIZE,
+    DEFAULT_CHI_SQUARED_VALUE,
+    DEFAULT_CONFIDENCE_THRESHOLD,
+    chi_squared_value,
+)
+from motion_models import (
+    MotionModel, MotionBuffers, VelocityMotionModel, OdometryMotionModel, integrate_arc
+)
+from shared_particles import SharedParticleMemory, bind_attached
+from map_storage import (
+    storage_shapes, particle_axes, slot_axes, particle_rows, gather_particles, landmark_view, covariance_view
+)
+from instrumentation import Instrumentation, PARTICLE_STAGES
 
-np.set_printoptions(suppress=True, precision=5)
 
 NUMBER_OF_PARTICLES = 50
 TIMESTEP = 0.01
 NUMBER_OF_LANDMARKS = 50
+DEFAULT_RESAMPLING_METHOD = "systematic"
+
+# When we run out of landmark slots, the arrays grow by this factor, rounded up to a whole chunk.
+LANDMARK_GROWTH_FACTOR = 2
+LANDMARK_CHUNK_SIZE = 16
+
+
+@dataclass
+class ResampleBuffers:
+    """Scratch space used to generate resampling indices without reallocating every step.
+
+    positions: the sorted pointers into the cumulative weight "wheel". There is one per particle drawn.
+    cumulative: cumulative sum of the (normalised) importance factors.
+    particle_range: 0, 1, ... N-1 as floats, used to space out pointers.
+    indices: the drawn particle indices. The resamplers fill this in place and return it, so it's only
+        valid until the next resample.
+
+    Systematic, stratified and multinomial resampling draw len(positions) particles, so positions can be
+    shorter or longer than the weights when the particle count changes (see AdaptiveParticles)."""
+    positions: np.ndarray
+    cumulative: np.ndarray
+    particle_range: np.ndarray
+    indices: np.ndarray
+
+    @classmethod
+    def allocate(cls, number_of_particles: int) -> "ResampleBuffers":
+        return cls(
+            np.empty(number_of_particles),
+            np.empty(number_of_particles),
+            np.arange(number_of_particles, dtype=np.float64),
+            np.empty(number_of_particles, dtype=np.intp),
+        )
+
+
+@dataclass
+class MeasurementBuffers:
+    """Scratch space for Particles.measurement_update().
+
+    Every (N,) array here is a per-particle value of a 2x2 matrix entry, so the whole
+    EKF update can be written as closed form ufuncs with out= set. The names follow
+    the maths in measurement_update."""
+    measured: np.ndarray
+    innovation: np.ndarray
+    cos_2phi: np.ndarray
+    sin_2phi: np.ndarray
+    s00: np.ndarray
+    s01: np.ndarray
+    s11: np.ndarray
+    det: np.ndarray
+    k00: np.ndarray
+    k01: np.ndarray
+    k10: np.ndarray
+    k11: np.ndarray
+    scratch: np.ndarray
+
+    @classmethod
+    def allocate(cls, number_of_particles: int) -> "MeasurementBuffers":
+        pairs = [np.empty((number_of_particles, 2)) for _ in range(2)]
+        singles = [np.empty(number_of_particles) for _ in range(11)]
+        return cls(*pairs, *singles)
+
 
 class Particles:
     """A class that holds informatiom about a particle set.
@@ -30,19 +104,80 @@ class Particles:
         number_of_particles: int,
         initial_pose: np.ndarray,
         initial_error: Optional[np.ndarray] = None,
-        max_landmarks: int = NUMBER_OF_LANDMARKS
+        max_landmarks: int = NUMBER_OF_LANDMARKS,
+        seed: Optional[int] = None,
+        association_cell_size: float = DEFAULT_CELL_SIZE,
+        landmark_cap: Optional[int] = None,
+        motion_model: Optional[MotionModel] = None,
+        shared_memory_name: Optional[str] = None,
+        dtype: Optional[np.dtype] = None,
+        packed_covariance: bool = False
     ):
         # Setting info about the 
         self.number_of_particles = number_of_particles
+
+        # How many particles the arrays have room for. Only AdaptiveParticles uses fewer than this.
+        self.particle_capacity = number_of_particles
+
+        # The model predict() uses to move the particles. See motion_models.py.
+        self.motion_model = motion_model
         self.observed_landmarks = 0
         self.observed_covariances = 0
+
+        # Goes up by one every time the arrays change, so the viewer can skip redrawing when nothing has moved.
+        self.version = 0
+
+        # Set by enable_instrumentation. None means nothing is being timed (and nothing is wrapped).
+        self.instrumentation = None
+
+        """max_landmarks is how many landmark slots we allocate up front. If the map gets
+        bigger than that, the arrays grow (see _grow_landmark_arrays), so max_landmarks is
+        always the current number of slots, not a hard limit.
+
+        landmark_cap is the hard limit. Once the map reaches it, adding a landmark evicts
+        the one with the lowest Tau (landmark_likelihood) and reuses its slot."""
+        self.landmark_cap = landmark_cap
+        if landmark_cap is not None:
+            max_landmarks = min(max_landmarks, landmark_cap)
         self.max_landmarks = max_landmarks
 
-        # Creates a numpy array where each particle has the same pose.
-        self.poses = np.tile(initial_pose, (number_of_particles, 1))
+        # Landmarks whose covariance hasn't been written yet, in the order they were added.
+        self._slots_missing_covariance = []
+
+        # Every random draw made by the particle set goes through this generator,
+        # so passing a seed makes a whole run reproducible.
+        self.rng = np.random.default_rng(seed)
+
+        """By default poses and importance_factors are float64 and the map is float32. Passing dtype
+        uses it for everything instead (float32 halves the pose memory, float64 makes the map exact).
+        packed_covariance stores each symmetric covariance as 3 numbers instead of 4, in a structure of
+        arrays layout. landmarks and covariance still look the same either way, see map_storage.py.
+        The scratch buffers stay float64, so the maths is always done at full precision."""
+        self.pose_dtype = np.dtype(np.float64 if dtype is None else dtype)
+        self.map_dtype = np.dtype(np.float32 if dtype is None else dtype)
+        self.packed_covariance = packed_covariance
 
-        # Initialises weights, These are set to 1/Number of particles.
-        self.importance_factors = np.repeat(1 / number_of_particles, number_of_particles)
+        """If shared_memory_name is given, poses, importance_factors and the landmark arrays live in
+        shared memory under that name, so another process can map them with Particles.attach.
+        See shared_particles.py. _live_poses and _live_map say which of the two copies gather has
+        left live, so the other process knows which one to read."""
+        self._shared = None
+        self._live_poses = 0
+        self._live_map = 0
+        if shared_memory_name is not None:
+            self._shared = SharedParticleMemory.create(
+                shared_memory_name, number_of_particles, self.pose_dtype
+            )
+            self.poses, self._spare_poses = self._shared.poses
+            self.importance_factors = self._shared.importance_factors
+        else:
+            self.poses = np.empty((number_of_particles, 3), self.pose_dtype)
+            self._spare_poses = np.empty_like(self.poses)
+            self.importance_factors = np.empty(number_of_particles, self.pose_dtype)
+
+        # Every particle starts at the same pose, with weights set to 1/Number of particles.
+        self.poses[:] = initial_pose
+        self.importance_factors.fill(1 / number_of_particles)
 
         """These variables set up the underlying memory accessed by views later on,
         
@@ -52,40 +187,99 @@ class Particles:
         a view instead of finding more data. This saves a lot of time during operation,
         however, it means that the numbers inside these attributes can be UNINITIALISED
         Please dont use these if you don't know exactly what youre doing with then."""
-        self.__landmark_estimate_array = np.empty(
-            (number_of_particles, max_landmarks, 2), np.float32
-        )
-
-        # This array stores Tau in Truns book probabalistic Robotics.
-        self.__landmark_likelihood_array = np.empty(
-            (number_of_particles, max_landmarks), np.float32
-        )   
-        
-        # Creating covariance array estimate
-        self.__covariance_array = np.empty(
-            (number_of_particles, max_landmarks, 2, 2), np.float32
-        )
+        self._allocate_landmark_arrays(max_landmarks)
 
         #  creating numpy views that let us access data stored in empty arrays.
-        self.landmarks = self.__landmark_estimate_array[:0]
-        self.covariance = self.__covariance_array[:0]
-        self.landmark_likelihood = self.__landmark_likelihood_array[:0]
+        self._rebind_views()
+
+        self._resample_buffers = ResampleBuffers.allocate(number_of_particles)
+        self._measurement_buffers = MeasurementBuffers.allocate(number_of_particles)
+        self._motion_buffers = MotionBuffers.allocate(number_of_particles)
+        self._motion_sequence_buffers = None
+
+        # Spatial index over the mean position of each landmark, used by associate().
+        self.landmark_grid = LandmarkGrid(association_cell_size)
 
         if initial_error is not None:
-            error = np.random.randn(*self.poses.shape) * initial_error
+            error = self.rng.standard_normal(self.poses.shape) * initial_error
             self.poses += error
 
-        self._particles = [Particle(self, i) for i in range(number_of_particles)] #should we make this into an __index__ thing instead?
+        self._publish_shared()
+
+    @classmethod
+    def attach(cls, shared_memory_name: str) -> "Particles":
+        """Maps a Particles object that another process made with shared_memory_name, without copying it.
+
+        The result is read-only: poses, importance_factors, landmarks, landmark_likelihood and covariance
+        all work, but anything that changes them (predict, resample...) will fail. Call refresh to pick up
+        the owner's latest state, e.g. once per frame in a viewer, and close when you're done."""
+        particles = cls.__new__(cls)
+        particles._shared = SharedParticleMemory.attach(shared_memory_name)
+        particles.version = -1
+        particles.motion_model = None
+        particles.landmark_cap = None
+        particles.instrumentation = None
+
+        if not particles.refresh():
+            particles.close()
+            raise RuntimeError(
+                f"particles in {shared_memory_name!r} aren't ready to read, try again shortly."
+            )
+
+        return particles
+
+    @property
+    def shared_memory_name(self) -> Optional[str]:
+        """The name to pass to Particles.attach, or None if these particles aren't in shared memory."""
+        return None if self._shared is None else self._shared.name
+
+    def refresh(self) -> bool:
+        """For particles made with attach: points poses, landmarks etc. at the owner's latest state.
+
+        Returns False if nothing changed (or the owner was half way through publishing), so there's
+        nothing to redraw. The owner's particles are always up to date, so for them it does nothing."""
+        if self._shared is None or self._shared.owner:
+            return False
+
+        return bind_attached(self, self._shared)
+
+    def close(self) -> None:
+        """Releases the shared memory. The owner also unlinks it, so call close on the owner last."""
+        if self._shared is None:
+            return
+
+        self.poses = self._spare_poses = self.importance_factors = None
+        self._bind_landmark_arrays(None, None, None)
+        self.__spare_landmark_estimate_array = None
+        self.__spare_landmark_likelihood_array = None
+        self.__spare_covariance_array = None
+        self._shared.close()
+        self._shared = None
 
     def __str__(self):
         output = f"number of particles:\t{self.number_of_particles}\n"
-        output += f"variance of particles: {np.std(self.poses, axis=0)}\n"
+        with np.printoptions(suppress=True, precision=5):
+            output += f"variance of particles: {np.std(self.poses, axis=0)}\n"
 
         return output
 
     def __getitem__(self, index):
         #get item is designed to return a Particle. This is the most obvious return from particles. If you disagree with this, please let me know why!
-        return Particle(self, index)
+        # Slices, boolean masks and index arrays give a ParticleSubset instead, over the same arrays.
+        if isinstance(index, slice):
+            return ParticleSubset(self, index)
+
+        if isinstance(index, (int, np.integer)):
+            if not -self.number_of_particles <= index < self.number_of_particles:
+                raise IndexError(f"particle {index} is out of range for {self.number_of_particles} particles.")
+            return Particle(self, int(index) % self.number_of_particles)
+
+        index = np.asarray(index)
+        if index.dtype == bool:
+            if index.shape != (self.number_of_particles,):
+                raise IndexError(f"a mask needs {self.number_of_particles} entries, not {index.shape}.")
+            index = np.flatnonzero(index)
+        return ParticleSubset(self, index.astype(np.intp, copy=False))
     
     def __iter__(self):
         for i in range(self.number_of_particles):
@@ -95,38 +289,619 @@ class Particles:
         pose = self.poses[particle_index, :]
         return pose
     
+    def _map_rows(self, name: str, index) -> np.ndarray:
+        """Returns rows index of the landmarks, covariance or landmark_likelihood array (picked by name).
+
+        Particle and ParticleSubset read the map through this, so subclasses that have to build those arrays
+        (like SharedMapParticles) can build just the rows that were asked for."""
+        return getattr(self, name)[index]
+
     def get_landmark_positions(self, landmark_index):
         """Returns all positions of a specific landmark"""
         return self.landmarks[:, landmark_index, :].reshape(NUMBER_OF_PARTICLES, 2)
     
+    def _allocate_landmark_arrays(self, capacity: int) -> None:
+        """Allocates the underlying landmark arrays (and their spare copies) with room for capacity landmarks."""
+        if self._shared is not None:
+            self._shared.allocate_map(capacity, self.map_dtype, self.packed_covariance)
+            self.__landmark_estimate_array, self.__spare_landmark_estimate_array = self._shared.landmarks
+            self.__landmark_likelihood_array, self.__spare_landmark_likelihood_array = (
+                self._shared.landmark_likelihood
+            )
+            self.__covariance_array, self.__spare_covariance_array = self._shared.covariance
+            self._live_map = 0
+            return
+
+        landmark_shape, likelihood_shape, covariance_shape = storage_shapes(
+            self.particle_capacity, capacity, self.packed_covariance
+        )
+        self.__landmark_estimate_array = np.empty(landmark_shape, self.map_dtype)
+
+        # This array stores Tau in Truns book probabalistic Robotics.
+        self.__landmark_likelihood_array = np.empty(likelihood_shape, self.map_dtype)
+
+        # Creating covariance array estimate
+        self.__covariance_array = np.empty(covariance_shape, self.map_dtype)
+
+        """Resampling gathers every particle's state into a second copy of each array,
+        then swaps the two. Having the spare arrays ready means resample() never has
+        to ask for new memory, which keeps its run time the same every cycle."""
+        self.__spare_landmark_estimate_array = np.empty_like(self.__landmark_estimate_array)
+        self.__spare_landmark_likelihood_array = np.empty_like(self.__landmark_likelihood_array)
+        self.__spare_covariance_array = np.empty_like(self.__covariance_array)
+
+    def _grow_landmark_arrays(self, required: int) -> None:
+        """Makes room for at least required landmarks (up to landmark_cap).
+
+        The arrays grow geometrically, so over a whole run the number of reallocations is
+        log(map size) and the average cost per added landmark stays constant. It's still a
+        copy of the whole map, so if you know roughly how big the map gets, set max_landmarks
+        and this will never run in the main loop."""
+        new_capacity = max(required, int(self.max_landmarks * LANDMARK_GROWTH_FACTOR))
+        new_capacity = -(-new_capacity // LANDMARK_CHUNK_SIZE) * LANDMARK_CHUNK_SIZE
+        if self.landmark_cap is not None:
+            new_capacity = min(new_capacity, self.landmark_cap)
+        if new_capacity <= self.max_landmarks:
+            return
+
+        self._resize_landmark_arrays(new_capacity)
+
+    def _resize_landmark_arrays(self, new_capacity: int) -> None:
+        """Moves the map into new arrays with room for new_capacity landmarks."""
+        old_landmarks, old_covariance = self.landmarks, self.covariance
+        old_likelihood = self.landmark_likelihood
+
+        self._allocate_landmark_arrays(new_capacity)
+        self.max_landmarks = new_capacity
+        self._rebind_views()
+
+        self.landmarks[...] = old_landmarks
+        self.covariance[...] = old_covariance
+        self.landmark_likelihood[...] = old_likelihood
+
+    def _least_likely_landmarks(self, count: int) -> np.ndarray:
+        """Returns the slots of the count landmarks with the lowest mean Tau across all particles."""
+        mean_tau = self.landmark_likelihood.mean(axis=0)
+        return np.argpartition(mean_tau, count - 1)[:count]
+
+    def _claim_landmark_slots(self, count: int) -> Union[slice, np.ndarray]:
+        """Finds room for count new landmarks and extends the views over them.
+
+        Returns a slice when the new landmarks are on the end of the map (the normal case),
+        or an index array when some of them replace evicted landmarks."""
+        if self.landmark_cap is not None and count > self.landmark_cap:
+            raise IndexError(
+                f"can't add {count} landmarks at once, landmark_cap is {self.landmark_cap}."
+            )
+
+        array_start = self.observed_landmarks
+        array_end = array_start + count
+        if array_end > self.max_landmarks:
+            self._grow_landmark_arrays(array_end)
+
+        if array_end <= self.max_landmarks:
+            self.observed_landmarks = array_end
+            self._rebind_views()
+            return slice(array_start, array_end)
+
+        # We're at the cap: fill whatever is left on the end, then reuse evicted slots.
+        evicted = self._least_likely_landmarks(array_end - self.max_landmarks)
+        self._slots_missing_covariance = [
+            slot for slot in self._slots_missing_covariance if slot not in evicted
+        ]
+        self.observed_landmarks = self.max_landmarks
+        self._rebind_views()
+
+        return np.concatenate((np.arange(array_start, self.max_landmarks), evicted))
+
     def add_landmark(self, landmark_positions) -> None:
         """Increases the number of visible landmarks by one.
 
-        TODO: Implement a way to define the noise profile of a landmark."""        
-        array_size = min(self.observed_landmarks, self.max_landmarks)
-        array_end = array_size + 1 
-        # Update view to add a new landmark.
-        self.landmarks = self.__landmark_estimate_array[:, :array_end, :]
+        TODO: Implement a way to define the noise profile of a landmark."""
+        self.add_landmarks(np.asarray(landmark_positions)[..., None, :])
+
+    def add_landmarks(
+        self,
+        landmark_positions: np.ndarray,
+        covariance_matrices: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Adds M landmarks at once, for example every new cone in a lidar scan.
+
+        Args:
+            landmark_positions: (N, M, 2) position of each landmark for each particle
+                (see get_landmark_offsets), or (M, 2) if every particle agrees.
+            covariance_matrices: Optional. If given, these are passed to add_covariances,
+                so it can be (M, 2, 2) or (N, M, 2, 2).
+
+        Returns:
+            The M landmark indices the new landmarks were stored at. These are on the end
+            of the map, unless landmark_cap has been reached and old landmarks were evicted.
+
+        This is one slice assignment however many landmarks there are, rather than M calls to add_landmark."""
+        number_added = landmark_positions.shape[-2]
+        array_start = self.observed_landmarks
+        slots = self._claim_landmark_slots(number_added)
+        if isinstance(slots, slice):
+            slot_indices = np.arange(array_start, self.observed_landmarks)
+        else:
+            slot_indices = slots
+
+        self._write_new_landmarks(slots, landmark_positions)
+        self._index_new_landmarks(slot_indices, self.observed_landmarks - array_start)
+
+        self._slots_missing_covariance.extend(slot_indices.tolist())
+        if covariance_matrices is not None:
+            self.add_covariances(covariance_matrices)
+
+        self.mark_changed()
+
+        return slot_indices
 
-        # Set landmark position according to each particle.
-        self.landmarks[:, self.observed_landmarks] = landmark_positions
-        self.observed_landmarks += 1
+    def _index_new_landmarks(self, slot_indices: np.ndarray, appended: int) -> None:
+        """Adds freshly written landmarks to landmark_grid. The first appended slots are on the end of the map."""
+        # Slots on the end of the map are new to the grid, reused slots just move.
+        new_means = self._landmark_means(slot_indices)
+        self.landmark_grid.insert_many(new_means[:appended])
+        for slot, mean in zip(slot_indices[appended:], new_means[appended:]):
+            self.landmark_grid.move(int(slot), mean)
+
+    def _write_new_landmarks(
+        self, slots: Union[slice, np.ndarray], landmark_positions: np.ndarray
+    ) -> None:
+        """Stores freshly added landmarks in slots (a slice if they are on the end of the map)."""
+        # Set landmark positions according to each particle.
+        self.landmarks[:, slots] = landmark_positions
+
+        # Tau starts at one, we've seen each landmark once.
+        self.landmark_likelihood[:, slots] = 1
+
+    def _landmark_means(self, landmark_indices=None) -> np.ndarray:
+        """Mean position of landmarks across all particles. These are what landmark_grid indexes.
+
+        Returns every observed landmark if landmark_indices isn't given."""
+        if landmark_indices is None:
+            return self.landmarks.mean(axis=0)
+        return self.landmarks[:, landmark_indices].mean(axis=0)
 
     def update_landmark(
         self, landmark_index: int, landmark_position: np.ndarray
     ) -> None:
         self.landmarks[:, landmark_index, :] = landmark_position
+        self.landmark_grid.move(landmark_index, self._landmark_means(landmark_index))
+        self.mark_changed()
 
     def add_covariance(self, covariance_matrix: np.ndarray) -> None:
-        array_size = min(self.observed_covariances, self.max_landmarks)
-        array_end = array_size + 1
-        self.covariance = self.__covariance_array[:, :array_end, :, :]
-        self.covariance[:, self.observed_covariances] = covariance_matrix
-        self.observed_covariances += 1
+        self.add_covariances(np.asarray(covariance_matrix)[..., None, :, :])
+
+    def add_covariances(self, covariance_matrices: np.ndarray) -> None:
+        """Adds M covariance matrices at once. Takes (M, 2, 2) if every particle shares them, or (N, M, 2, 2).
+
+        Covariances are matched up with the landmarks that don't have one yet, in the order
+        those landmarks were added, so add the landmarks first."""
+        number_added = covariance_matrices.shape[-3]
+        if number_added > len(self._slots_missing_covariance):
+            raise IndexError(
+                f"can't add {number_added} covariances, only "
+                f"{len(self._slots_missing_covariance)} landmarks are waiting for one."
+            )
+
+        slots = self._slots_missing_covariance[:number_added]
+        del self._slots_missing_covariance[:number_added]
+
+        self.observed_covariances = max(self.observed_covariances, max(slots) + 1)
+        self._write_covariances(slots, covariance_matrices)
+        self.mark_changed()
+
+    def _write_covariances(self, slots: list, covariance_matrices: np.ndarray) -> None:
+        """Stores covariances for the landmarks in slots. observed_covariances has already been updated."""
+        number_added = len(slots)
+        self._rebind_views()
+        if slots == list(range(slots[0], slots[0] + number_added)):
+            self.covariance[:, slots[0]:slots[0] + number_added] = covariance_matrices
+        else:
+            self.covariance[:, slots] = covariance_matrices
 
     def update_covariance(self, landmark_index, covariance_matrix) -> None:
-        self.landmarks[:, landmark_index] = covariance_matrix
-    
+        self.covariance[:, landmark_index] = covariance_matrix
+        self.mark_changed()
+
+    def measurement_update(
+        self,
+        landmark_index: int,
+        polar_measurement: np.ndarray,
+        sensor_noise_cov: np.ndarray
+    ) -> None:
+        """Runs the fastSLAM EKF correction for one observed landmark, for every particle at once.
+
+        Args:
+            landmark_index: the landmark that was observed. It must already have been added.
+            polar_measurement: [r, theta], range and bearing to the landmark relative to the car.
+            sensor_noise_cov: 2x2 covariance matrix in polar coordinates (R matrix)
+
+        Writes to landmarks[:, landmark_index], covariance[:, landmark_index],
+        landmark_likelihood[:, landmark_index] (Tau goes up by one) and multiplies each
+        particles importance factor by how likely the measurement was for that particle.
+
+        How it works:
+        The measurement is turned into a cartesian landmark position for each particle with
+        get_landmark_offset, and the sensor noise is moved into cartesian space using the
+        same jacobian as get_landmark_cov. Because that jacobian is invertible, the EKF update
+        from Probabilistic Robotics (Table 13.1) becomes a plain kalman update with H = I:
+
+            S = Σ + R_xy          (innovation covariance)
+            K = Σ S^-1            (kalman gain)
+            μ = μ + K (z_xy - μ)
+            Σ = Σ - K Σ
+            w = N(z_xy - μ; 0, S)
+
+        Doing it in cartesian space means we never have to wrap angles in the innovation.
+        The only difference from the polar likelihood is a factor of r, which is the same
+        for every particle and disappears when the importance factors are normalised.
+
+        Every 2x2 matrix is symmetric, so each one is stored as three (N,) arrays and
+        the inverse and products are written out in closed form. All temporaries live in
+        self._measurement_buffers, so this doesn't allocate anything per call. If numba is
+        installed, the same maths runs one particle at a time in numba_kernels.ekf_update."""
+        buffers = self._measurement_buffers
+        r, bearing = polar_measurement[0], polar_measurement[1]
+        mean, sigma, tau = self._landmark_column(landmark_index)
+
+        half_sum, half_diff, off_diagonal = self._stretched_noise_terms(r, sensor_noise_cov)
+
+        _ekf_update(
+            self.poses, r, bearing, half_sum, half_diff, off_diagonal,
+            mean, sigma, self.importance_factors, buffers
+        )
+
+        tau += 1
+        self._store_landmark_column(landmark_index, mean, sigma, tau)
+        self.landmark_grid.move(landmark_index, mean.mean(axis=0))
+        self.mark_changed()
+
+    def _landmark_column(self, landmark_index: int) -> tuple:
+        """Returns writeable (N, 2) mean, (N, 2, 2) covariance and (N,) Tau arrays for one landmark.
+
+        For this class they are views, so writing to them updates the map directly."""
+        return (
+            self.landmarks[:, landmark_index],
+            self.covariance[:, landmark_index],
+            self.landmark_likelihood[:, landmark_index],
+        )
+
+    def _store_landmark_column(
+        self, landmark_index: int, mean: np.ndarray, sigma: np.ndarray, tau: np.ndarray
+    ) -> None:
+        """Saves a column returned by _landmark_column. Nothing to do here, we wrote through views."""
+        pass
+
+    def associate(
+        self,
+        polar_detections: np.ndarray,
+        sensor_noise_cov: np.ndarray,
+        gate: float = DEFAULT_CHI_SQUARED_VALUE
+    ) -> np.ndarray:
+        """Finds the most likely landmark for each detection, separately for every particle.
+
+        Args:
+            polar_detections: (M, 2) array of [r, θ] detections.
+            sensor_noise_cov: (2, 2) R matrix, or (M, 2, 2).
+            gate: Any match with a squared mahalanobis distance above this is thrown out.
+                The default is the 95% chi-squared value for 2 degrees of freedom.
+
+        Returns:
+            (N, M) array of landmark indices. -1 means the detection didn't match anything
+            for that particle, so it's probably a new landmark.
+
+        Only landmarks near each detection (found using landmark_grid) are tested, so this
+        is O(N·M·K) where K is a handful of nearby landmarks, instead of O(N·M·L).
+        The best match is the one with the lowest -2 log likelihood: d^T S^-1 d + log|S|.
+        Two detections can pick the same landmark for the same particle."""
+        number_of_detections = polar_detections.shape[0]
+        associations = np.full(
+            (self.number_of_particles, number_of_detections), -1, dtype=np.intp
+        )
+        known_landmarks = min(self.observed_landmarks, self.observed_covariances)
+        if known_landmarks == 0 or number_of_detections == 0:
+            return associations
+
+        measured = get_landmark_offsets(self, polar_detections)
+        measured += self.poses[:, None, :2]
+        sensor_cov = self._landmark_covariances(polar_detections, sensor_noise_cov)
+
+        # (M, K) nearby landmarks for each detection, padded with -1.
+        candidates = self.landmark_grid.candidates(measured.mean(axis=0))
+        if candidates.shape[1] == 0:
+            return associations
+        padding = (candidates < 0) | (candidates >= known_landmarks)
+        safe_candidates = np.where(padding, 0, candidates)
+
+        # Everything from here is (N, M, K).
+        candidate_landmarks, candidate_covariance = self._candidate_landmarks(safe_candidates)
+        difference = measured[:, :, None, :] - candidate_landmarks
+        innovation_cov = sensor_cov[:, :, None] + candidate_covariance
+        s00 = innovation_cov[..., 0, 0]
+        s01 = (innovation_cov[..., 0, 1] + innovation_cov[..., 1, 0]) / 2
+        s11 = innovation_cov[..., 1, 1]
+        dx, dy = difference[..., 0], difference[..., 1]
+
+        det = s00 * s11 - s01 * s01
+        distance = (s11 * dx * dx - 2 * s01 * dx * dy + s00 * dy * dy) / det
+
+        cost = distance + np.log(det)
+        cost[(distance > gate) | padding] = np.inf
+
+        best = np.argmin(cost, axis=2)
+        best_cost = np.take_along_axis(cost, best[..., None], axis=2)[..., 0]
+        matched = np.isfinite(best_cost)
+        associations[matched] = candidates[
+            np.broadcast_to(np.arange(number_of_detections), best.shape)[matched],
+            best[matched]
+        ]
+
+        return associations
+
+    def _landmark_covariances(self, polar_detections: np.ndarray, sensor_noise_cov: np.ndarray) -> np.ndarray:
+        """get_landmark_covs rotated by every particle's heading, so (N, M, 2, 2).
+
+        This and _stretched_noise_terms are methods, rather than calls straight to the module functions, so
+        enable_instrumentation can time them as the covariance_transform stage."""
+        return get_landmark_covs(polar_detections, sensor_noise_cov, self.poses[:, 2])
+
+    def _stretched_noise_terms(self, r: float, sensor_noise_cov: np.ndarray) -> tuple:
+        return stretched_noise_terms(r, sensor_noise_cov)
+
+    def _candidate_landmarks(self, landmark_indices: np.ndarray) -> tuple:
+        """Gathers the landmark means and covariances at an array of landmark indices, for every particle."""
+        return self.landmarks[:, landmark_indices], self.covariance[:, landmark_indices]
+
+    def predict(
+        self,
+        control: np.ndarray,
+        timestep: float,
+        model: Optional[MotionModel] = None
+    ) -> None:
+        """Moves every particle using a motion model. This writes straight into self.poses.
+
+        Args:
+            control: the motion command. What this is depends on the model, e.g. (v, ω) for
+                VelocityMotionModel or (v, δ) for BicycleMotionModel.
+            timestep: time since the last prediction, in seconds.
+            model: Optional. The model to use for this call instead of self.motion_model.
+
+        All the noise is drawn from self.rng in one block and every temporary lives in
+        self._motion_buffers, so nothing is allocated per call."""
+        if model is None:
+            model = self.motion_model
+        if model is None:
+            raise ValueError("No motion model set. Pass one to Particles() or to predict().")
+
+        model.predict(self.poses, control, timestep, self.rng, self._motion_buffers)
+        self.mark_changed()
+
+    def predict_sequence(
+        self,
+        controls: np.ndarray,
+        timesteps,
+        trajectory: Optional[np.ndarray] = None,
+        model: Optional[MotionModel] = None
+    ) -> None:
+        """Moves every particle through a whole sequence of K controls at once, e.g. a frame's worth of odometry.
+
+        This gives the same result as calling predict K times, but does it in one vectorised sweep.
+
+        Args:
+            controls: (K, 2) array of controls for the velocity and bicycle models. The odometry model takes
+                (K + 1, 3) odometry poses instead.
+            timesteps: (K,) array of how long each control was applied for, or a single float.
+            trajectory: Optional (K, N, 3) array. If given, the poses after every step are written into it.
+            model: Optional. The model to use for this call instead of self.motion_model.
+
+        The buffers for K steps are kept between calls and only grow when a longer sequence turns up."""
+        if model is None:
+            model = self.motion_model
+        if model is None:
+            raise ValueError("No motion model set. Pass one to Particles() or to predict_sequence().")
+
+        number_of_steps = len(controls)
+        if isinstance(model, OdometryMotionModel):
+            number_of_steps -= 1
+        if number_of_steps < 1:
+            return
+
+        model.predict_sequence(
+            self.poses,
+            controls,
+            timesteps,
+            self.rng,
+            self._sequence_buffers(number_of_steps),
+            trajectory,
+        )
+        self.mark_changed()
+
+    def _sequence_buffers(self, number_of_steps: int) -> MotionBuffers:
+        """Views of K step motion buffers. The storage doubles whenever a longer sequence is asked for."""
+        capacity = 0
+        if self._motion_sequence_buffers is not None:
+            capacity = self._motion_sequence_buffers.chord.shape[0]
+
+        if number_of_steps > capacity:
+            capacity = max(number_of_steps, 2 * capacity)
+            self._motion_sequence_buffers = MotionBuffers.allocate(self.particle_capacity, capacity)
+
+        return self._motion_sequence_buffers.shaped(self.number_of_particles, number_of_steps)
+
+    def normalise_importance_factors(self) -> None:
+        """Scales the importance factors so they sum to one, in place.
+
+        If every weight has collapsed to zero we reset to uniform weights rather than divide by zero."""
+        total = self.importance_factors.sum()
+        if total > 0 and np.isfinite(total):
+            self.importance_factors /= total
+        else:
+            self.importance_factors.fill(1 / self.number_of_particles)
+
+    def effective_sample_size(self) -> float:
+        """Returns 1 / sum(w^2) of the normalised importance factors.
+
+        This is N when every particle has the same weight, and 1 when a single particle holds all of it."""
+        total = self.importance_factors.sum()
+        squared_total = np.dot(self.importance_factors, self.importance_factors)
+        if squared_total == 0:
+            return 0.
+        return float(total * total / squared_total)
+
+    def resample(
+        self,
+        method: str = DEFAULT_RESAMPLING_METHOD,
+        ess_threshold: Optional[float] = None
+    ) -> bool:
+        """Draws a new particle set from the current one, in proportion to the importance factors.
+
+        Args:
+            method: one of the keys in RESAMPLING_METHODS ("systematic", "stratified", "residual", "multinomial").
+            ess_threshold: If set, only resample when effective_sample_size() drops below
+                ess_threshold * number_of_particles. 0.5 is a common choice.
+
+        Returns:
+            True if the particles were resampled.
+
+        Every array is gathered into the spare arrays set up in __init__, and then the spare
+        and live arrays are swapped. Only the observed landmarks are gathered (see
+        map_storage.gather_particles), so the cost grows with the map, not with max_landmarks.
+
+        The views (landmarks, covariance...) are rebuilt after the swap, so don't hold onto
+        old views across a resample call!"""
+        if ess_threshold is not None:
+            if self.effective_sample_size() >= ess_threshold * self.number_of_particles:
+                return False
+
+        self.normalise_importance_factors()
+        indices = RESAMPLING_METHODS[method](
+            self.importance_factors, self.rng, self._resample_buffers
+        )
+        self.gather(indices)
+        self.importance_factors.fill(1 / self.number_of_particles)
+
+        return True
+
+    def gather(self, indices: np.ndarray) -> None:
+        """Replaces particle i with particle indices[i] for every array we store.
+
+        This is the step shared by every resampling method. mode="clip" stops numpy from
+        buffering the output, and means we never index out of bounds."""
+        np.take(self.poses, indices, axis=0, out=self._spare_poses, mode="clip")
+        self._gather_maps(indices)
+        self._swap_spare_arrays()
+
+        # Landmark means shift when particles are duplicated, so re-index them.
+        self.landmark_grid.move_all(self._landmark_means())
+        self.mark_changed()
+
+    def enable_instrumentation(self, instrumentation: Optional[Instrumentation] = None) -> Instrumentation:
+        """Starts recording how long predict, landmark insertion, measurement updates etc. take.
+
+        See instrumentation.py. Pass the same Instrumentation to the viewer to get everything in one place.
+        Returns the Instrumentation, so you can call stats or summary on it."""
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+
+        self.disable_instrumentation()
+        instrumentation.instrument(self, PARTICLE_STAGES)
+        self.instrumentation = instrumentation
+
+        return instrumentation
+
+    def disable_instrumentation(self) -> None:
+        """Stops recording. The methods go back to the plain ones, so there's no overhead at all."""
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            instrumentation.uninstrument(self)
+        self.instrumentation = None
+
+    def mark_changed(self) -> None:
+        """Bumps self.version. Every Particles method that changes the arrays calls this for you,
+        but if you write to poses, landmarks or covariance yourself, call it so the viewer redraws."""
+        self.version += 1
+        self._publish_shared()
+
+    def _publish_shared(self) -> None:
+        """Tells processes attached to our shared memory (if any) about the current sizes and live buffers."""
+        if self._shared is None:
+            return
+
+        self._shared.publish(
+            version=self.version,
+            number_of_particles=self.number_of_particles,
+            capacity=self.max_landmarks,
+            observed_landmarks=self.observed_landmarks,
+            observed_covariances=self.observed_covariances,
+            live_poses=self._live_poses,
+            live_map=self._live_map,
+        )
+
+    def _gather_maps(self, indices: np.ndarray) -> None:
+        """Gathers every particle's map into the spare arrays. _swap_spare_arrays swaps them in."""
+        count = len(indices)
+        observed = (self.observed_landmarks, self.observed_landmarks, self.observed_covariances)
+        for storage, spare, particle_axis, slot_axis, used in zip(
+            (self.__landmark_estimate_array, self.__landmark_likelihood_array, self.__covariance_array),
+            (
+                self.__spare_landmark_estimate_array, self.__spare_landmark_likelihood_array,
+                self.__spare_covariance_array
+            ),
+            particle_axes(self.packed_covariance), slot_axes(self.packed_covariance), observed
+        ):
+            gather_particles(
+                storage, indices, particle_rows(spare, particle_axis, count), particle_axis, slot_axis, used
+            )
+
+    def _swap_spare_arrays(self) -> None:
+        """Makes the spare arrays (filled by a gather) live, and the old live arrays the new spares."""
+        self.poses, self._spare_poses = self._spare_poses, self.poses
+        self._live_poses ^= 1
+        self._swap_spare_maps()
+
+    def _swap_spare_maps(self) -> None:
+        self.__landmark_estimate_array, self.__spare_landmark_estimate_array = (
+            self.__spare_landmark_estimate_array, self.__landmark_estimate_array
+        )
+        self.__landmark_likelihood_array, self.__spare_landmark_likelihood_array = (
+            self.__spare_landmark_likelihood_array, self.__landmark_likelihood_array
+        )
+        self.__covariance_array, self.__spare_covariance_array = (
+            self.__spare_covariance_array, self.__covariance_array
+        )
+        self._live_map ^= 1
+        self._rebind_views()
+
+    def _rebind_views(self) -> None:
+        """Points our public views back at the underlying arrays. Call this whenever they are swapped or replaced."""
+        landmark_axis, likelihood_axis, covariance_axis = particle_axes(self.packed_covariance)
+        count = self.number_of_particles
+        self.landmarks = landmark_view(
+            particle_rows(self.__landmark_estimate_array, landmark_axis, count),
+            self.observed_landmarks, self.packed_covariance
+        )
+        self.landmark_likelihood = particle_rows(
+            self.__landmark_likelihood_array, likelihood_axis, count
+        )[:, :self.observed_landmarks]
+        self.covariance = covariance_view(
+            particle_rows(self.__covariance_array, covariance_axis, count),
+            self.observed_covariances, self.packed_covariance
+        )
+
+    def _bind_landmark_arrays(
+        self, landmarks: np.ndarray, landmark_likelihood: np.ndarray, covariance: np.ndarray
+    ) -> None:
+        """Swaps in a new set of underlying landmark arrays, e.g. ones mapped from shared memory."""
+        self.__landmark_estimate_array = landmarks
+        self.__landmark_likelihood_array = landmark_likelihood
+        self.__covariance_array = covariance
+        if landmarks is None:
+            self.landmarks = self.landmark_likelihood = self.covariance = None
+        else:
+            self._rebind_views()
+
 
 class Particle:
     """A particle class is how we get information about a single particle from our particles class.
@@ -136,18 +911,26 @@ class Particle:
 
     im setting these up as properties because I want it to be super clear that they are slices of the current information.
 
-    This means that you cant deepcopy a Particle to see where it has gone (i think)"""
+    This means that you cant deepcopy a Particle to see where it has gone (i think)
+
+    It only holds a reference and an index (__slots__, no __dict__), so making one is about as cheap as a tuple.
+    It reads through to the arrays every time, so it stays right after a resample swaps them."""
+    __slots__ = ("_particles", "_index")
+
     def __init__(self, particles_ref: Particles, index):
         self._particles = particles_ref
         self._index = index
-        # In your Particle class
+
+    @property
+    def index(self) -> int:
+        return self._index
     
     @property
     def importance_factor(self):
         return self._particles.importance_factors[self._index]
     
     @importance_factor.setter
-    def importance_factor_setter(self, value):
+    def importance_factor(self, value):
         self._particles.importance_factors[self._index] = value
     
     @property
@@ -160,55 +943,381 @@ class Particle:
     
     @property
     def landmarks(self):
-        return self._particles.landmarks[self._index]
+        return self._particles._map_rows("landmarks", self._index)
     
     @landmarks.setter
-    def landmarks_setter(self, value):
+    def landmarks(self, value):
         self._particles.landmarks[self._index] = value
     
     @property
     def covariances(self):
-        return self._particles.covariance[self._index]
+        return self._particles._map_rows("covariance", self._index)
     
     @covariances.setter
+    def covariances(self, value):
+        self._particles.covariance[self._index] = value
+
     def set_covariance(self, landmark_index, value):
         self._particles.covariance[self._index, landmark_index] = value
 
     @property
     def landmark_likelihood(self):
-        return self._particles.landmarks[self._index]
+        return self._particles._map_rows("landmark_likelihood", self._index)
     
     def __str__(self):
         string = ""
-        string +=  f"index: {self._index}"
-        string += f"importance factor: {self.importance_factor}"
-        string += f"pose: {self.pose}"
+        string += f"index: {self._index}\n"
+        string += f"importance factor: {self.importance_factor}\n"
+        string += f"pose: {self.pose}\n"
         string += f"Landmarks: {self.landmarks}"
+        return string
 
     
     # We dont need a landmarks setter as landmarks[i] already checks for issues.
 
 
+class ParticleSubset:
+    """Some of the particles in a Particles object, made by indexing it with a slice, a boolean mask or an
+    array of indices (particles[::2], particles[particles.importance_factors > 0.01]...).
+
+    It has the same array attributes as Particles (poses, importance_factors, landmarks, landmark_likelihood,
+    covariance), always read from the parent, so it follows resamples and map growth. Clouds can draw it too.
+
+    For a slice they are numpy views, so writes go straight into the parent. For a mask or index array numpy
+    has to copy, so assign to the whole attribute to write back: subset.poses += 1 works, but
+    subset.poses[:, 0] += 1 only changes the copy."""
+    __slots__ = ("parent", "_index")
+
+    def __init__(self, parent: Particles, index):
+        self.parent = parent
+        self._index = index
+
+    @property
+    def indices(self) -> np.ndarray:
+        """The parent's index of every particle in this subset."""
+        if isinstance(self._index, slice):
+            return np.arange(*self._index.indices(self.parent.number_of_particles))
+        return self._index
+
+    @property
+    def number_of_particles(self) -> int:
+        return len(self.indices)
+
+    def __len__(self) -> int:
+        return self.number_of_particles
+
+    def __getitem__(self, index):
+        return self.parent[self.indices[index]]
+
+    def __iter__(self):
+        for index in self.indices:
+            yield Particle(self.parent, index)
+
+    @property
+    def version(self) -> int:
+        return self.parent.version
+
+    @property
+    def observed_landmarks(self) -> int:
+        return self.parent.observed_landmarks
+
+    @property
+    def observed_covariances(self) -> int:
+        return self.parent.observed_covariances
+
+    @property
+    def poses(self) -> np.ndarray:
+        return self.parent.poses[self._index]
+
+    @poses.setter
+    def poses(self, value):
+        self.parent.poses[self._index] = value
+
+    @property
+    def importance_factors(self) -> np.ndarray:
+        return self.parent.importance_factors[self._index]
+
+    @importance_factors.setter
+    def importance_factors(self, value):
+        self.parent.importance_factors[self._index] = value
+
+    @property
+    def landmarks(self) -> np.ndarray:
+        return self.parent._map_rows("landmarks", self._index)
+
+    @landmarks.setter
+    def landmarks(self, value):
+        self.parent.landmarks[self._index] = value
+
+    @property
+    def landmark_likelihood(self) -> np.ndarray:
+        return self.parent._map_rows("landmark_likelihood", self._index)
+
+    @landmark_likelihood.setter
+    def landmark_likelihood(self, value):
+        self.parent.landmark_likelihood[self._index] = value
+
+    @property
+    def covariance(self) -> np.ndarray:
+        return self.parent._map_rows("covariance", self._index)
+
+    @covariance.setter
+    def covariance(self, value):
+        self.parent.covariance[self._index] = value
+
+
+def _search_sorted_numpy(values: np.ndarray, queries: np.ndarray, out: np.ndarray, side: str = "left") -> None:
+    """np.searchsorted, written into out. numpy has no out= for searchsorted, so this still makes one temporary."""
+    np.copyto(out, np.searchsorted(values, queries, side=side))
+
+
+def _search_sorted_numba(values, queries, out, side="left") -> None:
+    """Same as _search_sorted_numpy, using numba_kernels.search_sorted. Nothing is allocated."""
+    numba_kernels.search_sorted(values, queries, side == "right", out)
+
+
+# Picked once, when particles.py is imported.
+_search_sorted = _search_sorted_numba if numba_kernels.USE_NUMBA else _search_sorted_numpy
+
+
+def systematic_resample(
+    weights: np.ndarray, rng: np.random.Generator, buffers: ResampleBuffers
+) -> np.ndarray:
+    """Low variance resampling (Table 4.4 in Probabilistic Robotics).
+
+    One random offset u ~ U[0, 1/N) is drawn, then N evenly spaced pointers (u + i/N) are
+    walked along the cumulative weights. weights must already be normalised."""
+    number_of_particles = buffers.positions.shape[0]
+    np.cumsum(weights, out=buffers.cumulative)
+    buffers.cumulative[-1] = 1.  # Stops rounding errors from pushing a pointer off the end.
+
+    np.add(buffers.particle_range, rng.random(), out=buffers.positions)
+    buffers.positions /= number_of_particles
+
+    _search_sorted(buffers.cumulative, buffers.positions, buffers.indices)
+    return buffers.indices
+
+
+def stratified_resample(
+    weights: np.ndarray, rng: np.random.Generator, buffers: ResampleBuffers
+) -> np.ndarray:
+    """Like systematic resampling, but each of the N pointers gets its own random offset inside its 1/N strata."""
+    number_of_particles = buffers.positions.shape[0]
+    np.cumsum(weights, out=buffers.cumulative)
+    buffers.cumulative[-1] = 1.
+
+    rng.random(out=buffers.positions)
+    buffers.positions += buffers.particle_range
+    buffers.positions /= number_of_particles
+
+    _search_sorted(buffers.cumulative, buffers.positions, buffers.indices)
+    return buffers.indices
+
+
+def multinomial_resample(
+    weights: np.ndarray, rng: np.random.Generator, buffers: ResampleBuffers
+) -> np.ndarray:
+    """Draws N independent samples from the weights. This is the noisiest method, its mainly here for comparison."""
+    np.cumsum(weights, out=buffers.cumulative)
+    buffers.cumulative[-1] = 1.
+
+    # Sorting the pointers keeps the output ordered, which is kinder to the cache during the gather.
+    rng.random(out=buffers.positions)
+    buffers.positions.sort()
+
+    _search_sorted(buffers.cumulative, buffers.positions, buffers.indices)
+    return buffers.indices
+
+
+def residual_resample(
+    weights: np.ndarray, rng: np.random.Generator, buffers: ResampleBuffers
+) -> np.ndarray:
+    """Copies floor(N * w) of each particle directly, then fills the remaining slots with
+    a multinomial draw over what's left of each weight."""
+    number_of_particles = weights.shape[0]
+    indices = buffers.indices
+
+    # positions holds the number of guaranteed copies, cumulative holds the leftover weight.
+    np.multiply(weights, number_of_particles, out=buffers.cumulative)
+    np.floor(buffers.cumulative, out=buffers.positions)
+    buffers.cumulative -= buffers.positions
+    copied = int(buffers.positions.sum())
+
+    # Particle i fills the slots between the running copy totals either side of it.
+    np.cumsum(buffers.positions, out=buffers.positions)
+    _search_sorted(buffers.positions, buffers.particle_range[:copied], indices[:copied], side="right")
+
+    remaining = number_of_particles - copied
+    if remaining > 0:
+        residual_total = buffers.cumulative.sum()
+        np.cumsum(buffers.cumulative, out=buffers.cumulative)
+        buffers.cumulative /= residual_total
+        buffers.cumulative[-1] = 1.
+
+        pointers = buffers.positions[:remaining]
+        rng.random(out=pointers)
+        pointers.sort()
+        _search_sorted(buffers.cumulative, pointers, indices[copied:])
+
+    return indices
+
+
+def _ekf_update_numpy(
+    poses: np.ndarray,
+    r: float,
+    bearing: float,
+    half_sum: float,
+    half_diff: float,
+    off_diagonal: float,
+    mean: np.ndarray,
+    sigma: np.ndarray,
+    importance_factors: np.ndarray,
+    buffers: MeasurementBuffers
+) -> None:
+    """The EKF correction from Particles.measurement_update. Updates mean, sigma and importance_factors in place.
+
+    half_sum, half_diff and off_diagonal describe the sensor noise stretched by the range (see measurement_update)."""
+    # Where each particle thinks the landmark is. Use the y column to hold theta until we're done with it.
+    measured = buffers.measured
+    np.add(poses[:, 2], bearing, out=measured[:, 1])
+    np.cos(measured[:, 1], out=measured[:, 0])
+    np.sin(measured[:, 1], out=measured[:, 1])
+    measured *= r
+    measured += poses[:, :2]
+
+    np.subtract(measured, mean, out=buffers.innovation)
+    dx, dy = buffers.innovation[:, 0], buffers.innovation[:, 1]
+
+    np.add(poses[:, 2], bearing, out=buffers.scratch)
+    buffers.scratch *= 2
+    np.cos(buffers.scratch, out=buffers.cos_2phi)
+    np.sin(buffers.scratch, out=buffers.sin_2phi)
+
+    sig00, sig01, sig11 = sigma[:, 0, 0], sigma[:, 0, 1], sigma[:, 1, 1]
+
+    # S = Σ + R_xy
+    np.multiply(buffers.cos_2phi, half_diff, out=buffers.s00)
+    np.multiply(buffers.sin_2phi, off_diagonal, out=buffers.scratch)
+    buffers.s00 -= buffers.scratch
+    np.subtract(sig11, buffers.s00, out=buffers.s11)
+    buffers.s00 += sig00
+    buffers.s00 += half_sum
+    buffers.s11 += half_sum
+
+    np.multiply(buffers.sin_2phi, half_diff, out=buffers.s01)
+    np.multiply(buffers.cos_2phi, off_diagonal, out=buffers.scratch)
+    buffers.s01 += buffers.scratch
+    buffers.s01 += sig01
+
+    # det(S)
+    np.multiply(buffers.s00, buffers.s11, out=buffers.det)
+    np.multiply(buffers.s01, buffers.s01, out=buffers.scratch)
+    buffers.det -= buffers.scratch
+
+    # K = Σ S^-1, using S^-1 = [[s11, -s01], [-s01, s00]] / det
+    np.multiply(sig00, buffers.s11, out=buffers.k00)
+    np.multiply(sig01, buffers.s01, out=buffers.scratch)
+    buffers.k00 -= buffers.scratch
+
+    np.multiply(sig01, buffers.s00, out=buffers.k01)
+    np.multiply(sig00, buffers.s01, out=buffers.scratch)
+    buffers.k01 -= buffers.scratch
+
+    np.multiply(sig01, buffers.s11, out=buffers.k10)
+    np.multiply(sig11, buffers.s01, out=buffers.scratch)
+    buffers.k10 -= buffers.scratch
+
+    np.multiply(sig11, buffers.s00, out=buffers.k11)
+    np.multiply(sig01, buffers.s01, out=buffers.scratch)
+    buffers.k11 -= buffers.scratch
+
+    for gain in (buffers.k00, buffers.k01, buffers.k10, buffers.k11):
+        gain /= buffers.det
+
+    # Importance weight. scratch holds the squared mahalanobis distance (d^T S^-1 d).
+    np.multiply(dx, dx, out=buffers.scratch)
+    buffers.scratch *= buffers.s11
+    np.multiply(dy, dy, out=buffers.measured[:, 0])
+    buffers.measured[:, 0] *= buffers.s00
+    buffers.scratch += buffers.measured[:, 0]
+    np.multiply(dx, dy, out=buffers.measured[:, 0])
+    buffers.measured[:, 0] *= buffers.s01
+    buffers.measured[:, 0] *= 2
+    buffers.scratch -= buffers.measured[:, 0]
+    buffers.scratch /= buffers.det
+
+    buffers.scratch *= -0.5
+    np.exp(buffers.scratch, out=buffers.scratch)
+    np.sqrt(buffers.det, out=buffers.det)
+    buffers.det *= 2 * np.pi
+    buffers.scratch /= buffers.det
+    importance_factors *= buffers.scratch
+
+    # μ = μ + K d
+    np.multiply(buffers.k00, dx, out=buffers.scratch)
+    mean[:, 0] += buffers.scratch
+    np.multiply(buffers.k01, dy, out=buffers.scratch)
+    mean[:, 0] += buffers.scratch
+    np.multiply(buffers.k10, dx, out=buffers.scratch)
+    mean[:, 1] += buffers.scratch
+    np.multiply(buffers.k11, dy, out=buffers.scratch)
+    mean[:, 1] += buffers.scratch
+
+    """Σ = Σ - K Σ. All three new entries use the old Σ, so they are built in the
+    buffers we're done with (s00, s01, s11) before anything is written back."""
+    np.multiply(buffers.k00, sig00, out=buffers.s00)
+    np.multiply(buffers.k01, sig01, out=buffers.scratch)
+    buffers.s00 += buffers.scratch
+
+    np.multiply(buffers.k00, sig01, out=buffers.s01)
+    np.multiply(buffers.k01, sig11, out=buffers.scratch)
+    buffers.s01 += buffers.scratch
+
+    np.multiply(buffers.k10, sig01, out=buffers.s11)
+    np.multiply(buffers.k11, sig11, out=buffers.scratch)
+    buffers.s11 += buffers.scratch
+
+    np.subtract(sig00, buffers.s00, out=sig00, casting="same_kind")
+    np.subtract(sig11, buffers.s11, out=sig11, casting="same_kind")
+    np.subtract(sig01, buffers.s01, out=sig01, casting="same_kind")
+    sigma[:, 1, 0] = sig01
+
+
+def _ekf_update_numba(
+    poses, r, bearing, half_sum, half_diff, off_diagonal, mean, sigma, importance_factors, buffers
+) -> None:
+    """Same as _ekf_update_numpy, using numba_kernels.ekf_update. It doesn't need any buffers."""
+    numba_kernels.ekf_update(
+        poses, r, bearing, half_sum, half_diff, off_diagonal, mean, sigma, importance_factors
+    )
+
+
+# Picked once, when particles.py is imported.
+_ekf_update = _ekf_update_numba if numba_kernels.USE_NUMBA else _ekf_update_numpy
+
+
+# Rule 3: Use dictionaries for more complex lookups.
+RESAMPLING_METHODS = {
+    "systematic": systematic_resample,
+    "stratified": stratified_resample,
+    "multinomial": multinomial_resample,
+    "residual": residual_resample,
+}
+
+
 def vectorised_motion_model(
     current_poses: np.ndarray, velocity_inputs: np.ndarray, timestep: float
 ):
-    # Setting up numpy views for velocities and angular velocities per particle.
-    particle_velocities = velocity_inputs[:, 0]
-    particle_omegas = velocity_inputs[:, 1]
-    # Calculating useful vectors for motion update.
-    v_over_w = particle_velocities / particle_omegas
-    theta = current_poses[:, 2]
-    d_theta = particle_omegas * timestep
-    new_theta = theta + d_theta
-
-    final_poses = np.empty(current_poses.shape)
-    final_poses[:, 0] = (
-        current_poses[:, 0] - v_over_w * np.sin(theta) + v_over_w * sin(new_theta)
-    )
-    final_poses[:, 1] = (
-        current_poses[:, 1] + v_over_w * np.cos(theta) - v_over_w * cos(new_theta)
+    """Moves each pose by its own (v, ω) in velocity_inputs, without adding any noise. Returns the new poses."""
+    final_poses = np.array(current_poses, dtype=np.float64)
+    integrate_arc(
+        final_poses,
+        velocity_inputs[:, 0],
+        velocity_inputs[:, 1],
+        None,
+        timestep,
+        MotionBuffers.allocate(final_poses.shape[0]),
     )
-    final_poses[:, 2] = theta + new_theta
 
     return final_poses
 
@@ -230,72 +1339,171 @@ def get_noisy_velocity_inputs(
 
 
 def motion_update(particles, velocities, timestep, alphas, debug=False):
-    v_hat, w_hat = velocities[0], velocities[1]
-    
-    # Sample noisy velocities for each particle
-    v_noise = np.sqrt(alphas[0]*v_hat**2 + alphas[1]*w_hat**2)
-    w_noise = np.sqrt(alphas[2]*v_hat**2 + alphas[3]*w_hat**2) 
-    gamma_noise = np.sqrt(alphas[4]*v_hat**2 + alphas[5]*w_hat**2)
-    
-    v = v_hat + np.random.normal(0, v_noise, particles.poses.shape[0])
-    w = w_hat + np.random.normal(0, w_noise, particles.poses.shape[0])
-    gamma = np.random.normal(0, gamma_noise, particles.poses.shape[0])
-    
-    # Handle division by zero
-    w_nonzero = np.where(np.abs(w) < 1e-6, 1e-6, w)
-    
-    x, y, theta = particles.poses[:, 0], particles.poses[:, 1], particles.poses[:, 2]
-    
-    # Motion update
-    new_x = x - (v/w_nonzero) * np.sin(theta) + (v/w_nonzero) * np.sin(theta + w*timestep)
-    new_y = y + (v/w_nonzero) * np.cos(theta) - (v/w_nonzero) * np.cos(theta + w*timestep)
-    new_theta = theta + w * timestep + gamma*timestep
-    
-    return np.column_stack([new_x, new_y, new_theta])
+    """Returns where the particles would be after a noisy (v, ω) motion command, without moving them.
+
+    This is VelocityMotionModel on a copy of the poses. Use Particles.predict to move them in place."""
+    new_poses = particles.poses.copy()
+    VelocityMotionModel(alphas).predict(
+        new_poses, velocities, timestep, particles.rng, particles._motion_buffers
+    )
+
+    return new_poses
 
 
 def ackermann_motion_update(particles, velocities, timestep, alphas, debug=False, track_width=0.):
-    v_hat, w_hat = velocities[0], velocities[1]
-    
-    # Sample noisy velocities for each particle
-    v_noise = np.sqrt(alphas[0]*v_hat**2 + alphas[1]*w_hat**2)
-    w_noise = np.sqrt(alphas[2]*v_hat**2 + alphas[3]*w_hat**2) 
-    gamma_noise = np.sqrt(alphas[4]*v_hat**2 + alphas[5]*w_hat**2)
-    
-    v = v_hat + np.random.normal(0, v_noise, particles.poses.shape[0])
-    
-    w = w_hat + np.random.normal(0, w_noise, particles.poses.shape[0])
-    
-    gamma = np.random.normal(0, gamma_noise, particles.poses.shape[0])
-    
-    #Get the ackermann 
-    # Handle division by zero
-    w_nonzero = np.where(np.abs(w) < 1e-6, 1e-6, w)
-    
-    x, y, theta = particles.poses[:, 0], particles.poses[:, 1], particles.poses[:, 2]
-    
-    # Motion update
-    axle_offset = np.array([np.cos(theta - np.pi/4)*track_width, np.sin(theta-np.pi/4)*track_width])
-    new_x = x - (v/w_nonzero) * np.sin(theta) + (v/w_nonzero) * np.sin(theta + w*timestep) + axle_offset[0]
-    new_y = y + (v/w_nonzero) * np.cos(theta) - (v/w_nonzero) * np.cos(theta + w*timestep) + axle_offset[1]
-    
-    centre_x = new_x + np.sin(particles.poses[0, 2] - np.pi/4) * 0.5
-    centre_y = new_y + np.cos(particles.poses[0, 2] - np.pi/4) * 0.5 
-    new_theta = theta + w*timestep + gamma*timestep
-    return np.column_stack([centre_x, centre_y, new_theta])
+    """Kept for older code. This used to add a fixed offset based on particle 0's heading.
+
+    With the pose at the middle of the rear axle, an Ackermann car driving at (v, ω) follows
+    the same arc as the velocity model, and the track width doesn't change that. If you have
+    a steering angle rather than ω, use BicycleMotionModel from motion_models.py."""
+    return motion_update(particles, velocities, timestep, alphas, debug)
 
 
-def get_landmark_offset(particles: Particles, landmark_vect):
+def get_landmark_offset(
+    particles: Particles, landmark_vect, out: Optional[np.ndarray] = None
+):
     """Converts a landmark detection in (r, θ) into their (x, y) position for each particle.
 
+    If out is given (an (N, 2) float array) the offsets are written into it and nothing is allocated.
+
     TODO: Write some documentation for this because this is a nasty fastSLAM concept at first."""
     r = landmark_vect[0]
-    theta = landmark_vect[1] + particles.poses[:, 2]
 
-    x = r * np.cos(theta)
-    y = r * np.sin(theta)
+    if out is None:
+        theta = landmark_vect[1] + particles.poses[:, 2]
+
+        x = r * np.cos(theta)
+        y = r * np.sin(theta)
+
+        return np.array([x, y]).T
+
+    # Use the y column to hold theta until we're done with it.
+    theta = np.add(particles.poses[:, 2], landmark_vect[1], out=out[:, 1])
+    np.cos(theta, out=out[:, 0])
+    np.sin(theta, out=out[:, 1])
+    out *= r
 
-    return np.array([x, y]).T
+    return out
+
+
+def get_landmark_offsets(
+    particles: Particles, polar_detections: np.ndarray, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """The batched version of get_landmark_offset. Converts a whole scan of detections at once.
+
+    Args:
+        particles: the particle set that made the detections.
+        polar_detections: (M, 2) array of [r, θ] detections.
+        out: Optional (N, M, 2) float array to write into.
+
+    Returns:
+        (N, M, 2) array of landmark offsets. Add particles.poses[:, None, :2] to get positions
+        you can pass straight to Particles.add_landmarks."""
+    ranges = polar_detections[:, 0]
+    theta = polar_detections[:, 1] + particles.poses[:, 2, None]
+
+    if out is None:
+        out = np.empty(theta.shape + (2,))
+
+    np.cos(theta, out=out[..., 0])
+    np.sin(theta, out=out[..., 1])
+    out *= ranges[:, None]
+
+    return out
+
+
+def get_landmark_covs(
+    polar_detections: np.ndarray,
+    sensor_noise_cov: np.ndarray,
+    headings: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """The batched version of get_landmark_cov.
+
+    Args:
+        polar_detections: (M, 2) array of [r, θ] detections.
+        sensor_noise_cov: (2, 2) R matrix shared by every detection, or (M, 2, 2).
+        headings: Optional (N,) particle headings, normally particles.poses[:, 2]. If given,
+            the covariances are rotated into the world frame for each particle.
+
+    Returns:
+        (M, 2, 2) cartesian covariances, or (N, M, 2, 2) if headings were given."""
+    if headings is not None and numba_kernels.USE_NUMBA:
+        sensor_noise_covs = np.broadcast_to(sensor_noise_cov, (len(polar_detections), 2, 2))
+        out = np.empty((len(headings), len(polar_detections), 2, 2))
+        numba_kernels.landmark_covs(polar_detections, sensor_noise_covs, headings, out)
+        return out
+
+    ranges = polar_detections[:, 0]
+    theta = polar_detections[:, 1]
+    if headings is not None:
+        theta = theta + headings[:, None]
+
+    cos_theta = np.cos(theta)
+    sin_theta = np.sin(theta)
+
+    # Same jacobian as get_landmark_cov, just with the 2x2 in the last two axes.
+    jacobian = np.empty(theta.shape + (2, 2))
+    jacobian[..., 0, 0] = cos_theta
+    jacobian[..., 0, 1] = -ranges * sin_theta
+    jacobian[..., 1, 0] = sin_theta
+    jacobian[..., 1, 1] = ranges * cos_theta
+
+    return jacobian @ sensor_noise_cov @ jacobian.swapaxes(-1, -2)
+
+
+def uncertainty_ellipses(
+    covariance: np.ndarray, confidence: float = DEFAULT_CONFIDENCE_THRESHOLD
+) -> tuple:
+    """Turns a stack of 2x2 covariance matrices into confidence ellipses, e.g. particles.covariance.
+
+    Args:
+        covariance: (..., 2, 2) array of covariance matrices, like the (N, L, 2, 2) particles.covariance.
+        confidence: how sure we want to be that the landmark is inside its ellipse.
+
+    Returns:
+        axes: (..., 2) array of the semi major and semi minor axis lengths.
+        angles: (...) array of the angle of the major axis, in radians anticlockwise from x.
+
+    How it works:
+    The axes of the ellipse are the eigenvectors of the covariance, scaled by the square root of each
+    eigenvalue times the chi-squared value. For a symmetric 2x2 matrix [[a, b], [b, d]] the eigenvalues are
+        (a + d)/2 ± sqrt(((a - d)/2)² + b²)
+    and the major axis is at atan2(2b, a - d)/2, so every matrix is done at once with no np.linalg."""
+    a, b, d = covariance[..., 0, 0], covariance[..., 0, 1], covariance[..., 1, 1]
+
+    half_sum = (a + d) / 2
+    half_diff = (a - d) / 2
+    radius = np.hypot(half_diff, b)
+
+    axes = np.empty(a.shape + (2,))
+    np.add(half_sum, radius, out=axes[..., 0])
+    np.subtract(half_sum, radius, out=axes[..., 1])
+
+    # Rounding can push the small eigenvalue of a nearly flat covariance a tiny bit below zero.
+    np.maximum(axes, 0, out=axes)
+    axes *= chi_squared_value(confidence)
+    np.sqrt(axes, out=axes)
+
+    angles = np.arctan2(b, half_diff)
+    angles /= 2
+
+    return axes, angles
+
+
+def stretched_noise_terms(r: float, sensor_noise_cov: np.ndarray) -> tuple:
+    """Returns the (half_sum, half_diff, off_diagonal) terms measurement_update needs for a range of r.
+
+    get_landmark_cov at a bearing of zero stretches R by the range. The remaining
+    part of the jacobian is a rotation by each particles global bearing phi, which we
+    do in closed form using the double angle formulas:
+        R_xy = a + b cos(2phi) - c sin(2phi), ...
+    """
+    stretched = get_landmark_cov(np.array((r, 0.)), sensor_noise_cov)
+    half_sum = (stretched[0, 0] + stretched[1, 1]) / 2
+    half_diff = (stretched[0, 0] - stretched[1, 1]) / 2
+    off_diagonal = (stretched[0, 1] + stretched[1, 0]) / 2
+
+    return half_sum, half_diff, off_diagonal
 
 
 def get_landmark_cov(landmark_polar_offset, sensor_noise_cov):
@@ -335,23 +1543,15 @@ def get_landmark_cov(landmark_polar_offset, sensor_noise_cov):
 
 
 if __name__ == "__main__":
+    # Plotting lives in particle_plots.py, so importing particles never pulls in matplotlib.
+    from particle_plots import animate_motion
+
+    np.set_printoptions(suppress=True, precision=5)
     particles = Particles(5000, np.array([0 ,0. ,0.]),np.array([0.01, 0.01, 0.001]))
-    import matplotlib.animation as animation
     iterator_start_time = time.time()
     for particle in particles:
         print(particle.pose)
     iterator_time = time.time() - iterator_start_time
     print(f"Pose print test time: {iterator_time * 1000}ms")
-    fig, ax = plt.subplots()
-
-    def animate(frame):
-        ax.clear()
-        # Update particles for this timestep
-        particles.poses = motion_update(particles, np.array((1, 0.2)), 0.1, [0.01, 0.0001, 0.0001, 0.001, 0.05, 0.1])
-        plot_particle_poses(particles, ax)
-        ax.set_title(f'Timestep {frame}')
-
-    ani = animation.FuncAnimation(fig, animate, frames=100, 
-                                interval=100, repeat=True)
 
-    plt.show()
+    animate_motion(particles, (1, 0.2), 0.1, [0.01, 0.0001, 0.0001, 0.001, 0.05, 0.1])
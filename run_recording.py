@@ -0,0 +1,277 @@
+"""
+#Run Recording:
+Records the full filter state at every step to disk, and replays it afterwards, so a bad lap can be stepped
+through (or analysed) long after the car has stopped.
+
+A recording is a folder with three kinds of file in it:
+- meta.json: the dtypes and chunk size, written once.
+- index.bin: one fixed size INDEX_DTYPE record per step, saying which chunk the step is in, where it starts,
+  and how many particles, landmarks and covariances it has.
+- chunk_00000.bin, chunk_00001.bin...: the arrays themselves, one step after another. Each chunk is a
+  memory mapped file of chunk_size bytes, so recording a step is just a copy into the page cache, and the OS
+  writes it out in the background. The filter never waits on the disk.
+
+Each step stores poses, importance_factors, and the observed parts of landmarks, landmark_likelihood and
+covariance, each starting on an ALIGNMENT byte boundary.
+
+RunReplayer maps the chunks read-only, so replayer[step] finds a step from the index in O(1) and returns a
+Snapshot (see filter_worker.py) of views straight into the file, without copying anything. The clouds in
+particle_viewer.py can draw a Snapshot directly, or you can hand a ReplayReader to them and seek around.
+"""
+
+import json
+import os
+import time
+from typing import Iterator, Optional
+
+import numpy as np
+
+from filter_worker import Snapshot
+
+FORMAT_VERSION = 1
+DEFAULT_CHUNK_SIZE = 256 * 1024 * 1024  # bytes
+ALIGNMENT = 64  # bytes. Every array in a step starts on a cache line.
+
+META_FILE = "meta.json"
+INDEX_FILE = "index.bin"
+CHUNK_FILE = "chunk_{:05d}.bin"
+
+INDEX_DTYPE = np.dtype([
+    ("chunk", np.int64),
+    ("offset", np.int64),
+    ("version", np.int64),
+    ("number_of_particles", np.int64),
+    ("observed_landmarks", np.int64),
+    ("observed_covariances", np.int64),
+    ("time", np.float64),
+])
+
+
+def _aligned(size: int) -> int:
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def _step_shapes(number_of_particles: int, observed_landmarks: int, observed_covariances: int) -> tuple:
+    """The shape of every array in a step, in the order they are written."""
+    return (
+        (number_of_particles, 3),
+        (number_of_particles,),
+        (number_of_particles, observed_landmarks, 2),
+        (number_of_particles, observed_landmarks),
+        (number_of_particles, observed_covariances, 2, 2),
+    )
+
+
+def _step_layout(shapes: tuple, dtypes: tuple) -> tuple:
+    """Returns the offset of every array relative to the start of the step, and the step's total size."""
+    offsets = []
+    size = 0
+    for shape, dtype in zip(shapes, dtypes):
+        offsets.append(size)
+        size += _aligned(int(np.prod(shape)) * dtype.itemsize)
+    return offsets, size
+
+
+class RunRecorder:
+    """Appends the state of a Particles object to a recording folder, one step at a time.
+
+    Args:
+        path: the folder to record into. It's created if it doesn't exist, and must not already hold a recording.
+        chunk_size: Optional. How many bytes each chunk file holds. A step bigger than this gets a chunk to itself.
+
+    Use it as a context manager, or call close when you're done, so the last chunk gets trimmed."""
+    def __init__(self, path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, INDEX_FILE)):
+            raise FileExistsError(f"{path} already holds a recording.")
+
+        self.steps_recorded = 0
+        self._dtypes = None
+        self._chunk = None
+        self._chunk_number = -1
+        self._chunk_used = 0
+        self._index_file = open(os.path.join(path, INDEX_FILE), "wb")
+        self._index_record = np.zeros(1, INDEX_DTYPE)
+
+    def __enter__(self) -> "RunRecorder":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _write_meta(self, dtypes: tuple) -> None:
+        meta = {
+            "format_version": FORMAT_VERSION,
+            "chunk_size": self.chunk_size,
+            "alignment": ALIGNMENT,
+            "dtypes": [dtype.str for dtype in dtypes],
+        }
+        with open(os.path.join(self.path, META_FILE), "w") as meta_file:
+            json.dump(meta, meta_file, indent=4)
+
+    def _finish_chunk(self) -> None:
+        """Unmaps the current chunk and trims the unused space off the end of it.
+
+        There's no flush here on purpose: that would wait for the disk. The data is already in the page cache,
+        so it survives the process crashing, and the OS writes it out in its own time."""
+        if self._chunk is None:
+            return
+
+        self._chunk = None
+        os.truncate(
+            os.path.join(self.path, CHUNK_FILE.format(self._chunk_number)), self._chunk_used
+        )
+
+    def _start_chunk(self, minimum_size: int) -> None:
+        self._finish_chunk()
+        self._chunk_number += 1
+        self._chunk_used = 0
+        self._chunk = np.memmap(
+            os.path.join(self.path, CHUNK_FILE.format(self._chunk_number)),
+            np.uint8, "w+", shape=(max(self.chunk_size, minimum_size),)
+        )
+
+    def record(self, particles) -> None:
+        """Appends the current state of particles (or anything with the same attributes, like a Snapshot)."""
+        arrays = (
+            particles.poses,
+            particles.importance_factors,
+            particles.landmarks,
+            particles.landmark_likelihood,
+            particles.covariance,
+        )
+        dtypes = tuple(array.dtype for array in arrays)
+        if self._dtypes is None:
+            self._dtypes = dtypes
+            self._write_meta(dtypes)
+        elif dtypes != self._dtypes:
+            raise ValueError(f"the dtypes changed part way through the recording: {dtypes} != {self._dtypes}")
+
+        offsets, step_size = _step_layout(tuple(array.shape for array in arrays), dtypes)
+        if self._chunk is None or self._chunk_used + step_size > len(self._chunk):
+            self._start_chunk(step_size)
+
+        start = self._chunk_used
+        for array, offset in zip(arrays, offsets):
+            destination = self._chunk[start + offset:start + offset + array.nbytes]
+            np.copyto(destination.view(array.dtype).reshape(array.shape), array)
+        self._chunk_used += step_size
+
+        record = self._index_record[0]
+        record["chunk"] = self._chunk_number
+        record["offset"] = start
+        record["version"] = particles.version
+        record["number_of_particles"] = len(particles.poses)
+        record["observed_landmarks"] = particles.landmarks.shape[1]
+        record["observed_covariances"] = particles.covariance.shape[1]
+        record["time"] = time.time()
+
+        # The index is written last, so a replayer following along never sees a step that isn't there yet.
+        self._index_file.write(self._index_record.tobytes())
+        self._index_file.flush()
+        self.steps_recorded += 1
+
+    def close(self) -> None:
+        self._finish_chunk()
+        if not self._index_file.closed:
+            self._index_file.close()
+
+
+class RunReplayer:
+    """Reads a recording made by RunRecorder.
+
+    replayer[step] returns a read-only Snapshot of that step, made of views into the memory mapped chunks.
+    Negative steps count from the end, like a list. len(replayer) is the number of steps.
+
+    Attributes:
+    index: the (steps,) INDEX_DTYPE array, e.g. index["time"] for the time of every step."""
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as meta_file:
+            meta = json.load(meta_file)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"{path} is format version {meta['format_version']}, we can read {FORMAT_VERSION}.")
+
+        self._dtypes = tuple(np.dtype(dtype) for dtype in meta["dtypes"])
+        self._chunks = {}
+        self.index = np.empty(0, INDEX_DTYPE)
+        self.refresh()
+
+    def refresh(self) -> int:
+        """Re-reads the index, to follow a recording that's still going. Returns the number of steps."""
+        index_path = os.path.join(self.path, INDEX_FILE)
+        steps = os.path.getsize(index_path) // INDEX_DTYPE.itemsize
+        if steps != len(self.index):
+            self.index = np.fromfile(index_path, INDEX_DTYPE, count=steps)
+
+            # The newest chunk may have grown (or been trimmed) since we mapped it.
+            self._chunks.pop(int(self.index["chunk"][-1]), None)
+
+        return len(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _chunk(self, chunk_number: int) -> np.memmap:
+        chunk = self._chunks.get(chunk_number)
+        if chunk is None:
+            chunk = np.memmap(os.path.join(self.path, CHUNK_FILE.format(chunk_number)), np.uint8, "r")
+            self._chunks[chunk_number] = chunk
+        return chunk
+
+    def __getitem__(self, step: int) -> Snapshot:
+        record = self.index[step]
+        shapes = _step_shapes(
+            int(record["number_of_particles"]),
+            int(record["observed_landmarks"]),
+            int(record["observed_covariances"]),
+        )
+        offsets, _ = _step_layout(shapes, self._dtypes)
+
+        chunk = self._chunk(int(record["chunk"]))
+        start = int(record["offset"])
+        arrays = []
+        for shape, dtype, offset in zip(shapes, self._dtypes, offsets):
+            size = int(np.prod(shape)) * dtype.itemsize
+            arrays.append(chunk[start + offset:start + offset + size].view(dtype).reshape(shape))
+
+        return Snapshot(int(record["version"]), *arrays)
+
+    def __iter__(self) -> Iterator[Snapshot]:
+        for step in range(len(self)):
+            yield self[step]
+
+    def step_at(self, timestamp: float) -> int:
+        """Returns the last step recorded at or before timestamp (a time.time() value)."""
+        return max(int(np.searchsorted(self.index["time"], timestamp, side="right")) - 1, 0)
+
+    def close(self) -> None:
+        self._chunks = {}
+
+
+class ReplayReader:
+    """Holds the replayed step the viewer is drawing. Pass this to the clouds instead of a Particles object.
+
+    Works like filter_worker.SnapshotReader, but you choose the step: call seek (or step_forward) and
+    then view.update_clouds()."""
+    def __init__(self, replayer: RunReplayer, step: int = 0):
+        self.replayer = replayer
+        self.step = step
+        self.snapshot = replayer[step]
+
+    def seek(self, step: int) -> Optional[Snapshot]:
+        """Moves to step. Returns the new snapshot, or None if step is past the end of the recording."""
+        if not -len(self.replayer) <= step < len(self.replayer):
+            return None
+
+        self.step = step % len(self.replayer)
+        self.snapshot = self.replayer[self.step]
+        return self.snapshot
+
+    def step_forward(self, steps: int = 1) -> Optional[Snapshot]:
+        return self.seek(self.step + steps)
+
+    def __getattr__(self, name):
+        return getattr(self.snapshot, name)
@@ -0,0 +1,593 @@
+"""
+#Sharded Particles:
+Spreads the particle updates across every core, using a pool of worker processes.
+
+numpy does the motion and landmark maths on one core at a time, and the GIL stops threads from helping
+with the parts that aren't one big ufunc. ShardedParticles keeps its arrays in shared memory (see
+shared_particles.py) and splits the particles into contiguous shards, one per worker process. The workers
+start once and stay running. Each step, every worker updates its own rows in place:
+- predict: moves its particles with the motion model, using its own random generator.
+- add_observations: turns (r, θ) detections into landmark positions and covariances for its particles.
+- measurement_update: runs the EKF for its particles and multiplies in their importance factors.
+- gather (used by resample): copies the particles it has been given into its rows of the spare arrays.
+
+The coordinator (the process that made the ShardedParticles) only does the steps that need every particle:
+normalising the weights, picking the resampling indices, and keeping landmark_grid up to date.
+
+Nothing is pickled per step. A command is one byte down a pipe, and its arguments (controls, detections,
+resampling indices...) are written into a small shared scratch block that every worker maps at startup.
+The reply is an empty message, or the worker's traceback if it failed. The motion model is the exception:
+it's pickled and sent down the pipe when the workers start, and again whenever motion_model is assigned.
+
+Workers are started with "spawn", so the script that makes a ShardedParticles needs the usual
+if __name__ == "__main__": guard. Each worker compiles (or loads from cache) its own numba kernels, and
+the cores are split between them so they don't fight over threads.
+
+Everything else (associate, predict_sequence, add_landmarks...) still works, it just runs on the
+coordinator. Each command costs roughly 50-100µs per worker, so this only pays off for ~20k+ particles.
+Call close() (or use a with block) when you're done, so the workers exit and the shared memory is freed.
+If you forget, the workers are stopped when the ShardedParticles is garbage collected, or when Python exits.
+"""
+
+import os
+import pickle
+import secrets
+import traceback
+import weakref
+from multiprocessing import get_context, shared_memory
+from typing import Optional
+
+import numpy as np
+
+import numba_kernels
+from particles import (
+    Particles,
+    MeasurementBuffers,
+    NUMBER_OF_LANDMARKS,
+    get_landmark_offsets,
+    get_landmark_covs,
+    _ekf_update,
+)
+from data_association import DEFAULT_CELL_SIZE
+from motion_models import MotionModel, MotionBuffers
+from map_storage import particle_axes, slot_axes, gather_particles, landmark_view, covariance_view
+from shared_particles import SharedParticleMemory, attach_block
+
+DEFAULT_MAX_OBSERVATIONS = 256  # Detections per add_observations command. Bigger scans are split up.
+START_METHOD = "spawn"
+
+PARAMETER_SLOTS = 16  # float64s for the arguments of one command.
+RESULT_SLOTS = 4  # float64s each worker can send back.
+CONTROL_OFFSET = 4  # predict: timestep, control ndim, control shape (2 slots), then the control itself.
+
+# Rule 3: Use dictionaries for more complex lookups.
+COMMANDS = {
+    "stop": 0,
+    "predict": 1,
+    "add_observations": 2,
+    "measurement_update": 3,
+    "gather": 4,
+    "set_motion_model": 5,
+}
+COMMAND_NAMES = {code: name for name, code in COMMANDS.items()}
+
+
+def shard_bounds(number_of_particles: int, number_of_workers: int) -> list:
+    """Splits N particles into contiguous (start, stop) shards, as evenly as possible."""
+    edges = [worker * number_of_particles // number_of_workers for worker in range(number_of_workers + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+class ShardScratch:
+    """The shared block the coordinator uses to hand arguments to the workers, and get results back.
+
+    Attributes:
+    parameters: (PARAMETER_SLOTS,) float64 arguments of the current command.
+    results: (W, RESULT_SLOTS) float64, one row written by each worker.
+    observations: (max_observations, 2) polar detections for add_observations.
+    slots: (max_observations,) landmark slots for add_observations.
+    indices: (N,) resampling indices for gather."""
+    def __init__(
+        self,
+        block: shared_memory.SharedMemory,
+        number_of_particles: int,
+        number_of_workers: int,
+        max_observations: int,
+        owner: bool
+    ):
+        self.name = block.name
+        self.owner = owner
+        self._block = block
+
+        offset = 0
+        arrays = []
+        for shape, dtype in self._layout(number_of_particles, number_of_workers, max_observations):
+            array = np.ndarray(shape, dtype, block.buf, offset)
+            offset += array.nbytes
+            arrays.append(array)
+
+        self.parameters, self.results, self.observations, self.slots, self.indices = arrays
+
+    @staticmethod
+    def _layout(number_of_particles: int, number_of_workers: int, max_observations: int) -> list:
+        return [
+            ((PARAMETER_SLOTS,), np.float64),
+            ((number_of_workers, RESULT_SLOTS), np.float64),
+            ((max_observations, 2), np.float64),
+            ((max_observations,), np.int64),
+            ((number_of_particles,), np.int64),
+        ]
+
+    @classmethod
+    def create(
+        cls, name: str, number_of_particles: int, number_of_workers: int, max_observations: int
+    ) -> "ShardScratch":
+        size = sum(
+            int(np.prod(shape)) * np.dtype(dtype).itemsize
+            for shape, dtype in cls._layout(number_of_particles, number_of_workers, max_observations)
+        )
+        block = shared_memory.SharedMemory(name, create=True, size=size)
+        return cls(block, number_of_particles, number_of_workers, max_observations, owner=True)
+
+    @classmethod
+    def attach(
+        cls, name: str, number_of_particles: int, number_of_workers: int, max_observations: int
+    ) -> "ShardScratch":
+        block = attach_block(name)
+        return cls(block, number_of_particles, number_of_workers, max_observations, owner=False)
+
+    def close(self) -> None:
+        self.parameters = self.results = self.observations = self.slots = self.indices = None
+        self._block.close()
+        if self.owner:
+            self._block.unlink()
+
+
+class ShardWorker:
+    """Runs in a worker process, and updates rows start to stop of the shared particles in place.
+
+    Every command starts by reading the shared header (see bind), so the worker always writes into whichever
+    pose and map buffers are live, even after a resample swapped them or the map grew into a new block."""
+    def __init__(
+        self,
+        memory_name: str,
+        scratch_name: str,
+        worker_index: int,
+        number_of_workers: int,
+        max_observations: int,
+        start: int,
+        stop: int,
+        motion_model: Optional[MotionModel],
+        seed: np.random.SeedSequence,
+        threads: int
+    ):
+        if numba_kernels.USE_NUMBA:
+            import numba
+            numba.set_num_threads(threads)
+
+        self.memory = SharedParticleMemory.attach(memory_name)
+        number_of_particles = self.memory.poses.shape[1]
+        self.scratch = ShardScratch.attach(
+            scratch_name, number_of_particles, number_of_workers, max_observations
+        )
+        self.worker_index = worker_index
+        self.rows = slice(start, stop)
+        self.motion_model = motion_model
+        self.rng = np.random.default_rng(seed)
+        self.motion_buffers = MotionBuffers.allocate(stop - start)
+        self.measurement_buffers = MeasurementBuffers.allocate(stop - start)
+
+        self.poses = self.importance_factors = None
+        self.landmarks = self.landmark_likelihood = self.covariance = None
+        self._live_poses = self._live_map = 0
+        self._packed = False
+        self._observed = (0, 0, 0)
+
+    def bind(self) -> None:
+        """Points poses, landmarks etc. at this worker's rows of the live buffers.
+
+        The views cover the whole capacity of the map, so they work for landmarks the coordinator has
+        only just claimed."""
+        header = None
+        while header is None:
+            header = self.memory.read_header()
+
+        if header["map_generation"] != self.memory.map_generation:
+            self.landmarks = self.landmark_likelihood = self.covariance = None
+            self.memory.attach_map(
+                header["map_generation"], header["capacity"], header["map_itemsize"],
+                bool(header["packed_covariance"])
+            )
+
+        packed = self._packed = bool(header["packed_covariance"])
+        capacity = header["capacity"]
+        self._live_poses, self._live_map = header["live_poses"], header["live_map"]
+        self._observed = (header["observed_landmarks"], header["observed_landmarks"], header["observed_covariances"])
+        self.poses = self.memory.poses[self._live_poses][self.rows]
+        self.importance_factors = self.memory.importance_factors[self.rows]
+
+        landmark_axis, _, covariance_axis = particle_axes(packed)
+        self.landmarks = landmark_view(
+            self._shard(self.memory.landmarks[self._live_map], landmark_axis), capacity, packed
+        )
+        self.landmark_likelihood = self.memory.landmark_likelihood[self._live_map][self.rows]
+        self.covariance = covariance_view(
+            self._shard(self.memory.covariance[self._live_map], covariance_axis), capacity, packed
+        )
+
+    def _shard(self, storage: np.ndarray, axis: int) -> np.ndarray:
+        index = [slice(None)] * storage.ndim
+        index[axis] = self.rows
+        return storage[tuple(index)]
+
+    def predict(self) -> None:
+        parameters = self.scratch.parameters
+        timestep, ndim = parameters[0], int(parameters[1])
+        shape = tuple(int(size) for size in parameters[2:2 + ndim])
+        control = parameters[CONTROL_OFFSET:CONTROL_OFFSET + int(np.prod(shape))].reshape(shape)
+
+        self.motion_model.predict(self.poses, control, timestep, self.rng, self.motion_buffers)
+
+    def add_observations(self) -> None:
+        """Writes landmark positions (Tau of one) and covariances for the detections in scratch."""
+        scratch = self.scratch
+        number_of_observations = int(scratch.parameters[0])
+        sensor_noise_cov = scratch.parameters[1:5].reshape(2, 2)
+        observations = scratch.observations[:number_of_observations]
+        slots = scratch.slots[:number_of_observations]
+
+        positions = get_landmark_offsets(self, observations)
+        positions += self.poses[:, None, :2]
+        self.landmarks[:, slots] = positions
+        self.landmark_likelihood[:, slots] = 1
+        self.covariance[:, slots] = get_landmark_covs(observations, sensor_noise_cov, self.poses[:, 2])
+
+    def measurement_update(self) -> None:
+        """The EKF from Particles.measurement_update, for our rows. Sends back the sum of the new means."""
+        parameters = self.scratch.parameters
+        landmark_index = int(parameters[0])
+        r, bearing, half_sum, half_diff, off_diagonal = parameters[1:6]
+
+        mean = self.landmarks[:, landmark_index]
+        sigma = self.covariance[:, landmark_index]
+        _ekf_update(
+            self.poses, r, bearing, half_sum, half_diff, off_diagonal,
+            mean, sigma, self.importance_factors, self.measurement_buffers
+        )
+        self.landmark_likelihood[:, landmark_index] += 1
+
+        mean.sum(axis=0, out=self.scratch.results[self.worker_index, :2])
+
+    def gather(self) -> None:
+        """Copies particles scratch.indices[rows] from the live buffers into our rows of the spare buffers."""
+        memory = self.memory
+        indices = self.scratch.indices[self.rows]
+        live_poses, live_map = self._live_poses, self._live_map
+        spare_poses, spare_map = live_poses ^ 1, live_map ^ 1
+
+        np.take(memory.poses[live_poses], indices, axis=0, out=memory.poses[spare_poses][self.rows], mode="clip")
+        for storage, particle_axis, slot_axis, observed in zip(
+            (memory.landmarks, memory.landmark_likelihood, memory.covariance),
+            particle_axes(self._packed), slot_axes(self._packed), self._observed
+        ):
+            gather_particles(
+                storage[live_map], indices, self._shard(storage[spare_map], particle_axis),
+                particle_axis, slot_axis, observed
+            )
+
+    def serve(self, connection) -> None:
+        """Runs commands from the coordinator until it sends stop."""
+        connection.send_bytes(b"")
+        while True:
+            command = COMMAND_NAMES[connection.recv_bytes()[0]]
+            if command == "stop":
+                break
+
+            try:
+                if command == "set_motion_model":
+                    # The one argument that doesn't fit in the scratch block, so it comes down the pipe.
+                    self.motion_model = pickle.loads(connection.recv_bytes())
+                else:
+                    self.bind()
+                    getattr(self, command)()
+            except Exception:
+                connection.send_bytes(traceback.format_exc().encode())
+            else:
+                connection.send_bytes(b"")
+
+    def close(self) -> None:
+        self.poses = self.importance_factors = None
+        self.landmarks = self.landmark_likelihood = self.covariance = None
+        self.scratch.close()
+        self.memory.close()
+
+
+def _shut_down(connections: list, workers: list, scratch: ShardScratch, memory: SharedParticleMemory) -> None:
+    """Stops the workers, frees the scratch block and unlinks the particles' shared memory.
+
+    ShardedParticles.close calls this, and so does weakref.finalize if it's garbage collected (or Python exits)
+    without being closed. So it's only given what it needs, never the ShardedParticles itself. The particle
+    arrays can still be in use when it runs, so the memory is only unlinked. It's unmapped once they are gone."""
+    stop = bytes((COMMANDS["stop"],))
+    for connection in connections:
+        try:
+            connection.send_bytes(stop)
+        except (BrokenPipeError, OSError):
+            pass
+    for worker, connection in zip(workers, connections):
+        worker.join()
+        connection.close()
+
+    scratch.close()
+    memory.unlink()
+
+
+def _run_worker(connection, *args) -> None:
+    """Entry point of each worker process."""
+    try:
+        worker = ShardWorker(*args)
+    except Exception:
+        connection.send_bytes(traceback.format_exc().encode())
+        return
+
+    try:
+        worker.serve(connection)
+    finally:
+        worker.close()
+
+
+class ShardedParticles(Particles):
+    """A Particles object whose predict, add_observations, measurement_update and resample run on a
+    pool of worker processes, each one owning a contiguous shard of the particles.
+
+    Args:
+        number_of_workers: Optional. How many worker processes (and shards) to use. Defaults to one per core.
+        max_observations: Optional. How many detections add_observations sends to the workers at once.
+        shared_memory_name: Optional. The arrays always live in shared memory, a name is made up if you
+            don't give one. Viewers can still Particles.attach to it as normal.
+        The rest are the same as Particles.
+
+    Attributes:
+    shards: the (start, stop) rows of each worker."""
+    def __init__(
+        self,
+        number_of_particles: int,
+        initial_pose: np.ndarray,
+        initial_error: Optional[np.ndarray] = None,
+        max_landmarks: int = NUMBER_OF_LANDMARKS,
+        seed: Optional[int] = None,
+        association_cell_size: float = DEFAULT_CELL_SIZE,
+        landmark_cap: Optional[int] = None,
+        motion_model: Optional[MotionModel] = None,
+        shared_memory_name: Optional[str] = None,
+        dtype: Optional[np.dtype] = None,
+        packed_covariance: bool = False,
+        number_of_workers: Optional[int] = None,
+        max_observations: int = DEFAULT_MAX_OBSERVATIONS
+    ):
+        if shared_memory_name is None:
+            shared_memory_name = f"clouds_{secrets.token_hex(6)}"
+
+        super().__init__(
+            number_of_particles,
+            initial_pose,
+            initial_error,
+            max_landmarks,
+            seed,
+            association_cell_size,
+            landmark_cap,
+            motion_model,
+            shared_memory_name=shared_memory_name,
+            dtype=dtype,
+            packed_covariance=packed_covariance,
+        )
+
+        cores = os.cpu_count() or 1
+        if number_of_workers is None:
+            number_of_workers = cores
+        number_of_workers = max(1, min(number_of_workers, number_of_particles))
+        self.shards = shard_bounds(number_of_particles, number_of_workers)
+        self.max_observations = max_observations
+
+        self._scratch = ShardScratch.create(
+            f"{shared_memory_name}_shards", number_of_particles, number_of_workers, max_observations
+        )
+        self._connections = []
+        self._workers = []
+        self._finalizer = weakref.finalize(
+            self, _shut_down, self._connections, self._workers, self._scratch, self._shared
+        )
+
+        # Each worker gets its own independent stream from the seed, so a run is reproducible
+        # for a given seed and number_of_workers.
+        seeds = np.random.SeedSequence(seed).spawn(number_of_workers)
+        threads = max(1, cores // number_of_workers)
+        context = get_context(START_METHOD)
+        for worker_index, (start, stop) in enumerate(self.shards):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(
+                target=_run_worker,
+                args=(
+                    worker_connection, shared_memory_name, self._scratch.name, worker_index,
+                    number_of_workers, max_observations, start, stop, self._motion_model,
+                    seeds[worker_index], threads,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._workers.append(worker)
+
+        try:
+            self._collect()
+        except RuntimeError:
+            self.close()
+            raise
+
+    @property
+    def number_of_workers(self) -> int:
+        return len(self.shards)
+
+    @property
+    def motion_model(self) -> Optional[MotionModel]:
+        """The model predict uses. Every worker has its own copy, so assigning a new model sends it to all of them.
+
+        Changes made to the model in place aren't seen by the workers. Assign it again to send it again."""
+        return self._motion_model
+
+    @motion_model.setter
+    def motion_model(self, motion_model: Optional[MotionModel]) -> None:
+        self._motion_model = motion_model
+        # Particles.__init__ sets this before there are any workers. They get it when they start.
+        if getattr(self, "_connections", None):
+            self._run("set_motion_model", pickle.dumps(motion_model))
+
+    def __enter__(self) -> "ShardedParticles":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _run(self, command: str, payload: Optional[bytes] = None) -> None:
+        """Sends command (followed by payload, if given) to every worker and waits until they have all finished it.
+
+        The header is published first, so the workers bind to our current buffers and map block."""
+        self._publish_shared()
+        code = bytes((COMMANDS[command],))
+        for connection in self._connections:
+            connection.send_bytes(code)
+            if payload is not None:
+                connection.send_bytes(payload)
+        self._collect()
+
+    def _collect(self) -> None:
+        """Waits for a reply from every worker, and raises if any of them failed."""
+        failures = []
+        for worker_index, connection in enumerate(self._connections):
+            try:
+                reply = connection.recv_bytes()
+            except EOFError:
+                reply = b"worker exited"
+            if reply:
+                failures.append(f"shard {worker_index}: {reply.decode()}")
+
+        if failures:
+            raise RuntimeError("sharded update failed\n" + "\n".join(failures))
+
+    def predict(
+        self,
+        control: np.ndarray,
+        timestep: float,
+        model: Optional[MotionModel] = None
+    ) -> None:
+        """Same as Particles.predict, but every worker moves its own shard.
+
+        model has to be self.motion_model, as that's the one the workers have. Assign motion_model to change it.
+        Per particle controls aren't supported, use one control for every particle."""
+        if model is not None and model is not self.motion_model:
+            raise ValueError(
+                "ShardedParticles can only predict with its own motion_model. Assign motion_model to change it."
+            )
+        if self.motion_model is None:
+            raise ValueError("No motion model set. Pass one to ShardedParticles().")
+
+        control = np.asarray(control, dtype=np.float64)
+        if control.ndim > 2 or CONTROL_OFFSET + control.size > PARAMETER_SLOTS:
+            raise ValueError(f"ShardedParticles can't send a {control.shape} control to its workers.")
+
+        parameters = self._scratch.parameters
+        parameters[0] = timestep
+        parameters[1] = control.ndim
+        parameters[2:2 + control.ndim] = control.shape
+        parameters[CONTROL_OFFSET:CONTROL_OFFSET + control.size] = control.ravel()
+
+        self._run("predict")
+        self.mark_changed()
+
+    def add_observations(self, polar_detections: np.ndarray, sensor_noise_cov: np.ndarray) -> np.ndarray:
+        """Adds a landmark for every detection, with its position and covariance worked out by the workers.
+
+        This does the same as
+            add_landmarks(get_landmark_offsets(particles, polar_detections) + poses[:, None, :2],
+                          get_landmark_covs(polar_detections, sensor_noise_cov, poses[:, 2]))
+        but without making the (N, M, ...) arrays on the coordinator.
+
+        Args:
+            polar_detections: (M, 2) array of [r, θ] detections.
+            sensor_noise_cov: 2x2 covariance matrix in polar coordinates (R matrix).
+
+        Returns:
+            The M landmark indices the new landmarks were stored at (see add_landmarks)."""
+        polar_detections = np.asarray(polar_detections, dtype=np.float64)
+        slot_indices = [
+            self._add_observation_chunk(polar_detections[start:start + self.max_observations], sensor_noise_cov)
+            for start in range(0, len(polar_detections), self.max_observations)
+        ]
+        self.mark_changed()
+
+        return np.concatenate(slot_indices) if slot_indices else np.empty(0, dtype=np.int64)
+
+    def _add_observation_chunk(self, polar_detections: np.ndarray, sensor_noise_cov: np.ndarray) -> np.ndarray:
+        number_added = len(polar_detections)
+        array_start = self.observed_landmarks
+        slots = self._claim_landmark_slots(number_added)
+        if isinstance(slots, slice):
+            slot_indices = np.arange(array_start, self.observed_landmarks)
+        else:
+            slot_indices = slots
+
+        scratch = self._scratch
+        scratch.parameters[0] = number_added
+        scratch.parameters[1:5] = np.asarray(sensor_noise_cov, dtype=np.float64).ravel()
+        scratch.observations[:number_added] = polar_detections
+        scratch.slots[:number_added] = slot_indices
+        self._run("add_observations")
+
+        # These landmarks came with their covariance, so nothing is left waiting for one.
+        self.observed_covariances = max(self.observed_covariances, int(slot_indices.max()) + 1)
+        self._rebind_views()
+        self._index_new_landmarks(slot_indices, self.observed_landmarks - array_start)
+
+        return slot_indices
+
+    def measurement_update(
+        self,
+        landmark_index: int,
+        polar_measurement: np.ndarray,
+        sensor_noise_cov: np.ndarray
+    ) -> None:
+        """Same as Particles.measurement_update, but every worker runs the EKF for its own shard.
+
+        The workers send back the sum of their new landmark means, so the coordinator never reads
+        the landmark column itself."""
+        r, bearing = polar_measurement[0], polar_measurement[1]
+        parameters = self._scratch.parameters
+        parameters[0] = landmark_index
+        parameters[1:3] = r, bearing
+        parameters[3:6] = self._stretched_noise_terms(r, sensor_noise_cov)
+
+        self._run("measurement_update")
+
+        mean = self._scratch.results[:, :2].sum(axis=0) / self.number_of_particles
+        self.landmark_grid.move(landmark_index, mean)
+        self.mark_changed()
+
+    def gather(self, indices: np.ndarray) -> None:
+        """Same as Particles.gather, but every worker fills its own rows of the spare arrays."""
+        self._scratch.indices[:] = indices
+        self._run("gather")
+        self._swap_spare_arrays()
+
+        self.landmark_grid.move_all(self._landmark_means())
+        self.mark_changed()
+
+    def close(self) -> None:
+        """Stops the workers, then frees the shared memory."""
+        # The finalizer only runs once, so calling close again does nothing.
+        self._finalizer()
+        self._connections = []
+        self._workers = []
+        self._scratch = None
+
+        super().close()
@@ -0,0 +1,350 @@
+"""
+#Shared Map Particles:
+A version of Particles where duplicated particles share landmark estimates instead of copying them.
+
+After resampling, lots of particles are copies of each other. With the normal Particles class every copy
+gets its own copy of the whole map, so resampling moves N × L × (2 + 4 + 1) floats every cycle. In fastSLAM
+most of those landmarks aren't touched again until they are re-observed, so this copying is mostly wasted.
+
+This class follows the idea behind Montemerlo's log(N) fastSLAM: landmark estimates live in a shared pool,
+and each particle just stores a table of which pool entry holds each of its landmarks. Resampling only copies
+that table (one int per landmark), and pool entries are reference counted. When a particle changes a landmark
+that it shares with other particles, it gets its own copy of that entry first (copy-on-write).
+
+Instead of Montemerlo's balanced trees, we use flat (N, L) index tables, so every operation stays vectorised.
+
+The landmarks, covariance and landmark_likelihood attributes still work for reading, but they have to be gathered
+from the pool. Each one is gathered the first time you read it after the particles change (see version), and
+particles[i] only gathers its own rows. They are read only: use the Particles methods to change the map.
+"""
+
+import numpy as np
+from typing import Optional, Union
+
+from particles import (
+    Particles,
+    NUMBER_OF_LANDMARKS,
+    LANDMARK_GROWTH_FACTOR,
+    LANDMARK_CHUNK_SIZE,
+)
+from data_association import DEFAULT_CELL_SIZE
+from map_storage import gather_particles
+from motion_models import MotionModel
+
+# Rule 3: Use dictionaries for more complex lookups.
+# The pool behind each map attribute, and the observed count that says how many of its slots are in use.
+MAP_POOLS = {
+    "landmarks": ("pool_landmarks", "observed_landmarks"),
+    "covariance": ("pool_covariance", "observed_covariances"),
+    "landmark_likelihood": ("pool_likelihood", "observed_landmarks"),
+}
+
+
+class SharedMapParticles(Particles):
+    """A Particles class that stores landmarks in a shared, copy-on-write pool.
+
+    Attributes (on top of Particles):
+    map_table: (N, max_landmarks) pool entry that holds each particle's estimate of each landmark.
+    pool_landmarks, pool_covariance, pool_likelihood: the landmark estimates themselves.
+    pool_refcount: how many (particle, landmark) slots point at each pool entry. 0 means the entry is free.
+    pool_owner: which landmark index each pool entry belongs to."""
+    def __init__(
+        self,
+        number_of_particles: int,
+        initial_pose: np.ndarray,
+        initial_error: Optional[np.ndarray] = None,
+        max_landmarks: int = NUMBER_OF_LANDMARKS,
+        seed: Optional[int] = None,
+        association_cell_size: float = DEFAULT_CELL_SIZE,
+        landmark_cap: Optional[int] = None,
+        motion_model: Optional[MotionModel] = None,
+        shared_memory_name: Optional[str] = None,
+        dtype: Optional[np.dtype] = None,
+        packed_covariance: bool = False
+    ):
+        """The arguments are the same as Particles. dtype sets the pool's precision the same way it sets the map's.
+
+        The pool isn't laid out like the Particles map arrays, so it can't be packed or put in shared memory
+        (Particles.attach wouldn't know how to read it). Both of those raise a ValueError."""
+        if shared_memory_name is not None:
+            raise ValueError(
+                "SharedMapParticles can't use shared_memory_name, the landmark pool isn't laid out like "
+                "the Particles map arrays, so Particles.attach couldn't read it. Use Particles instead."
+            )
+        if packed_covariance:
+            raise ValueError(
+                "SharedMapParticles can't use packed_covariance, its pool always stores full 2x2 covariances."
+            )
+
+        super().__init__(
+            number_of_particles,
+            initial_pose,
+            initial_error,
+            max_landmarks,
+            seed,
+            association_cell_size,
+            landmark_cap,
+            motion_model,
+            dtype=dtype,
+        )
+
+        # Particles.__init__ only sets up the map tables, so the pool can wait until map_dtype is known.
+        self._allocate_pool(number_of_particles * LANDMARK_CHUNK_SIZE)
+
+        # Scratch column used by measurement_update, so it can work on plain arrays.
+        self._column_mean = np.empty((number_of_particles, 2), self.map_dtype)
+        self._column_covariance = np.empty((number_of_particles, 2, 2), self.map_dtype)
+        self._column_tau = np.empty(number_of_particles, self.map_dtype)
+
+        # Whole map arrays gathered at _gathered_version. Every change to the map goes through mark_changed,
+        # so a new version means they're out of date.
+        self._gathered = {}
+        self._gathered_version = None
+
+    # Reading the map.
+    @property
+    def landmarks(self) -> np.ndarray:
+        return self._gather_whole_map("landmarks")
+
+    @property
+    def covariance(self) -> np.ndarray:
+        return self._gather_whole_map("covariance")
+
+    @property
+    def landmark_likelihood(self) -> np.ndarray:
+        return self._gather_whole_map("landmark_likelihood")
+
+    def _gather_whole_map(self, name: str) -> np.ndarray:
+        if self._gathered_version != self.version:
+            self._gathered = {}
+            self._gathered_version = self.version
+
+        if name not in self._gathered:
+            self._gathered[name] = self._map_rows(name, slice(None))
+        return self._gathered[name]
+
+    def _map_rows(self, name: str, index) -> np.ndarray:
+        # Reuse the whole array if it's already been gathered, otherwise only gather the rows we need.
+        if self._gathered_version == self.version and name in self._gathered:
+            return self._gathered[name][index]
+
+        pool, observed = MAP_POOLS[name]
+        return self._read_only(getattr(self, pool)[self.map_table[index, :getattr(self, observed)]])
+
+    @staticmethod
+    def _read_only(array: np.ndarray) -> np.ndarray:
+        # These are copies, so writing to them would silently do nothing. Make that an error instead.
+        array.flags.writeable = False
+        return array
+
+    def shared_fraction(self) -> float:
+        """How much smaller the pool is than a full copy of every map. 0 means nothing is shared."""
+        slots = self.number_of_particles * self.observed_landmarks
+        if slots == 0:
+            return 0.
+        used_entries = np.count_nonzero(self.pool_refcount)
+        return 1 - used_entries / slots
+
+    # Pool management.
+    def _allocate_pool(self, capacity: int) -> None:
+        self.pool_landmarks = np.empty((capacity, 2), self.map_dtype)
+        self.pool_covariance = np.empty((capacity, 2, 2), self.map_dtype)
+        self.pool_likelihood = np.empty(capacity, self.map_dtype)
+        self.pool_refcount = np.zeros(capacity, np.int64)
+        self.pool_owner = np.zeros(capacity, np.intp)
+
+        # Free entries are kept in a stack. The top of the stack is _free_entries[_free_count - 1].
+        self._free_entries = np.arange(capacity, dtype=np.intp)[::-1].copy()
+        self._free_count = capacity
+
+    def _grow_pool(self, required: int) -> None:
+        """Grows the pool geometrically, the same way Particles grows its landmark arrays."""
+        old_capacity = self.pool_refcount.shape[0]
+        new_capacity = max(required, int(old_capacity * LANDMARK_GROWTH_FACTOR))
+
+        old_pool = (
+            self.pool_landmarks, self.pool_covariance, self.pool_likelihood,
+            self.pool_refcount, self.pool_owner
+        )
+        free_entries = self._free_entries[:self._free_count].copy()
+        self._allocate_pool(new_capacity)
+
+        for new_array, old_array in zip(
+            (self.pool_landmarks, self.pool_covariance, self.pool_likelihood,
+             self.pool_refcount, self.pool_owner),
+            old_pool
+        ):
+            new_array[:old_capacity] = old_array
+
+        # Everything past the old pool is free, along with whatever was free before.
+        new_entries = np.arange(new_capacity - 1, old_capacity - 1, -1, dtype=np.intp)
+        self._free_count = new_entries.shape[0] + free_entries.shape[0]
+        self._free_entries[:new_entries.shape[0]] = new_entries
+        self._free_entries[new_entries.shape[0]:self._free_count] = free_entries
+
+    def _take_entries(self, count: int) -> np.ndarray:
+        """Pops count free entries off the stack."""
+        if count > self._free_count:
+            in_use = self.pool_refcount.shape[0] - self._free_count
+            self._grow_pool(in_use + count)
+
+        self._free_count -= count
+        return self._free_entries[self._free_count:self._free_count + count].copy()
+
+    def _release_entries(self, entries: np.ndarray) -> None:
+        """Drops one reference for every entry in entries (repeats allowed), freeing any that reach zero."""
+        np.subtract.at(self.pool_refcount, entries, 1)
+        released = np.unique(entries)
+        freed = released[self.pool_refcount[released] == 0]
+
+        self._free_entries[self._free_count:self._free_count + freed.shape[0]] = freed
+        self._free_count += freed.shape[0]
+
+    def _recount_entries(self) -> None:
+        """Rebuilds every reference count (and the free stack) from the map tables."""
+        self.pool_refcount[:] = np.bincount(
+            self.map_table[:, :self.observed_landmarks].ravel(),
+            minlength=self.pool_refcount.shape[0]
+        )
+        free = np.flatnonzero(self.pool_refcount == 0)
+        self._free_count = free.shape[0]
+        self._free_entries[:self._free_count] = free
+
+    def _detach_column(self, landmark_index: int, copy_data: bool = True) -> np.ndarray:
+        """Copy-on-write: makes sure no particle shares its entry for landmark_index with another particle.
+
+        Returns:
+            (N,) view of the map table column. Every entry in it now has a reference count of one."""
+        entries = self.map_table[:, landmark_index]
+        shared = self.pool_refcount[entries] > 1
+        number_shared = np.count_nonzero(shared)
+        if number_shared == 0:
+            return entries
+
+        old_entries = entries[shared]
+        new_entries = self._take_entries(number_shared)
+        if copy_data:
+            self.pool_landmarks[new_entries] = self.pool_landmarks[old_entries]
+            self.pool_covariance[new_entries] = self.pool_covariance[old_entries]
+            self.pool_likelihood[new_entries] = self.pool_likelihood[old_entries]
+        self.pool_refcount[new_entries] = 1
+        self.pool_owner[new_entries] = landmark_index
+
+        self._release_entries(old_entries)
+        entries[shared] = new_entries
+
+        return entries
+
+    def _shared_entries(self, landmark_indices) -> Optional[np.ndarray]:
+        """If every particle points at the same entry for each of landmark_indices, returns those entries."""
+        columns = self.map_table[:, landmark_indices]
+        if np.all(columns == columns[0]):
+            return columns[0]
+        return None
+
+    # Particles hooks.
+    def _allocate_landmark_arrays(self, capacity: int) -> None:
+        # -1 means the slot doesn't point at anything yet.
+        self.map_table = np.full((self.number_of_particles, capacity), -1, np.intp)
+        self._spare_map_table = np.full_like(self.map_table, -1)
+
+    def _resize_landmark_arrays(self, new_capacity: int) -> None:
+        old_table = self.map_table[:, :self.observed_landmarks]
+        self._allocate_landmark_arrays(new_capacity)
+        self.max_landmarks = new_capacity
+        self.map_table[:, :old_table.shape[1]] = old_table
+
+    def _rebind_views(self) -> None:
+        # landmarks, covariance and landmark_likelihood are properties, so there is nothing to rebind.
+        pass
+
+    def _write_new_landmarks(
+        self, slots: Union[slice, np.ndarray], landmark_positions: np.ndarray
+    ) -> None:
+        slot_indices = np.arange(self.max_landmarks)[slots]
+
+        # Evicted landmarks (when we're at landmark_cap) give their entries back first.
+        old_entries = self.map_table[:, slot_indices].ravel()
+        self._release_entries(old_entries[old_entries >= 0])
+
+        number_added = slot_indices.shape[0]
+        if landmark_positions.ndim == 3:
+            # Every particle has its own estimate.
+            entries = self._take_entries(self.number_of_particles * number_added)
+            entries = entries.reshape(self.number_of_particles, number_added)
+            self.pool_refcount[entries] = 1
+        else:
+            # Every particle agrees, so they can all share one entry per landmark.
+            entries = self._take_entries(number_added)
+            self.pool_refcount[entries] = self.number_of_particles
+
+        self.pool_landmarks[entries] = landmark_positions
+        self.pool_likelihood[entries] = 1
+        self.pool_owner[entries] = slot_indices
+        self.map_table[:, slot_indices] = entries
+
+    def _landmark_means(self, landmark_indices=None) -> np.ndarray:
+        if landmark_indices is None:
+            landmark_indices = slice(0, self.observed_landmarks)
+        entries = self.map_table[:, landmark_indices]
+
+        # np.take is a lot faster than fancy indexing for big gathers.
+        return np.take(self.pool_landmarks, entries, axis=0).mean(axis=0)
+
+    def update_landmark(self, landmark_index: int, landmark_position: np.ndarray) -> None:
+        landmark_position = np.asarray(landmark_position)
+        entries = self._shared_entries(landmark_index)
+        if entries is None or landmark_position.ndim > 1:
+            entries = self._detach_column(landmark_index)
+
+        self.pool_landmarks[entries] = landmark_position
+        self.landmark_grid.move(landmark_index, self._landmark_means(landmark_index))
+        self.mark_changed()
+
+    def update_covariance(self, landmark_index, covariance_matrix) -> None:
+        covariance_matrix = np.asarray(covariance_matrix)
+        entries = self._shared_entries(landmark_index)
+        if entries is None or covariance_matrix.ndim > 2:
+            entries = self._detach_column(landmark_index)
+
+        self.pool_covariance[entries] = covariance_matrix
+        self.mark_changed()
+
+    def _write_covariances(self, slots: list, covariance_matrices: np.ndarray) -> None:
+        entries = self._shared_entries(slots)
+        if entries is not None and covariance_matrices.ndim == 3:
+            self.pool_covariance[entries] = covariance_matrices
+            return
+
+        for slot in slots:
+            self._detach_column(slot)
+        self.pool_covariance[self.map_table[:, slots]] = covariance_matrices
+
+    def _landmark_column(self, landmark_index: int) -> tuple:
+        entries = self.map_table[:, landmark_index]
+        np.take(self.pool_landmarks, entries, axis=0, out=self._column_mean)
+        np.take(self.pool_covariance, entries, axis=0, out=self._column_covariance)
+        np.take(self.pool_likelihood, entries, axis=0, out=self._column_tau)
+
+        return self._column_mean, self._column_covariance, self._column_tau
+
+    def _store_landmark_column(
+        self, landmark_index: int, mean: np.ndarray, sigma: np.ndarray, tau: np.ndarray
+    ) -> None:
+        # Every particle's estimate has just changed, so every particle needs its own entry.
+        entries = self._detach_column(landmark_index, copy_data=False)
+        self.pool_landmarks[entries] = mean
+        self.pool_covariance[entries] = sigma
+        self.pool_likelihood[entries] = tau
+
+    def _candidate_landmarks(self, landmark_indices: np.ndarray) -> tuple:
+        entries = self.map_table[:, landmark_indices]
+        return self.pool_landmarks[entries], self.pool_covariance[entries]
+
+    def _gather_maps(self, indices: np.ndarray) -> None:
+        """Resampling only copies the map tables (the columns in use). The pool itself doesn't move."""
+        gather_particles(self.map_table, indices, self._spare_map_table, 0, 1, self.observed_landmarks)
+
+    def _swap_spare_maps(self) -> None:
+        self.map_table, self._spare_map_table = self._spare_map_table, self.map_table
+        self._recount_entries()
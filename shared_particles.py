@@ -0,0 +1,308 @@
+"""
+#Shared Memory:
+Lets another process (like a viewer, or a second ROS node) read a live Particles object without copying anything.
+
+When you pass shared_memory_name to Particles, its arrays are allocated in multiprocessing.shared_memory
+instead of normal numpy memory. Particles.attach(name) in another process maps the same memory and gives
+you a read-only Particles whose views point straight at it.
+
+The memory is split into two kinds of block:
+- The control block, called name. It holds a small header, both pose buffers (live and spare, see
+  Particles.gather) and the importance factors. It never changes size.
+- A map block, called name_map<generation>. It holds the live and spare landmark, Tau and covariance arrays,
+  in whichever layout the owner uses (see map_storage.py). When the map outgrows it, a bigger one is made with the next generation number and the old one is unlinked.
+
+Only the owner registers its blocks with multiprocessing's resource tracker (see attach_block). Otherwise a reader
+exiting would unlink blocks the owner is still using.
+
+The header is a row of int64s (see HEADER_FIELDS) saying how many landmarks there are, which buffers are live,
+and which map block to use. It is guarded by a seqlock: the writer makes sequence odd, writes the header, then
+makes it even again. A reader that sees an odd sequence, or a different sequence after reading, just tries
+again later. The arrays themselves aren't locked, so a reader can see a frame that is half way through an
+update. That's fine for drawing. If you need a consistent copy, use the snapshots in filter_worker.py instead.
+"""
+
+import sys
+import threading
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional
+
+import numpy as np
+
+from map_storage import storage_shapes
+
+# Rule 3: Use dictionaries for more complex lookups.
+HEADER_FIELDS = (
+    "magic",
+    "sequence",
+    "version",
+    "number_of_particles",
+    "capacity",
+    "observed_landmarks",
+    "observed_covariances",
+    "live_poses",
+    "live_map",
+    "map_generation",
+    "map_itemsize",
+    "pose_itemsize",
+    "packed_covariance",
+    "particle_capacity",
+)
+HEADER = {field: index for index, field in enumerate(HEADER_FIELDS)}
+HEADER_SLOTS = 16  # int64s reserved for the header, so fields can be added without moving the arrays.
+MAGIC = 0x636C6F756473  # "clouds"
+
+POSE_SIZE = 3
+HEADER_ITEMSIZE = 8
+
+
+def _map_block_name(name: str, generation: int) -> str:
+    return f"{name}_map{generation}"
+
+
+_attach_lock = threading.Lock()
+
+
+def attach_block(name: str) -> shared_memory.SharedMemory:
+    """Maps an existing shared memory block without registering it with this process's resource tracker.
+
+    Before Python 3.13, SharedMemory(name) registers every block it maps, and the tracker unlinks everything
+    still registered when the process exits. So a reader exiting would unlink the owner's blocks. We can't
+    just unregister afterwards either: spawned workers (and readers in the owner's own process) share the
+    owner's tracker, which only remembers each name once, so that would drop the owner's registration too.
+    Instead, registration is skipped for this one name, which is what track=False does on 3.13+."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+
+    with _attach_lock:
+        register = resource_tracker.register
+
+        def register_other_blocks(resource_name, resource_type):
+            if resource_name.lstrip("/") != name:
+                register(resource_name, resource_type)
+
+        resource_tracker.register = register_other_blocks
+        try:
+            return shared_memory.SharedMemory(name)
+        finally:
+            resource_tracker.register = register
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+class SharedParticleMemory:
+    """The shared memory blocks behind one Particles object.
+
+    Use create in the process that owns the filter and attach everywhere else.
+
+    Attributes:
+    name: the name of the control block. This is what you pass to Particles.attach.
+    header: (HEADER_SLOTS,) int64 view of the header.
+    poses: (2, N, 3) live and spare pose buffers.
+    importance_factors: (N,) importance factors. N is the particle_capacity, see AdaptiveParticles.
+    landmarks, landmark_likelihood, covariance: the current map block's storage arrays, each with a leading
+        axis of 2 for the live and spare copies."""
+    def __init__(self, control_block: shared_memory.SharedMemory, owner: bool):
+        self.name = control_block.name
+        self.owner = owner
+        # True until the owner has unlinked the blocks (see unlink).
+        self._linked = owner
+        self._control_block = control_block
+        self._map_block = None
+        self._retired_blocks = []
+
+        self.header = np.ndarray((HEADER_SLOTS,), np.int64, control_block.buf)
+        # The arrays have room for particle_capacity particles, number_of_particles of them are in use.
+        number_of_particles = int(self.header[HEADER["particle_capacity"]])
+        pose_dtype = np.dtype(f"f{self.header[HEADER['pose_itemsize']]}")
+        offset = HEADER_SLOTS * HEADER_ITEMSIZE
+        self.poses = np.ndarray(
+            (2, number_of_particles, POSE_SIZE), pose_dtype, control_block.buf, offset
+        )
+        offset += self.poses.nbytes
+        self.importance_factors = np.ndarray(
+            (number_of_particles,), pose_dtype, control_block.buf, offset
+        )
+
+        self.landmarks = self.landmark_likelihood = self.covariance = None
+        self.map_generation = None
+
+    @classmethod
+    def create(
+        cls, name: str, number_of_particles: int, pose_dtype=np.float64
+    ) -> "SharedParticleMemory":
+        """Makes a new control block with room for number_of_particles. The map block is made by allocate_map."""
+        pose_dtype = np.dtype(pose_dtype)
+        size = HEADER_SLOTS * HEADER_ITEMSIZE + (2 * POSE_SIZE + 1) * number_of_particles * pose_dtype.itemsize
+        control_block = shared_memory.SharedMemory(name, create=True, size=size)
+
+        header = np.ndarray((HEADER_SLOTS,), np.int64, control_block.buf)
+        header[:] = 0
+        header[HEADER["magic"]] = MAGIC
+        header[HEADER["number_of_particles"]] = number_of_particles
+        header[HEADER["particle_capacity"]] = number_of_particles
+        header[HEADER["map_generation"]] = -1
+        header[HEADER["pose_itemsize"]] = pose_dtype.itemsize
+        del header
+
+        return cls(control_block, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedParticleMemory":
+        """Maps an existing control block, made by another process."""
+        control_block = attach_block(name)
+        if control_block.buf[:HEADER_ITEMSIZE].cast("q")[0] != MAGIC:
+            control_block.close()
+            raise ValueError(f"shared memory block {name!r} doesn't hold particles.")
+
+        return cls(control_block, owner=False)
+
+    def _map_shapes(self, capacity: int, packed: bool) -> list:
+        shapes = storage_shapes(self.poses.shape[1], capacity, packed)
+        return [(2,) + shape for shape in shapes]
+
+    def _bind_map(self, block, capacity: int, dtype, packed: bool) -> None:
+        arrays = []
+        offset = 0
+        for shape in self._map_shapes(capacity, packed):
+            array = np.ndarray(shape, dtype, block.buf, offset)
+            offset += array.nbytes
+            arrays.append(array)
+
+        self.landmarks, self.landmark_likelihood, self.covariance = arrays
+        self._map_block = block
+
+    def allocate_map(self, capacity: int, dtype, packed: bool = False) -> None:
+        """Makes a new map block with room for capacity landmarks, and unlinks the old one.
+
+        The old block stays mapped (so its arrays can still be copied from) until close is called."""
+        dtype = np.dtype(dtype)
+        generation = int(self.header[HEADER["map_generation"]]) + 1
+        size = sum(int(np.prod(shape)) for shape in self._map_shapes(capacity, packed)) * dtype.itemsize
+
+        if self._map_block is not None:
+            self._map_block.unlink()
+            self._retired_blocks.append(self._map_block)
+            self.landmarks = self.landmark_likelihood = self.covariance = None
+
+        block = shared_memory.SharedMemory(
+            _map_block_name(self.name, generation), create=True, size=max(size, 1)
+        )
+        self._bind_map(block, capacity, dtype, packed)
+        self.map_generation = generation
+
+        self.publish(
+            capacity=capacity,
+            map_generation=generation,
+            map_itemsize=dtype.itemsize,
+            packed_covariance=int(packed),
+        )
+
+    def attach_map(self, generation: int, capacity: int, itemsize: int, packed: bool) -> None:
+        """Maps the map block for generation, made by the owner."""
+        block = attach_block(_map_block_name(self.name, generation))
+        if self._map_block is not None:
+            self._retired_blocks.append(self._map_block)
+            self.landmarks = self.landmark_likelihood = self.covariance = None
+
+        self._bind_map(block, capacity, np.dtype(f"f{itemsize}"), packed)
+        self.map_generation = generation
+
+    def publish(self, **fields) -> None:
+        """Writes header fields under the seqlock."""
+        header = self.header
+        header[HEADER["sequence"]] += 1
+        for field, value in fields.items():
+            header[HEADER[field]] = value
+        header[HEADER["sequence"]] += 1
+
+    def read_header(self) -> Optional[dict]:
+        """Returns a consistent copy of the header, or None if the owner is writing it right now."""
+        sequence = int(self.header[HEADER["sequence"]])
+        if sequence % 2:
+            return None
+
+        values = self.header[:len(HEADER_FIELDS)].copy()
+        if int(self.header[HEADER["sequence"]]) != sequence:
+            return None
+
+        return dict(zip(HEADER_FIELDS, values.tolist()))
+
+    def unlink(self) -> None:
+        """Removes the owner's blocks from the system, without unmapping them (close does both).
+
+        Processes that have them mapped carry on as normal. This is for when the owner can't close yet,
+        because its arrays are still in use. Does nothing for readers, or if it's already been done."""
+        if not self._linked:
+            return
+
+        for block in (self._map_block, self._control_block):
+            if block is not None:
+                block.unlink()
+        self._linked = False
+
+    def close(self) -> None:
+        """Unmaps every block. The owner also unlinks them, so they are freed once every reader has closed too.
+
+        Drop any views you took of the arrays first, or the unmap fails with a BufferError."""
+        self.header = self.poses = self.importance_factors = None
+        self.landmarks = self.landmark_likelihood = self.covariance = None
+
+        for block in self._retired_blocks:
+            block.close()
+        for block in (self._map_block, self._control_block):
+            if block is None:
+                continue
+            block.close()
+            if self._linked:
+                block.unlink()
+        self._linked = False
+
+        self._retired_blocks = []
+        self._map_block = self._control_block = None
+
+
+def bind_attached(particles, memory: SharedParticleMemory) -> bool:
+    """Points an attached Particles object's views at the newest state in memory.
+
+    Returns False if nothing has changed, or the owner was half way through writing the header."""
+    header = memory.read_header()
+    if header is None or header["version"] == particles.version:
+        return False
+
+    if header["map_generation"] < 0:
+        return False
+    if header["map_generation"] != memory.map_generation:
+        try:
+            memory.attach_map(
+                header["map_generation"], header["capacity"], header["map_itemsize"],
+                bool(header["packed_covariance"])
+            )
+        except FileNotFoundError:
+            # The owner grew the map again since we read the header. Try next time.
+            return False
+
+    particles.number_of_particles = number_of_particles = header["number_of_particles"]
+    particles.particle_capacity = header["particle_capacity"]
+    particles.observed_landmarks = header["observed_landmarks"]
+    particles.observed_covariances = header["observed_covariances"]
+    particles.max_landmarks = header["capacity"]
+    particles.version = header["version"]
+    particles.packed_covariance = bool(header["packed_covariance"])
+    particles.pose_dtype = memory.poses.dtype
+    particles.map_dtype = memory.landmarks.dtype
+
+    live_map = header["live_map"]
+    particles.poses = _read_only(memory.poses[header["live_poses"]][:number_of_particles])
+    particles.importance_factors = _read_only(memory.importance_factors[:number_of_particles])
+    particles._bind_landmark_arrays(
+        _read_only(memory.landmarks[live_map]),
+        _read_only(memory.landmark_likelihood[live_map]),
+        _read_only(memory.covariance[live_map]),
+    )
+
+    return True
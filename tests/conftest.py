@@ -0,0 +1,42 @@
+"""
+Shared setup for the tests. The modules live in the repo root (from particles import ...), so it goes on the path,
+the same way the benchmarks do it.
+"""
+
+import os
+import secrets
+import sys
+
+import numpy as np
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+ALPHAS = [0.01, 0.0001, 0.0001, 0.001, 0.05, 0.1]
+SENSOR_NOISE = np.array(((0.1, 0.01), (0.01, 0.02)))
+DETECTIONS = np.array(((3., 0.1), (4., -0.3), (5., 1.), (6., 2.), (2., 0.)))
+
+
+@pytest.fixture
+def shared_memory_name():
+    """A name nothing else is using, so tests can run side by side."""
+    return f"clouds_test_{secrets.token_hex(4)}"
+
+
+def make_particles(number_of_particles=200, **kwargs):
+    """A seeded Particles with a small starting spread. kwargs go straight to Particles."""
+    from particles import Particles
+
+    kwargs.setdefault("seed", 0)
+    return Particles(number_of_particles, np.zeros(3), np.array((0.1, 0.1, 0.05)), **kwargs)
+
+
+def add_detections(particles, detections=DETECTIONS, sensor_noise_cov=SENSOR_NOISE):
+    """Adds a landmark for every detection, the way the demo scripts do. Returns the landmark indices."""
+    from particles import get_landmark_offsets, get_landmark_covs
+
+    positions = get_landmark_offsets(particles, detections) + particles.poses[:, None, :2]
+    return particles.add_landmarks(
+        positions, get_landmark_covs(detections, sensor_noise_cov, particles.poses[:, 2])
+    )
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from particles import Particles
+from adaptive_particles import AdaptiveParticles, kld_particle_count
+from motion_models import VelocityMotionModel
+
+from .conftest import ALPHAS, SENSOR_NOISE, DETECTIONS, add_detections
+
+
+def make_particles(initial_error, **kwargs):
+    kwargs.setdefault("seed", 0)
+    return AdaptiveParticles(100, 5000, np.zeros(3), np.asarray(initial_error), **kwargs)
+
+
+def test_kld_count_grows_with_the_occupied_bins():
+    counts = kld_particle_count(np.array((1, 2, 10, 100, 1000)))
+    assert counts[0] == 1
+    assert np.all(np.diff(counts) > 0)
+
+
+def test_count_follows_the_spread_of_the_belief():
+    tight = make_particles((0.01, 0.01, 0.001))
+    tight.resample()
+    assert 100 <= tight.number_of_particles < 500
+
+    spread = make_particles((5., 5., 1.))
+    spread.resample()
+    assert spread.number_of_particles == 5000
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_resamples_in_either_precision(dtype):
+    particles = make_particles((1., 1., 0.5), dtype=dtype)
+    add_detections(particles)
+    particles.measurement_update(1, DETECTIONS[1], SENSOR_NOISE)
+
+    assert particles.resample()
+    assert 100 <= particles.number_of_particles <= 5000
+    assert particles.poses.dtype == dtype
+    assert np.all(np.isfinite(particles.poses))
+
+
+def test_matches_particles_on_the_same_rows():
+    model = VelocityMotionModel(ALPHAS)
+    adaptive = make_particles((0.1, 0.1, 0.05), motion_model=model, initial_particles=5000)
+    plain = Particles(5000, np.zeros(3), np.array((0.1, 0.1, 0.05)), seed=0, motion_model=model)
+
+    for particles in (adaptive, plain):
+        add_detections(particles)
+        particles.predict((1., 0.2), 0.1)
+        particles.measurement_update(1, DETECTIONS[1], SENSOR_NOISE)
+    np.testing.assert_array_equal(adaptive.poses, plain.poses)
+    np.testing.assert_array_equal(adaptive.importance_factors, plain.importance_factors)
+
+    # After a resample the count drops, and every array is a view of that many rows.
+    adaptive.resample()
+    count = adaptive.number_of_particles
+    assert count < 5000
+    assert adaptive.poses.shape == (count, 3)
+    assert adaptive.landmarks.shape == (count, len(DETECTIONS), 2)
+    assert adaptive.covariance.shape == (count, len(DETECTIONS), 2, 2)
+    np.testing.assert_allclose(adaptive.importance_factors, 1 / count)
+
+    # Gathering more rows than are in use grows the count again, still inside the same arrays.
+    poses, landmarks = adaptive.poses.copy(), adaptive.landmarks.copy()
+    indices = np.arange(2 * count) % count
+    adaptive.gather(indices)
+    assert adaptive.number_of_particles == 2 * count
+    np.testing.assert_array_equal(adaptive.poses, poses[indices])
+    np.testing.assert_array_equal(adaptive.landmarks, landmarks[indices])
+
+
+def test_attached_particles_follow_the_count(shared_memory_name):
+    owner = make_particles((0.01, 0.01, 0.001), shared_memory_name=shared_memory_name)
+    reader = Particles.attach(shared_memory_name)
+    try:
+        assert reader.number_of_particles == 5000
+        owner.resample()
+        assert reader.refresh()
+        assert reader.number_of_particles == owner.number_of_particles < 5000
+        np.testing.assert_array_equal(reader.poses, owner.poses)
+    finally:
+        reader.close()
+        owner.close()
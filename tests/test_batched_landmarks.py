@@ -0,0 +1,36 @@
+import numpy as np
+
+from particles import get_landmark_cov, get_landmark_covs, get_landmark_offset, get_landmark_offsets
+
+from .conftest import SENSOR_NOISE, DETECTIONS, make_particles
+
+
+def test_batched_offsets_and_covariances_match_the_single_versions():
+    particles = make_particles(20)
+    offsets = get_landmark_offsets(particles, DETECTIONS)
+    covariances = get_landmark_covs(DETECTIONS, SENSOR_NOISE, particles.poses[:, 2])
+
+    for detection_index, detection in enumerate(DETECTIONS):
+        np.testing.assert_allclose(offsets[:, detection_index], get_landmark_offset(particles, detection))
+        for particle_index, heading in enumerate(particles.poses[:, 2]):
+            global_detection = (detection[0], detection[1] + heading)
+            np.testing.assert_allclose(
+                covariances[particle_index, detection_index], get_landmark_cov(global_detection, SENSOR_NOISE)
+            )
+
+
+def test_add_landmarks_matches_adding_one_at_a_time():
+    batched = make_particles(20)
+    single = make_particles(20)
+    positions = get_landmark_offsets(batched, DETECTIONS) + batched.poses[:, None, :2]
+    covariances = get_landmark_covs(DETECTIONS, SENSOR_NOISE, batched.poses[:, 2])
+
+    indices = batched.add_landmarks(positions, covariances)
+    for landmark_index in range(len(DETECTIONS)):
+        single.add_landmark(positions[:, landmark_index])
+        single.add_covariance(covariances[:, landmark_index])
+
+    assert indices.tolist() == list(range(len(DETECTIONS)))
+    np.testing.assert_array_equal(batched.landmarks, single.landmarks)
+    np.testing.assert_array_equal(batched.covariance, single.covariance)
+    np.testing.assert_array_equal(batched.landmark_likelihood, 1)
@@ -0,0 +1,16 @@
+import numpy as np
+
+from .conftest import SENSOR_NOISE, DETECTIONS, add_detections, make_particles
+
+
+def test_associate_finds_the_landmark_and_gates_new_ones():
+    particles = make_particles(50, dtype=np.float64)
+    add_detections(particles)
+    detections = np.vstack((DETECTIONS[[2, 0]], ((30., 0.),)))
+
+    associations = particles.associate(detections, SENSOR_NOISE)
+
+    assert associations.shape == (50, 3)
+    np.testing.assert_array_equal(associations[:, 0], 2)
+    np.testing.assert_array_equal(associations[:, 1], 0)
+    np.testing.assert_array_equal(associations[:, 2], -1)
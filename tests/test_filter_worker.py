@@ -0,0 +1,41 @@
+import numpy as np
+
+from particles import Particles
+from filter_worker import SnapshotBuffer, FilterWorker
+from motion_models import VelocityMotionModel
+
+from .conftest import ALPHAS, DETECTIONS, add_detections
+
+
+def test_snapshots_are_read_only_copies():
+    particles = Particles(20, np.zeros(3), seed=0)
+    add_detections(particles)
+    buffer = SnapshotBuffer(particles.number_of_particles)
+
+    buffer.publish(particles)
+    snapshot = buffer.latest()
+    assert buffer.latest() is None
+
+    np.testing.assert_array_equal(snapshot.landmarks, particles.landmarks)
+    assert snapshot.observed_landmarks == len(DETECTIONS)
+    assert not snapshot.poses.flags.writeable
+
+    # Changing the particles (or publishing again) doesn't touch the snapshot being read.
+    particles.poses += 1
+    buffer.publish(particles)
+    np.testing.assert_array_equal(snapshot.poses, 0)
+    np.testing.assert_array_equal(buffer.latest().poses, 1)
+
+
+def test_filter_worker_publishes_every_step():
+    particles = Particles(20, np.zeros(3), seed=0, motion_model=VelocityMotionModel(ALPHAS))
+    worker = FilterWorker(particles, lambda particles: particles.predict((1., 0.), 0.1))
+    worker.start()
+    while worker.steps_run < 5:
+        worker.reader.refresh()
+    worker.stop(timeout=5)
+
+    assert not worker.is_alive()
+    worker.reader.refresh()
+    np.testing.assert_array_equal(worker.reader.poses, particles.poses)
+    assert worker.reader.version == particles.version
@@ -0,0 +1,13 @@
+import subprocess
+import sys
+
+from .conftest import REPO_ROOT
+
+
+def test_importing_particles_skips_plotting_and_qt():
+    """A headless node shouldn't pay for matplotlib or Qt."""
+    script = f"import sys; sys.path.insert(0, {REPO_ROOT!r}); import particles; print(sorted(sys.modules))"
+    modules = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+
+    assert "matplotlib" not in modules
+    assert "PyQt5" not in modules
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from particles import Particle, ParticleSubset
+
+from .conftest import make_particles
+
+
+def test_indexing_gives_particles_and_subsets():
+    particles = make_particles(10)
+    mask = np.arange(10) % 3 == 0
+
+    assert isinstance(particles[2], Particle)
+    assert isinstance(particles[::2], ParticleSubset)
+    np.testing.assert_array_equal(particles[mask].poses, particles.poses[mask])
+    np.testing.assert_array_equal(particles[[1, 4]].indices, [1, 4])
+
+    particles[1:3].poses[:] = 7
+    np.testing.assert_array_equal(particles[2].pose, 7)
+    with pytest.raises(IndexError):
+        particles[10]
@@ -0,0 +1,53 @@
+import gc
+
+import numpy as np
+
+from particles import Particles
+from instrumentation import Instrumentation, PARTICLE_STAGES
+from motion_models import VelocityMotionModel
+
+from .conftest import ALPHAS, SENSOR_NOISE, DETECTIONS, add_detections
+
+
+def test_each_stage_is_recorded_and_disabling_unwraps():
+    particles = Particles(50, np.zeros(3), seed=0, motion_model=VelocityMotionModel(ALPHAS))
+    instrumentation = particles.enable_instrumentation()
+
+    particles.predict((1., 0.2), 0.1)
+    add_detections(particles)
+    particles.associate(DETECTIONS, SENSOR_NOISE)
+    particles.measurement_update(0, DETECTIONS[0], SENSOR_NOISE)
+    particles.resample()
+
+    summary = instrumentation.summary()
+    for stage in ("predict", "landmark_insert", "covariance_insert", "associate", "measurement_update", "resample"):
+        assert summary[stage]["count"] == 1, stage
+    # Once for associate's per-particle covariances, once for measurement_update's stretched noise.
+    assert summary["covariance_transform"]["count"] == 2
+
+    particles.disable_instrumentation()
+    assert not any(name in vars(particles) for name in PARTICLE_STAGES)
+    particles.predict((1., 0.2), 0.1)
+    assert instrumentation.stats("predict")["count"] == 1
+
+
+def test_instrumenting_doesnt_keep_particles_alive():
+    instrumentation = Instrumentation()
+    particles = Particles(10, np.zeros(3))
+    particles.enable_instrumentation(instrumentation)
+
+    del particles
+    gc.collect()
+    assert len(instrumentation._wrapped) == 0
+
+
+def test_ring_buffer_keeps_the_newest_records_and_exports_the_rest():
+    exported = []
+    instrumentation = Instrumentation(capacity=4, exporter=lambda records, names: exported.append(records))
+    code = instrumentation.stage_code("stage")
+    for record in range(10):
+        instrumentation.record(code, float(record), 0.001)
+
+    np.testing.assert_array_equal(instrumentation.records("stage")["start"], (6, 7, 8, 9))
+    instrumentation.flush()
+    np.testing.assert_array_equal(np.concatenate(exported)["start"], np.arange(10))
@@ -0,0 +1,28 @@
+import numpy as np
+
+from .conftest import DETECTIONS, add_detections, make_particles
+
+
+def test_landmark_arrays_grow_without_losing_the_map():
+    particles = make_particles(10, max_landmarks=2)
+    add_detections(particles)
+    landmarks = particles.landmarks.copy()
+
+    add_detections(particles)
+
+    assert particles.max_landmarks >= 10
+    np.testing.assert_array_equal(particles.landmarks[:, :len(DETECTIONS)], landmarks)
+    assert len(particles.landmark_grid) == 2 * len(DETECTIONS)
+
+
+def test_landmark_cap_evicts_the_least_likely_landmark():
+    particles = make_particles(10, max_landmarks=2, landmark_cap=len(DETECTIONS))
+    add_detections(particles)
+    particles.landmark_likelihood[:, :] = 5
+    particles.landmark_likelihood[:, 3] = 1
+
+    indices = add_detections(particles, DETECTIONS[:1])
+
+    assert particles.max_landmarks == len(DETECTIONS)
+    assert indices.tolist() == [3]
+    np.testing.assert_array_equal(particles.landmark_likelihood[:, 3], 1)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from particles import Particles
+from map_storage import landmark_view, covariance_view, storage_shapes
+from motion_models import VelocityMotionModel
+
+from .conftest import ALPHAS, SENSOR_NOISE, DETECTIONS, add_detections
+
+
+def run_filter(**kwargs):
+    particles = Particles(
+        60, np.zeros(3), np.array((0.1, 0.1, 0.05)), seed=1, max_landmarks=2,
+        motion_model=VelocityMotionModel(ALPHAS), **kwargs
+    )
+    add_detections(particles)
+    for step in range(3):
+        particles.predict((1., 0.2), 0.1)
+        particles.measurement_update(step, DETECTIONS[step], SENSOR_NOISE)
+        particles.resample()
+
+    return particles
+
+
+def test_packed_views_look_like_full_matrices():
+    landmark_shape, _, covariance_shape = storage_shapes(4, 8, packed=True)
+    landmarks = np.zeros(landmark_shape)
+    covariance = np.zeros(covariance_shape)
+
+    covariance_view(covariance, 3, packed=True)[:] = SENSOR_NOISE
+    landmark_view(landmarks, 3, packed=True)[:] = (1., 2.)
+
+    # Each plane holds one component: xx, xy and yy for covariance, x and y for landmarks.
+    np.testing.assert_array_equal(covariance[:, 0, 0], (SENSOR_NOISE[0, 0], SENSOR_NOISE[0, 1], SENSOR_NOISE[1, 1]))
+    np.testing.assert_array_equal(landmarks[:, 0, 0], (1., 2.))
+    np.testing.assert_array_equal(covariance_view(covariance, 3, packed=True), np.broadcast_to(SENSOR_NOISE, (4, 3, 2, 2)))
+    np.testing.assert_array_equal(landmarks[:, 3:], 0)
+    assert landmark_view(landmarks, 3, packed=True).shape == (4, 3, 2)
+
+    # The particles are the last axis, so one landmark across every particle is contiguous.
+    assert landmark_view(landmarks, 3, packed=True)[:, 1, 0].strides == (landmarks.itemsize,)
+    assert covariance_view(covariance, 3, packed=True)[:, 1, 0, 1].strides == (covariance.itemsize,)
+
+
+@pytest.mark.parametrize("dtype, packed", [(None, True), (np.float64, False), (np.float64, True), (np.float32, False)])
+def test_layouts_and_dtypes_match_the_default(dtype, packed):
+    default = run_filter()
+    other = run_filter(dtype=dtype, packed_covariance=packed)
+
+    map_dtype = np.float32 if dtype is None else dtype
+    assert other.landmarks.dtype == map_dtype and other.covariance.dtype == map_dtype
+    assert other.landmarks.shape == default.landmarks.shape
+    assert other.covariance.shape == default.covariance.shape
+
+    tolerance = 1e-6 if dtype is None else 1e-4
+    np.testing.assert_allclose(other.poses, default.poses, rtol=tolerance, atol=tolerance)
+    np.testing.assert_allclose(other.landmarks, default.landmarks, rtol=tolerance, atol=tolerance)
+    np.testing.assert_allclose(other.covariance, default.covariance, rtol=1e-3, atol=1e-6)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from .conftest import SENSOR_NOISE, add_detections, make_particles
+
+
+def dense_ekf_update(poses, mean, sigma, weights, measurement, sensor_noise_cov):
+    """The fastSLAM EKF correction written out one particle at a time with np.linalg, to check the batched one."""
+    r, bearing = measurement
+    mean, sigma, weights = mean.astype(np.float64), sigma.astype(np.float64), weights.astype(np.float64)
+    for i, (x, y, theta) in enumerate(poses):
+        phi = theta + bearing
+        measured = np.array((x + r * np.cos(phi), y + r * np.sin(phi)))
+        jacobian = np.array(((np.cos(phi), -r * np.sin(phi)), (np.sin(phi), r * np.cos(phi))))
+        innovation_cov = sigma[i] + jacobian @ sensor_noise_cov @ jacobian.T
+        gain = sigma[i] @ np.linalg.inv(innovation_cov)
+        innovation = measured - mean[i]
+
+        weights[i] *= np.exp(-0.5 * innovation @ np.linalg.solve(innovation_cov, innovation)) / (
+            2 * np.pi * np.sqrt(np.linalg.det(innovation_cov))
+        )
+        mean[i] = mean[i] + gain @ innovation
+        sigma[i] = (np.eye(2) - gain) @ sigma[i]
+
+    return mean, sigma, weights
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_measurement_update_matches_a_dense_ekf(packed):
+    particles = make_particles(dtype=np.float64, packed_covariance=packed)
+    add_detections(particles)
+    particles.poses += particles.rng.normal(0, 0.05, particles.poses.shape)
+    measurement = np.array((4.1, -0.28))
+
+    expected = dense_ekf_update(
+        particles.poses, particles.landmarks[:, 1], particles.covariance[:, 1],
+        particles.importance_factors, measurement, SENSOR_NOISE
+    )
+    particles.measurement_update(1, measurement, SENSOR_NOISE)
+
+    for result, reference in zip(
+        (particles.landmarks[:, 1], particles.covariance[:, 1], particles.importance_factors), expected
+    ):
+        np.testing.assert_allclose(result, reference, rtol=1e-9, atol=1e-12)
+    np.testing.assert_array_equal(particles.landmark_likelihood[:, 1], 2)
+
+
+def test_measurement_update_in_float32_maps():
+    particles = make_particles()
+    add_detections(particles)
+    measurement = np.array((4.1, -0.28))
+
+    expected = dense_ekf_update(
+        particles.poses, particles.landmarks[:, 1], particles.covariance[:, 1],
+        particles.importance_factors, measurement, SENSOR_NOISE
+    )
+    particles.measurement_update(1, measurement, SENSOR_NOISE)
+
+    np.testing.assert_allclose(particles.landmarks[:, 1], expected[0], rtol=1e-5)
+    np.testing.assert_allclose(particles.covariance[:, 1], expected[1], rtol=1e-3, atol=1e-6)
+    np.testing.assert_allclose(particles.importance_factors, expected[2], rtol=1e-3)
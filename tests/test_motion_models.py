@@ -0,0 +1,64 @@
+import numpy as np
+
+from particles import Particles
+from motion_models import OdometryMotionModel, VelocityMotionModel
+
+from .conftest import ALPHAS, make_particles
+
+
+def test_predict_noise_is_reproducible_from_the_seed():
+    first = make_particles(motion_model=VelocityMotionModel(ALPHAS), seed=4)
+    second = make_particles(motion_model=VelocityMotionModel(ALPHAS), seed=4)
+    first.predict((1., 0.2), 0.1)
+    second.predict((1., 0.2), 0.1)
+
+    np.testing.assert_array_equal(first.poses, second.poses)
+    assert np.std(first.poses[:, 0]) > 0
+
+
+def test_predict_drives_straight_without_blowing_up():
+    particles = Particles(10, np.array((1., 2., np.pi / 2)), motion_model=VelocityMotionModel(np.zeros(6)))
+    particles.predict((3., 0.), 0.5)
+
+    np.testing.assert_allclose(particles.poses, np.tile((1., 3.5, np.pi / 2), (10, 1)), atol=1e-12)
+
+
+def test_predict_follows_the_exact_arc():
+    particles = Particles(10, np.zeros(3), motion_model=VelocityMotionModel(np.zeros(6)))
+    v, w, timestep = 2., 0.5, 0.3
+
+    particles.predict((v, w), timestep)
+
+    theta = w * timestep
+    expected = (v / w * np.sin(theta), v / w * (1 - np.cos(theta)), theta)
+    np.testing.assert_allclose(particles.poses, np.tile(expected, (10, 1)), atol=1e-12)
+
+
+def test_predict_sequence_matches_repeated_predicts():
+    model = VelocityMotionModel(np.zeros(6))
+    controls = np.column_stack((np.linspace(1, 3, 7), np.linspace(-0.5, 0.5, 7)))
+    timesteps = np.linspace(0.05, 0.2, 7)
+    sequence = make_particles(20, motion_model=model)
+    repeated = make_particles(20, motion_model=model)
+    trajectory = np.empty((7, 20, 3))
+
+    sequence.predict_sequence(controls, timesteps, trajectory)
+    for step, (control, timestep) in enumerate(zip(controls, timesteps)):
+        repeated.predict(control, timestep)
+        np.testing.assert_allclose(trajectory[step], repeated.poses, atol=1e-12)
+
+    np.testing.assert_allclose(sequence.poses, repeated.poses, atol=1e-12)
+
+
+def test_odometry_noise_doesnt_depend_on_the_heading():
+    """Near ±π the raw rotations come out close to ±2π unless they are wrapped."""
+    spreads = []
+    for heading in (0., np.pi - 0.01):
+        start = np.array((0., 0., heading))
+        turn = np.array((0.1 * np.cos(heading + 0.02), 0.1 * np.sin(heading + 0.02), heading + 0.04))
+        particles = Particles(2000, start, motion_model=OdometryMotionModel(ALPHAS[:4]), seed=0)
+        particles.predict(np.stack((start, turn)), 0.1)
+
+        spreads.append(np.std(np.angle(np.exp(1j * (particles.poses[:, 2] - turn[2])))))
+
+    np.testing.assert_allclose(spreads[1], spreads[0], rtol=1e-6)
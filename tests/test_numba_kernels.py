@@ -0,0 +1,85 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import numba_kernels
+from particles import MeasurementBuffers, _ekf_update_numpy, _ekf_update_numba, stretched_noise_terms
+
+from .conftest import REPO_ROOT, SENSOR_NOISE
+
+needs_numba = pytest.mark.skipif(not numba_kernels.USE_NUMBA, reason="numba isn't installed (or is disabled)")
+
+# Runs a short seeded filter and prints the result, so it can be run with and without numba.
+FILTER_RUN = """
+import json, sys
+import numpy as np
+sys.path.insert(0, {root!r})
+import numba_kernels
+from particles import Particles, get_landmark_offsets, get_landmark_covs
+from motion_models import VelocityMotionModel, BicycleMotionModel
+
+R = np.array(((0.1, 0.01), (0.01, 0.02)))
+detections = np.array(((3., 0.1), (4., -0.3), (5., 1.)))
+particles = Particles(500, np.zeros(3), seed=2, motion_model=VelocityMotionModel([0.01, 0.0001, 0.0001, 0.001, 0.05, 0.1]))
+particles.predict((1., 0.2), 0.1)
+particles.predict((1., 0.), 0.1, model=BicycleMotionModel(1.5, [0.01] * 6))
+particles.predict_sequence(np.array(((1., 0.1), (2., -0.2), (1.5, 0.))), 0.05)
+positions = get_landmark_offsets(particles, detections) + particles.poses[:, None, :2]
+particles.add_landmarks(positions, get_landmark_covs(detections, R, particles.poses[:, 2]))
+particles.measurement_update(1, np.array((4.1, -0.28)), R)
+print(json.dumps({{
+    "numba": numba_kernels.USE_NUMBA,
+    "poses": particles.poses.tolist(),
+    "landmarks": particles.landmarks.tolist(),
+    "covariance": particles.covariance.tolist(),
+    "importance_factors": particles.importance_factors.tolist(),
+}}))
+"""
+
+
+def run_filter(disable_numba: bool) -> dict:
+    environment = dict(os.environ)
+    environment.pop("CLOUDS_DISABLE_NUMBA", None)
+    if disable_numba:
+        environment["CLOUDS_DISABLE_NUMBA"] = "1"
+
+    output = subprocess.run(
+        [sys.executable, "-c", FILTER_RUN.format(root=REPO_ROOT)],
+        env=environment, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output)
+
+
+@needs_numba
+def test_ekf_kernel_matches_numpy():
+    rng = np.random.default_rng(0)
+    number_of_particles = 300
+    poses = rng.normal(0, 0.2, (number_of_particles, 3))
+    mean = rng.normal((3, 1), 0.1, (number_of_particles, 2))
+    sigma = np.tile(((0.1, 0.02), (0.02, 0.05)), (number_of_particles, 1, 1))
+    weights = rng.random(number_of_particles)
+    terms = stretched_noise_terms(3.2, SENSOR_NOISE)
+
+    numpy_arrays = [array.copy() for array in (mean, sigma, weights)]
+    _ekf_update_numpy(
+        poses, 3.2, 0.3, *terms, *numpy_arrays, MeasurementBuffers.allocate(number_of_particles)
+    )
+    numba_arrays = [array.copy() for array in (mean, sigma, weights)]
+    _ekf_update_numba(poses, 3.2, 0.3, *terms, *numba_arrays, None)
+
+    for numba_result, numpy_result in zip(numba_arrays, numpy_arrays):
+        np.testing.assert_allclose(numba_result, numpy_result, rtol=1e-10)
+
+
+@needs_numba
+def test_whole_filter_matches_with_numba_disabled():
+    with_numba = run_filter(disable_numba=False)
+    without_numba = run_filter(disable_numba=True)
+
+    assert with_numba["numba"] and not without_numba["numba"]
+    for key in ("poses", "landmarks", "covariance", "importance_factors"):
+        np.testing.assert_allclose(with_numba[key], without_numba[key], rtol=1e-5, atol=1e-9)
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from particles import Particles, get_landmark_offsets, get_landmark_covs
+from particle_batch import ParticleBatch, BATCH_RESAMPLING_METHODS
+from motion_models import VelocityMotionModel, OdometryMotionModel
+
+from .conftest import ALPHAS, SENSOR_NOISE, DETECTIONS
+
+
+@pytest.mark.parametrize("method", list(BATCH_RESAMPLING_METHODS))
+def test_one_filter_matches_particles_under_the_same_seed(method):
+    model = VelocityMotionModel(ALPHAS)
+    batch = ParticleBatch(1, 100, np.zeros(3), np.array((0.1, 0.1, 0.05)), seed=3, motion_model=model)
+    plain = Particles(100, np.zeros(3), np.array((0.1, 0.1, 0.05)), seed=3, motion_model=model)
+
+    for particles in (batch, plain):
+        positions = get_landmark_offsets(particles, DETECTIONS) + particles.poses[:, None, :2]
+        particles.add_landmarks(positions, get_landmark_covs(DETECTIONS, SENSOR_NOISE, particles.poses[:, 2]))
+        for step in range(3):
+            particles.predict((1., 0.2), 0.1)
+            particles.measurement_update(step, DETECTIONS[step], SENSOR_NOISE)
+            particles.resample(method)
+
+    np.testing.assert_array_equal(batch.poses, plain.poses)
+    np.testing.assert_array_equal(batch.landmarks, plain.landmarks)
+    np.testing.assert_array_equal(batch.covariance, plain.covariance)
+
+
+def test_each_filter_runs_like_its_own_particles():
+    alphas = np.array((ALPHAS, np.zeros(6), np.multiply(ALPHAS, 4)))
+    noise = np.array((SENSOR_NOISE, SENSOR_NOISE * 2, SENSOR_NOISE / 2))
+    initial_poses = np.array(((0., 0., 0.), (1., 0., 0.5), (0., -2., 1.)))
+    batch = ParticleBatch(
+        3, 50, initial_poses, seed=0, motion_model=VelocityMotionModel(np.zeros(6)), filter_alphas=alphas
+    )
+
+    batch.predict(((1., 0.2), (2., 0.), (1., 0.2)), 0.1, per_filter=True)
+    positions = get_landmark_offsets(batch, DETECTIONS) + batch.poses[:, None, :2]
+    batch.add_landmarks(positions, get_landmark_covs(DETECTIONS, SENSOR_NOISE, batch.poses[:, 2]))
+    poses, landmarks = batch.filter_poses.copy(), batch.filter_landmarks.copy()
+    covariance, weights = batch.filter_covariance.copy(), batch.filter_importance_factors.copy()
+    batch.measurement_update(1, DETECTIONS[1], noise)
+
+    # The filter with no motion noise drove exactly, and the one with the biggest alphas spread out most.
+    np.testing.assert_allclose(batch.filter_poses[1], np.tile((1 + 0.2 * np.cos(0.5), 0.2 * np.sin(0.5), 0.5), (50, 1)))
+    assert np.std(batch.filter_poses[2][:, 2]) > np.std(batch.filter_poses[0][:, 2]) > 0
+
+    for filter_index in range(3):
+        particles = Particles(50, np.zeros(3))
+        particles.poses[:] = poses[filter_index]
+        particles.importance_factors[:] = weights[filter_index]
+        particles.add_landmarks(landmarks[filter_index], covariance[filter_index])
+        particles.measurement_update(1, DETECTIONS[1], noise[filter_index])
+
+        np.testing.assert_array_equal(batch.filter_landmarks[filter_index], particles.landmarks)
+        np.testing.assert_array_equal(batch.filter_covariance[filter_index], particles.covariance)
+        np.testing.assert_allclose(
+            batch.filter_importance_factors[filter_index], particles.importance_factors, rtol=1e-12
+        )
+
+
+def test_controls_are_only_per_filter_when_asked():
+    # With two filters, one (2, 3) odometry control has the same shape as a row of controls per filter.
+    odometry = np.array(((0., 0., 0.), (1., 0., 0.)))
+    batch = ParticleBatch(2, 10, np.zeros(3), motion_model=OdometryMotionModel(np.zeros(4)))
+    batch.predict(odometry, 0.1)
+    np.testing.assert_allclose(batch.poses, np.tile((1., 0., 0.), (20, 1)))
+
+    # Filter 0 drives 1m forward again, filter 1 stays put.
+    batch.predict(np.array((odometry, odometry[[1, 1]])), 0.1, per_filter=True)
+    np.testing.assert_allclose(batch.filter_poses[0], np.tile((2., 0., 0.), (10, 1)))
+    np.testing.assert_allclose(batch.filter_poses[1], np.tile((1., 0., 0.), (10, 1)))
+
+    with pytest.raises(ValueError):
+        batch.predict(odometry[0], 0.1, per_filter=True)
+
+
+def test_per_filter_landmarks_go_to_every_particle_of_their_filter():
+    batch = ParticleBatch(2, 5, np.zeros(3))
+    positions = np.array((((1., 2.), (3., 4.)), ((5., 6.), (7., 8.))))
+    covariances = np.array((np.tile(SENSOR_NOISE, (2, 1, 1)), np.tile(SENSOR_NOISE * 2, (2, 1, 1))))
+
+    assert batch.add_landmarks(positions, covariances, per_filter=True).tolist() == [0, 1]
+    np.testing.assert_array_equal(batch.filter_landmarks[1, 3], positions[1])
+    np.testing.assert_allclose(batch.filter_covariance[1, 3], covariances[1])
+
+    # (F, N, M, 2) gives every particle its own position.
+    per_particle = np.arange(2 * 5 * 1 * 2, dtype=np.float64).reshape(2, 5, 1, 2)
+    batch.add_landmarks(per_particle, per_filter=True)
+    np.testing.assert_array_equal(batch.filter_landmarks[:, :, 2], per_particle[:, :, 0])
+
+
+def test_resampling_stays_inside_each_filter():
+    batch = ParticleBatch(4, 25, np.zeros(3), seed=0)
+    batch.poses[:, 0] = np.repeat(np.arange(4), 25)
+    batch.filter_importance_factors[:] = np.random.default_rng(0).random((4, 25))
+    batch.filter_importance_factors[2] = np.eye(25)[3]
+
+    resampled = batch.resample()
+
+    assert resampled.all()
+    np.testing.assert_array_equal(batch.filter_poses[..., 0], np.arange(4)[:, None] + np.zeros(25))
+    assert np.ptp(batch.filter_poses[2], axis=0).max() == 0
+    np.testing.assert_allclose(batch.effective_sample_size(), 25)
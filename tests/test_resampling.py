@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from particles import ResampleBuffers, RESAMPLING_METHODS, get_landmark_offsets, _search_sorted
+from map_storage import gather_particles
+
+from .conftest import DETECTIONS, add_detections, make_particles
+
+
+@pytest.mark.parametrize("method", list(RESAMPLING_METHODS))
+def test_resampling_follows_the_weights(method):
+    number_of_particles = 1000
+    rng = np.random.default_rng(1)
+    weights = rng.random(number_of_particles) ** 4
+    weights /= weights.sum()
+
+    buffers = ResampleBuffers.allocate(number_of_particles)
+    counts = np.zeros(number_of_particles)
+    for _ in range(200):
+        indices = RESAMPLING_METHODS[method](weights, rng, buffers)
+        assert indices is buffers.indices
+        assert indices.min() >= 0 and indices.max() < number_of_particles
+        counts += np.bincount(indices, minlength=number_of_particles)
+
+    expected = weights * number_of_particles * 200
+    assert np.abs(counts - expected).max() < 5 * np.sqrt(expected.max()) + 5
+
+
+@pytest.mark.parametrize("method", ["systematic", "stratified", "residual"])
+def test_low_variance_methods_copy_whole_weights(method):
+    weights = np.zeros(10)
+    weights[3] = 0.5
+    weights[7] = 0.5
+
+    indices = RESAMPLING_METHODS[method](weights, np.random.default_rng(0), ResampleBuffers.allocate(10))
+    assert np.bincount(indices, minlength=10)[[3, 7]].tolist() == [5, 5]
+
+
+@pytest.mark.parametrize("side", ["left", "right"])
+def test_search_sorted_matches_numpy(side):
+    values = np.repeat(np.linspace(0, 1, 50), 2)
+    queries = np.random.default_rng(0).permutation(np.concatenate((values[::3], (-1., 0.5, 2.))))
+    out = np.empty(len(queries), dtype=np.intp)
+
+    _search_sorted(values, queries, out, side=side)
+    np.testing.assert_array_equal(out, np.searchsorted(values, queries, side=side))
+
+
+def test_resample_swaps_the_double_buffers():
+    particles = make_particles()
+    add_detections(particles)
+    live, spare = particles.poses, particles._spare_poses
+    particles.importance_factors[:] = np.linspace(0, 1, particles.number_of_particles)
+
+    assert particles.resample()
+    assert particles.poses is spare and particles._spare_poses is live
+    np.testing.assert_allclose(particles.importance_factors, 1 / particles.number_of_particles)
+
+    # Every particle's map comes along with its pose.
+    offsets = particles.landmarks - particles.poses[:, None, :2]
+    np.testing.assert_allclose(offsets, get_landmark_offsets(particles, DETECTIONS), atol=1e-5)
+
+
+def test_resample_skips_above_the_ess_threshold():
+    particles = make_particles()
+    poses = particles.poses.copy()
+
+    assert particles.effective_sample_size() == pytest.approx(particles.number_of_particles)
+    assert not particles.resample(ess_threshold=0.5)
+    np.testing.assert_array_equal(particles.poses, poses)
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_resample_only_needs_the_observed_landmarks(packed):
+    """A roomy map gathers fewer slots, but has to give the same particles as a full one."""
+    roomy = make_particles(max_landmarks=1024, packed_covariance=packed)
+    full = make_particles(max_landmarks=len(DETECTIONS), packed_covariance=packed)
+    for particles in (roomy, full):
+        add_detections(particles)
+        particles.importance_factors[:] = np.linspace(0, 1, particles.number_of_particles)
+        particles.resample()
+
+    np.testing.assert_array_equal(roomy.poses, full.poses)
+    np.testing.assert_array_equal(roomy.landmarks, full.landmarks)
+    np.testing.assert_array_equal(roomy.landmark_likelihood, full.landmark_likelihood)
+    np.testing.assert_array_equal(roomy.covariance, full.covariance)
+
+
+@pytest.mark.parametrize("observed", [3, 12])
+@pytest.mark.parametrize("particle_axis, slot_axis", [(0, 1), (1, 2), (2, 1)])
+def test_gather_particles_matches_np_take(observed, particle_axis, slot_axis):
+    rng = np.random.default_rng(0)
+    shape = [2, 16, 16]
+    shape[particle_axis] = 50
+    storage = rng.random(shape)
+    indices = rng.integers(0, 50, 50)
+    out = np.zeros_like(storage)
+
+    gather_particles(storage, indices, out, particle_axis, slot_axis, observed)
+
+    used = [slice(None)] * 3
+    used[slot_axis] = slice(observed)
+    np.testing.assert_array_equal(out[tuple(used)], np.take(storage, indices, axis=particle_axis)[tuple(used)])
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from particles import Particles
+from run_recording import RunRecorder, RunReplayer, ReplayReader
+from motion_models import VelocityMotionModel
+
+from .conftest import ALPHAS, DETECTIONS, add_detections
+
+
+def test_replay_gives_back_every_recorded_step(tmp_path):
+    particles = Particles(
+        40, np.zeros(3), np.array((0.1, 0.1, 0.05)), seed=0, max_landmarks=2, motion_model=VelocityMotionModel(ALPHAS)
+    )
+    expected = []
+
+    # A tiny chunk size, so the recording is spread over several chunk files.
+    with RunRecorder(str(tmp_path), chunk_size=4096) as recorder:
+        for step in range(6):
+            particles.predict((1., 0.2), 0.1)
+            if step % 2:
+                add_detections(particles, DETECTIONS[step // 2:step // 2 + 1])
+            recorder.record(particles)
+            expected.append(
+                (particles.version, particles.poses.copy(), particles.landmarks.copy(), particles.covariance.copy())
+            )
+
+    assert len(list(tmp_path.glob("chunk_*.bin"))) > 1
+
+    replayer = RunReplayer(str(tmp_path))
+    assert len(replayer) == 6
+    for snapshot, (version, poses, landmarks, covariance) in zip(replayer, expected):
+        assert snapshot.version == version
+        np.testing.assert_array_equal(snapshot.poses, poses)
+        np.testing.assert_array_equal(snapshot.landmarks, landmarks)
+        np.testing.assert_array_equal(snapshot.covariance, covariance)
+        assert snapshot.landmarks.dtype == np.float32
+
+    reader = ReplayReader(replayer)
+    assert reader.seek(-1).version == expected[-1][0]
+    assert reader.step_forward() is None
+    np.testing.assert_array_equal(reader.poses, expected[-1][1])
+    replayer.close()
+
+
+def test_recording_into_an_existing_recording_fails(tmp_path):
+    with RunRecorder(str(tmp_path)):
+        pass
+    with pytest.raises(FileExistsError):
+        RunRecorder(str(tmp_path))
@@ -0,0 +1,85 @@
+import gc
+
+import numpy as np
+import pytest
+
+from particles import Particles
+from sharded_particles import ShardedParticles, shard_bounds
+from motion_models import VelocityMotionModel
+
+from .conftest import ALPHAS, SENSOR_NOISE, DETECTIONS, add_detections
+
+
+def test_shards_cover_every_particle():
+    shards = shard_bounds(10, 3)
+    assert shards == [(0, 3), (3, 6), (6, 10)]
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_matches_particles(packed):
+    model = VelocityMotionModel(ALPHAS)
+    initial_error = np.array((0.1, 0.1, 0.05))
+    # max_observations and max_landmarks are tiny, so the scan is split up and the map grows part way through.
+    with ShardedParticles(
+        300, np.zeros(3), initial_error, seed=3, max_landmarks=2, motion_model=model,
+        packed_covariance=packed, number_of_workers=2, max_observations=2
+    ) as sharded:
+        plain = Particles(
+            300, np.zeros(3), initial_error, seed=3, max_landmarks=2, motion_model=model, packed_covariance=packed
+        )
+        np.testing.assert_array_equal(sharded.poses, plain.poses)
+
+        # Every worker draws its own noise, so give the plain particles the same poses afterwards.
+        sharded.predict((1., 0.2), 0.1)
+        assert np.std(sharded.poses[:, 0]) > 0
+        plain.poses[:] = sharded.poses
+
+        indices = sharded.add_observations(DETECTIONS, SENSOR_NOISE)
+        assert indices.tolist() == add_detections(plain).tolist()
+        sharded.measurement_update(1, DETECTIONS[1], SENSOR_NOISE)
+        plain.measurement_update(1, DETECTIONS[1], SENSOR_NOISE)
+
+        np.testing.assert_array_equal(sharded.landmarks, plain.landmarks)
+        np.testing.assert_array_equal(sharded.covariance, plain.covariance)
+        np.testing.assert_array_equal(sharded.landmark_likelihood, plain.landmark_likelihood)
+        np.testing.assert_allclose(sharded.importance_factors, plain.importance_factors, rtol=1e-12)
+
+        plain.importance_factors[:] = sharded.importance_factors
+        sharded.rng = np.random.default_rng(9)
+        plain.rng = np.random.default_rng(9)
+        sharded.resample()
+        plain.resample()
+
+        np.testing.assert_array_equal(sharded.poses, plain.poses)
+        np.testing.assert_array_equal(sharded.landmarks, plain.landmarks)
+        np.testing.assert_array_equal(sharded.covariance, plain.covariance)
+
+        # A viewer can still attach to the shared arrays.
+        reader = Particles.attach(sharded.shared_memory_name)
+        np.testing.assert_array_equal(reader.poses, sharded.poses)
+        reader.close()
+
+
+def test_assigning_the_motion_model_sends_it_to_the_workers():
+    with ShardedParticles(20, np.zeros(3), seed=0, number_of_workers=2) as sharded:
+        with pytest.raises(ValueError, match="motion model"):
+            sharded.predict((1., 0.), 0.5)
+
+        sharded.motion_model = VelocityMotionModel(np.zeros(6))
+        sharded.predict((1., 0.), 0.5)
+        np.testing.assert_allclose(sharded.poses, np.tile((0.5, 0., 0.), (20, 1)), atol=1e-12)
+
+        with pytest.raises(ValueError, match="Assign motion_model"):
+            sharded.predict((1., 0.), 0.5, model=VelocityMotionModel(ALPHAS))
+
+
+def test_garbage_collection_stops_the_workers():
+    sharded = ShardedParticles(20, np.zeros(3), seed=0, number_of_workers=2)
+    workers, name = list(sharded._workers), sharded.shared_memory_name
+
+    del sharded
+    gc.collect()
+
+    assert not any(worker.is_alive() for worker in workers)
+    with pytest.raises(FileNotFoundError):
+        Particles.attach(name)
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from particles import Particles
+from shared_map_particles import SharedMapParticles
+from motion_models import VelocityMotionModel
+
+from .conftest import ALPHAS, SENSOR_NOISE, DETECTIONS, add_detections
+
+
+def run_filter(particles_class, **kwargs):
+    particles = particles_class(
+        100, np.zeros(3), np.array((0.1, 0.1, 0.05)), seed=5, max_landmarks=2,
+        motion_model=VelocityMotionModel(ALPHAS), **kwargs
+    )
+    add_detections(particles)
+    for step in range(4):
+        particles.predict((1., 0.1), 0.1)
+        particles.measurement_update(step % len(DETECTIONS), DETECTIONS[step % len(DETECTIONS)], SENSOR_NOISE)
+        particles.resample()
+    add_detections(particles, DETECTIONS[:2])
+    particles.measurement_update(6, DETECTIONS[1], SENSOR_NOISE)
+
+    return particles
+
+
+@pytest.mark.parametrize("dtype", [None, np.float32, np.float64])
+def test_matches_particles_under_the_same_seed(dtype):
+    shared = run_filter(SharedMapParticles, dtype=dtype)
+    plain = run_filter(Particles, dtype=dtype)
+
+    assert shared.pool_landmarks.dtype == shared.landmarks.dtype == plain.landmarks.dtype
+    assert shared.poses.dtype == plain.poses.dtype
+    np.testing.assert_array_equal(shared.poses, plain.poses)
+    np.testing.assert_array_equal(shared.importance_factors, plain.importance_factors)
+    np.testing.assert_array_equal(shared.landmarks, plain.landmarks)
+    np.testing.assert_array_equal(shared.covariance, plain.covariance)
+    np.testing.assert_array_equal(shared.landmark_likelihood, plain.landmark_likelihood)
+
+
+def test_landmarks_are_shared_until_written():
+    particles = SharedMapParticles(50, np.zeros(3), seed=0)
+    particles.add_landmarks(np.array(((1., 2.), (3., 4.))), np.tile(SENSOR_NOISE, (2, 1, 1)))
+
+    # Every particle agrees, so each landmark is one pool entry.
+    assert particles.shared_fraction() == 1 - 2 / 100
+    np.testing.assert_array_equal(particles.landmarks[:, 1], np.tile((3., 4.), (50, 1)))
+
+    # The update changes every particle's copy of landmark 0, so it gets detached. Landmark 1 stays shared.
+    particles.poses[:, 0] = np.linspace(-0.1, 0.1, 50)
+    particles.measurement_update(0, np.array((2.2, 1.1)), SENSOR_NOISE)
+    assert len(np.unique(particles.map_table[:, 0])) == 50
+    assert len(np.unique(particles.map_table[:, 1])) == 1
+    assert np.count_nonzero(particles.pool_refcount) == 51
+
+    # Resampling duplicates particles, so they share their entries again and nothing is copied.
+    particles.importance_factors[:] = 0
+    particles.importance_factors[7] = 1
+    particles.resample()
+    assert len(np.unique(particles.map_table[:, 0])) == 1
+    assert np.count_nonzero(particles.pool_refcount) == 2
+
+
+def test_particles_read_their_own_rows():
+    particles = run_filter(SharedMapParticles)
+    subset = particles[::3]
+    rows = {name: particles._map_rows(name, 4) for name in ("landmarks", "covariance", "landmark_likelihood")}
+
+    # Nothing has been gathered yet, so these come straight from the pool.
+    assert particles._gathered == {}
+    np.testing.assert_array_equal(particles[4].landmarks, rows["landmarks"])
+    assert not particles[4].covariances.flags.writeable
+
+    # The whole arrays are gathered once per version.
+    landmarks = particles.landmarks
+    assert particles.landmarks is landmarks
+    np.testing.assert_array_equal(landmarks[4], rows["landmarks"])
+    np.testing.assert_array_equal(particles.covariance[4], rows["covariance"])
+    np.testing.assert_array_equal(particles.landmark_likelihood[4], rows["landmark_likelihood"])
+    np.testing.assert_array_equal(subset.landmarks, landmarks[::3])
+
+    particles.measurement_update(0, DETECTIONS[0], SENSOR_NOISE)
+    assert particles.landmarks is not landmarks
+    np.testing.assert_array_equal(subset.covariance, particles.covariance[::3])
+    assert not np.array_equal(particles.landmarks[:, 0], landmarks[:, 0])
+
+
+@pytest.mark.parametrize("argument", [{"packed_covariance": True}, {"shared_memory_name": "clouds_unused"}])
+def test_unsupported_layouts_are_refused(argument):
+    with pytest.raises(ValueError, match=next(iter(argument))):
+        SharedMapParticles(10, np.zeros(3), **argument)
@@ -0,0 +1,75 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from particles import Particles
+from motion_models import VelocityMotionModel
+
+from .conftest import ALPHAS, SENSOR_NOISE, DETECTIONS, REPO_ROOT, add_detections
+
+# Attaches from another process, then exits without closing.
+READER_RUN = """
+import sys
+sys.path.insert(0, {root!r})
+from particles import Particles
+reader = Particles.attach({name!r})
+print(reader.number_of_particles)
+"""
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_attached_particles_follow_the_owner(shared_memory_name, packed):
+    owner = Particles(
+        50, np.zeros(3), np.array((0.1, 0.1, 0.05)), seed=0, max_landmarks=2, motion_model=VelocityMotionModel(ALPHAS),
+        shared_memory_name=shared_memory_name, packed_covariance=packed
+    )
+    reader = Particles.attach(shared_memory_name)
+    try:
+        np.testing.assert_array_equal(reader.poses, owner.poses)
+        assert reader.observed_landmarks == 0
+
+        # Adding landmarks grows the map into a new block, and resampling swaps the live buffers.
+        add_detections(owner)
+        owner.predict((1., 0.2), 0.1)
+        owner.measurement_update(2, DETECTIONS[2], SENSOR_NOISE)
+        owner.resample()
+
+        assert reader.refresh()
+        assert not reader.refresh()
+        assert reader.observed_landmarks == len(DETECTIONS)
+        np.testing.assert_array_equal(reader.poses, owner.poses)
+        np.testing.assert_array_equal(reader.importance_factors, owner.importance_factors)
+        np.testing.assert_array_equal(reader.landmarks, owner.landmarks)
+        np.testing.assert_array_equal(reader.covariance, owner.covariance)
+        np.testing.assert_array_equal(reader.landmark_likelihood, owner.landmark_likelihood)
+
+        with pytest.raises(ValueError):
+            reader.poses[0, 0] = 1
+    finally:
+        reader.close()
+        owner.close()
+
+
+def test_a_reader_exiting_leaves_the_owners_blocks_alone(shared_memory_name):
+    owner = Particles(50, np.zeros(3), seed=0, max_landmarks=2, shared_memory_name=shared_memory_name)
+    try:
+        add_detections(owner, DETECTIONS[:1])
+        output = subprocess.run(
+            [sys.executable, "-c", READER_RUN.format(root=REPO_ROOT, name=shared_memory_name)],
+            capture_output=True, text=True, check=True,
+        )
+        assert output.stdout.strip() == "50"
+        assert "leaked" not in output.stderr
+
+        # Growing the map unlinks the old map block, which the reader's exit mustn't have done already.
+        add_detections(owner)
+        assert owner.observed_landmarks == len(DETECTIONS) + 1
+    finally:
+        owner.close()
+
+
+def test_attach_to_a_missing_block_fails(shared_memory_name):
+    with pytest.raises(FileNotFoundError):
+        Particles.attach(shared_memory_name)
@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PyQt5")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import QRectF  # noqa: E402
+from PyQt5.QtGui import QImage, QPainter  # noqa: E402
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+from particles import Particles, uncertainty_ellipses  # noqa: E402
+from particle_viewer import ParticleView, create_landmark_layer, create_ellipse_layer  # noqa: E402
+from landmark_cloud import LandmarkLayerItem, EllipseLayerItem  # noqa: E402
+from vehicle_cloud import PoseCloudItem  # noqa: E402
+
+from .conftest import add_detections  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def application():
+    return QApplication.instance() or QApplication([])
+
+
+def test_uncertainty_ellipses_match_the_eigenvectors():
+    rng = np.random.default_rng(0)
+    factors = rng.normal(size=(20, 2, 2))
+    covariance = factors @ factors.swapaxes(-1, -2)
+
+    axes, angles = uncertainty_ellipses(covariance, confidence=0.95)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+
+    np.testing.assert_allclose(axes, np.sqrt(eigenvalues[:, ::-1] * 5.991), rtol=1e-3)
+    major = eigenvectors[:, :, 1]
+    np.testing.assert_allclose(np.abs(np.sin(angles - np.arctan2(major[:, 1], major[:, 0]))), 0, atol=1e-9)
+
+
+def test_pose_cloud_culls_thins_and_skips_unchanged_frames(application):
+    particles = Particles(1000, np.zeros(3), seed=0)
+    particles.poses[:, 0] = np.linspace(-50, 50, 1000)
+    cloud = PoseCloudItem(particles)
+    cloud.detail_budget = 100
+
+    cloud.update_particles()
+    bounds = cloud.boundingRect()
+    assert bounds.left() < -50 and bounds.right() > 50
+
+    # Only the particles inside the exposed rect are drawn, thinned out to the detail budget.
+    visible = cloud.visible_markers(cloud.anchors(), QRectF(-10, -10, 20, 20))
+    assert 0 < len(visible) <= 100
+    assert np.all(np.abs(cloud.anchors()[visible, 0]) < 10 + cloud.margin())
+    assert len(cloud.visible_markers(cloud.anchors(), QRectF(-50, -50, 100, 100))) <= 100
+
+    # Nothing has changed, so the bounds aren't worked out again.
+    cloud._bounds = QRectF()
+    cloud.update_particles()
+    assert cloud.boundingRect().isEmpty()
+    particles.mark_changed()
+    cloud.update_particles()
+    assert not cloud.boundingRect().isEmpty()
+
+
+def test_detail_follows_the_zoom(application):
+    particles = Particles(5000, np.zeros(3), np.array((1., 1., 0.1)), seed=0)
+    particles.poses[0, :2] = (8., 8.)
+    cloud = PoseCloudItem(particles)
+    anchors = cloud.anchors()
+    exposed = QRectF(-10, -10, 20, 20)
+
+    # Zoomed out, a pixel cell covers a lot of the cloud, so only one marker per cell is drawn.
+    cloud.pixel_size = 1.
+    zoomed_out = cloud.visible_markers(anchors, exposed)
+    cells = (anchors[zoomed_out] - (-10 - cloud.margin())) // 2
+    assert len(np.unique(cells, axis=0)) == len(zoomed_out)
+
+    cloud.pixel_size = 0.005
+    zoomed_in = cloud.visible_markers(anchors, exposed)
+    assert len(zoomed_out) < len(zoomed_in) == len(particles.poses)
+
+    # The lone particle has a cell to itself, so it's always drawn.
+    assert 0 in zoomed_out and 0 in zoomed_in
+
+
+def test_crowded_clouds_are_summarised(application):
+    particles = Particles(5000, np.zeros(3), seed=0)
+    particles.poses[:, 0] = np.linspace(0, 40, 5000)
+    cloud = PoseCloudItem(particles)
+    cloud.update_particles()
+
+    # 40 pixels across is too big for SUMMARY_SIZE, but 5000 arrows in it is too crowded.
+    assert cloud.summarise()
+    cloud.pixel_size = 0.2
+    assert not cloud.summarise()
+
+
+@pytest.mark.parametrize(
+    "layer_class, drawer", [(LandmarkLayerItem, "draw_markers"), (EllipseLayerItem, "draw_ellipses")]
+)
+def test_landmark_layers_summarise_to_one_marker_per_landmark(application, monkeypatch, layer_class, drawer):
+    particles = Particles(200, np.zeros(3), np.array((0.2, 0.2, 0.1)), seed=0)
+    add_detections(particles)
+    drawn = []
+    monkeypatch.setattr(layer_class, drawer, lambda self, painter, anchors, *rest: drawn.append(len(rest[0])))
+
+    layer = layer_class(particles, means_only=True)
+    layer.update_particles()
+    assert not layer.draw_summary(None, QRectF(-100, -100, 200, 200))
+
+    layer = layer_class(particles, means_only=False)
+    layer.update_particles()
+    assert layer.draw_summary(None, QRectF(-100, -100, 200, 200))
+    assert drawn == [particles.observed_landmarks]
+
+
+def test_view_draws_every_layer(application):
+    particles = Particles(200, np.zeros(3), np.array((0.2, 0.2, 0.1)), seed=0)
+    add_detections(particles)
+    view = ParticleView(particles)
+    for cloud in (PoseCloudItem(particles), create_landmark_layer(particles), create_ellipse_layer(particles)):
+        view.add_cloud(cloud)
+    view.update_clouds()
+
+    image = QImage(200, 200, QImage.Format_ARGB32)
+    image.fill(0)
+    painter = QPainter(image)
+    view.scene.render(painter, QRectF(0, 0, 200, 200), QRectF(-3, -8, 12, 16))
+    painter.end()
+
+    pixels = np.frombuffer(image.constBits().asstring(image.sizeInBytes()), np.uint32)
+    assert np.count_nonzero(pixels) > 0
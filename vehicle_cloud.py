@@ -1,9 +1,14 @@
-from particles import Particle
+from particles import Particle, Particles, uncertainty_ellipses
+from particle_cloud import ArrayCloudItem
 from PyQt5.QtWidgets import QGraphicsItem
-from PyQt5.QtGui import QBrush, QPen, QPainter, QPolygonF 
+from PyQt5.QtGui import QBrush, QPen, QPainter, QPolygonF, QColor, QPixmap
+from PyQt5 import sip
 from PyQt5.QtCore import Qt, QPointF, QRectF
 import numpy as np
 
+DEFAULT_ARROW_HEIGHT = 9  # pixels. The arrows are three times as long as they are wide.
+FRAGMENT_FIELDS = 10  # doubles in one QPainter.PixmapFragment.
+
 class DirectionalParticleItem(QGraphicsItem):
     """This class is used to create a direction particle. A direction particle is anything with a full pose (IE a position and heading. This is represented by an arrow at the moment. The direction particle does not handle movement or uncertanty for now, its only a point. If you want to change how this is displayed, please read the docs! It should be fairly flexible."""
     def __init__(self, x, y, angle, height):
@@ -51,5 +56,108 @@ def update_direction_particle(particle_data: Particle, particle_view: Directiona
     x, y, theta = particle_data.pose
     particle_view.setPos(x, -y)
     particle_view.setRotation(np.degrees(-theta))
-    
 
+
+def create_arrow_pixmap(color, height: float) -> QPixmap:
+    """Draws one arrow pointing along +x, with its tip on the right hand edge, into a transparent pixmap."""
+    width = 3 * height
+    pixmap = QPixmap(int(np.ceil(width)) + 1, int(np.ceil(height)) + 1)
+    pixmap.fill(Qt.GlobalColor.transparent)
+
+    painter = QPainter(pixmap)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    painter.setBrush(QBrush(color))
+    painter.setPen(QPen(Qt.PenStyle.NoPen))
+    painter.drawPolygon(QPolygonF([
+        QPointF(width + 0.5, height / 2 + 0.5),
+        QPointF(0.5, 0.5),
+        QPointF(0.5, height + 0.5),
+    ]))
+    painter.end()
+
+    return pixmap
+
+
+class PoseCloudItem(ArrayCloudItem):
+    """Draws every particle pose as an arrow, in one paint call.
+
+    The arrows look the same as DirectionalParticleItem, but instead of one item per particle, one arrow is
+    drawn into a pixmap up front and stamped down at every pose with a single drawPixmapFragments call.
+    The position and rotation of every stamp are written straight into the fragment array with numpy.
+
+    When the whole cloud is tiny on screen, it's drawn as one arrow at the mean pose inside the 95% ellipse
+    of the particle positions."""
+    def __init__(self, particles_data: Particles, color=None, height: float = DEFAULT_ARROW_HEIGHT):
+        super().__init__(particles_data, QColor(Qt.GlobalColor.red) if color is None else color, height)
+
+        self._summary_pen = QPen(self.color)
+        self._summary_pen.setCosmetic(True)
+        self._arrow_pixmap = create_arrow_pixmap(self.color, height)
+        self._fragments = sip.array(QPainter.PixmapFragment, 0)
+        self._fragment_fields = np.empty((0, FRAGMENT_FIELDS))
+
+    def anchors(self):
+        poses = self.data.poses
+        return np.stack((poses[:, 0], -poses[:, 1]), axis=1)
+
+    def reach(self):
+        # The arrows are three times longer than their height.
+        return 2 * self.size * self.pixel_size
+
+    def draw_markers(self, painter, anchors, visible):
+        self.draw_arrows(painter, anchors[visible], self.data.poses[visible, 2])
+
+    def draw_arrows(self, painter, points: np.ndarray, theta: np.ndarray) -> None:
+        """Draws an arrow with its tip at each (K, 2) scene point, pointing along each heading."""
+        fragments, fields = self.fragments(len(points))
+
+        # Fragments are placed by their centre, which is half an arrow behind the tip.
+        half_length = self._arrow_pixmap.width() / 2 * self.pixel_size
+        np.cos(theta, out=fields[:, 0])
+        np.sin(theta, out=fields[:, 1])
+        fields[:, 1] *= -1
+        fields[:, :2] *= -half_length
+        fields[:, :2] += points
+
+        # Undo the view's zoom, so the arrows stay the same size on screen.
+        fields[:, 6:8] = self.pixel_size
+        np.degrees(theta, out=fields[:, 8])
+        fields[:, 8] *= -1
+
+        painter.drawPixmapFragments(fragments, self._arrow_pixmap)
+
+    def fragments(self, number_of_fragments: int) -> tuple:
+        """Returns a sip array of pixmap fragments and an (K, 10) numpy view of it.
+
+        Each row is (x, y, source left, source top, width, height, scale x, scale y, rotation, opacity).
+        Like ArrayCloudItem.polygon, it's only rebuilt when the number of fragments changes."""
+        if len(self._fragments) != number_of_fragments:
+            self._fragments = sip.array(QPainter.PixmapFragment, number_of_fragments)
+            self._fragment_fields = np.frombuffer(
+                memoryview(self._fragments), np.float64
+            ).reshape(number_of_fragments, FRAGMENT_FIELDS)
+
+            # Everything but the position, scale and rotation is the same for every arrow.
+            self._fragment_fields[:, 2:4] = 0
+            self._fragment_fields[:, 4] = self._arrow_pixmap.width()
+            self._fragment_fields[:, 5] = self._arrow_pixmap.height()
+            self._fragment_fields[:, 9] = 1
+
+        return self._fragments, self._fragment_fields
+
+    def draw_summary(self, painter, exposed):
+        poses = self.data.poses
+        mean = poses[:, :2].mean(axis=0)
+        heading = np.arctan2(np.sin(poses[:, 2]).mean(), np.cos(poses[:, 2]).mean())
+        axes, angle = uncertainty_ellipses(np.cov(poses[:, :2], rowvar=False))
+
+        painter.save()
+        painter.translate(mean[0], -mean[1])
+        painter.rotate(-np.degrees(angle))
+        painter.setPen(self._summary_pen)
+        painter.setBrush(Qt.BrushStyle.NoBrush)
+        painter.drawEllipse(QPointF(0, 0), axes[0], axes[1])
+        painter.restore()
+
+        self.draw_arrows(painter, np.array([[mean[0], -mean[1]]]), np.array([heading]))
+        return True